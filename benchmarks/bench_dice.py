@@ -0,0 +1,76 @@
+"""/dice engine: old per-die loop vs. rollSum, plus a moment check.
+
+    py benchmarks/bench_dice.py --samples 2000
+
+For each (roll, side) the script times one call of each method (the old
+loop is skipped when it would take too long) and compares the mean and
+standard deviation of many rollSum samples with the exact values
+N(S+1)/2 and sqrt(N(S^2-1)/12), in units of the exact standard deviation.
+"""
+import argparse
+import math
+import os
+import random
+import sys
+import time
+from fractions import Fraction
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from dice import rollSum
+
+CASES = [
+    (100, 6),
+    (10_000, 6),
+    (100_000, 100),
+    (1_000_000, 1_000_000),
+    (16_777_215, 16_777_215),
+    (10 ** 15, 6),
+    (10 ** 300, 10 ** 300),
+    (10 ** 900 - 1, 10 ** 900 - 1),
+]
+OLD_LOOP_LIMIT = 1_000_000
+
+
+def old_loop(roll: int, side: int):
+    return sum(random.randint(1, side) for _ in range(roll))
+
+
+def as_float(value: Fraction):
+    # 分子と分母が float に収まらない桁数でも比は出せるように対数で割る
+    if value == 0:
+        return 0.0
+    return math.exp(math.log(abs(value.numerator)) - math.log(value.denominator)) * (1 if value > 0 else -1)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--samples", type=int, default=2000)
+    args = parser.parse_args()
+    sys.set_int_max_str_digits(0)
+
+    print(f"{'roll':>10} {'side':>10} {'old (ms)':>10} {'new (ms)':>10} {'mean dev':>9} {'sd ratio':>9}")
+    for roll, side in CASES:
+        old = f"{timed(old_loop, roll, side):10.2f}" if roll <= OLD_LOOP_LIMIT else f"{'-':>10}"
+        new = timed(rollSum, roll, side)
+        samples = [rollSum(roll, side) for _ in range(args.samples)]
+        n = len(samples)
+        total = sum(samples)
+        variance = Fraction(roll * (side * side - 1), 12)
+        diff = Fraction(2 * total - n * roll * (side + 1), 2 * n)
+        mean_dev = math.sqrt(as_float(diff * diff / variance)) * (1 if diff >= 0 else -1)
+        sample_variance = Fraction(sum((n * x - total) ** 2 for x in samples), n ** 3)
+        sd_ratio = math.sqrt(as_float(sample_variance / variance))
+        label = lambda value: f"{value:,}" if value < 10 ** 9 else f"1e{len(str(value)) - 1}"
+        print(f"{label(roll):>10} {label(side):>10} {old} {new:10.2f} {mean_dev:9.3f} {sd_ratio:9.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Event-loop lag under concurrent voice churn: crud on the loop vs. the DB executor.
+
+    py benchmarks/bench_event_loop_lag.py --users 200 --events 20
+
+Runs against a throwaway SQLite file so ``vampire.db`` is never touched.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+_tmpdir = tempfile.TemporaryDirectory()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmpdir.name, 'bench.db')}"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import delete
+from database import init_db
+from database.models import VCSession
+import database.crud as crud
+import database.aio as db
+from database.crud import get_session
+
+GUILD_ID = 1
+CHANNEL_ID = 100
+
+
+async def monitor_lag(stop: asyncio.Event, samples: list, interval: float = 0.001):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(loop.time() - start - interval)
+
+
+def open_session(session, user_id: int, mic_on: bool, event_time: int):
+    crud.checkpointVcSessions(session, [], [(GUILD_ID, user_id, CHANNEL_ID, event_time, mic_on)], [])
+
+
+def close_session(session, user_id: int, mic_on: bool, start_time: int, end_time: int):
+    key = (GUILD_ID, user_id, CHANNEL_ID)
+    crud.checkpointVcSessions(session, [(*key, start_time, end_time, mic_on)], [], [key])
+
+
+def toggle_mute(session, user_id: int, mic_on: bool, start_time: int, event_time: int):
+    close_session(session, user_id, mic_on, start_time, event_time)
+    open_session(session, user_id, not mic_on, event_time)
+
+
+async def churn_blocking(user_id: int, events: int):
+    # ループ上で直接crudを呼び、イベントごとに書き込む
+    mic_on = False
+    start_time = int(time.time())
+    with get_session() as session:
+        open_session(session, user_id, mic_on, start_time)
+    for _ in range(events):
+        await asyncio.sleep(random.random() * 0.005)
+        event_time = int(time.time())
+        with get_session() as session:
+            toggle_mute(session, user_id, mic_on, start_time, event_time)
+        mic_on, start_time = not mic_on, event_time
+    with get_session() as session:
+        close_session(session, user_id, mic_on, start_time, int(time.time()))
+
+
+async def churn_executor(user_id: int, events: int):
+    mic_on = False
+    start_time = int(time.time())
+    await db.run(open_session, user_id, mic_on, start_time)
+    for _ in range(events):
+        await asyncio.sleep(random.random() * 0.005)
+        event_time = int(time.time())
+        await db.run(toggle_mute, user_id, mic_on, start_time, event_time)
+        mic_on, start_time = not mic_on, event_time
+    await db.run(close_session, user_id, mic_on, start_time, int(time.time()))
+
+
+async def run_case(name: str, churn, users: int, events: int):
+    with get_session() as session:
+        session.execute(delete(VCSession))
+        session.commit()
+    stop = asyncio.Event()
+    samples = []
+    monitor = asyncio.create_task(monitor_lag(stop, samples))
+    start = time.perf_counter()
+    await asyncio.gather(*(churn(user_id, events) for user_id in range(1, users + 1)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await monitor
+
+    samples.sort()
+    p99 = samples[int(len(samples) * 0.99) - 1] if samples else 0.0
+    total_events = users * (events * 2 + 2)
+    print(f"{name:<10} events={total_events:>6} elapsed={elapsed:7.2f}s "
+          f"lag mean={statistics.fmean(samples) * 1000:8.2f}ms "
+          f"p99={p99 * 1000:8.2f}ms max={samples[-1] * 1000:8.2f}ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--events", type=int, default=20)
+    args = parser.parse_args()
+
+    init_db()
+    random.seed(0)
+    await run_case("blocking", churn_blocking, args.users, args.events)
+    await run_case("executor", churn_executor, args.users, args.events)
+    db.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,127 @@
+"""Memory and time of /server-settings export: buffered vs. streamed.
+
+    py benchmarks/bench_export.py --rows 300000
+
+Seeds one guild with --rows vc_summary rows (--members members over
+--channels channels and as many months as needed), then builds the
+export file both ways:
+
+  buffered  .all() the rows and build the whole file in a StringIO
+  streamed  crud.exportVcSummary: yield_per chunks into an ExportWriter,
+            split into --part-size parts that spill to temp files
+
+Reported: time, output size, files and the peak Python heap seen by
+tracemalloc while building the file (measured on a second, untimed
+run). The streamed peak should stay flat as --rows grows; the buffered
+one grows with it.
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+_tmpdir = tempfile.TemporaryDirectory()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmpdir.name, 'export.db')}"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import insert, select
+from database import engine, init_db
+from database.export import ExportWriter, flattenRow
+from database.models import Guild, GuildUser, User, VCSummary
+import database.crud as crud
+
+GUILD_ID = 1
+
+
+def seed(args):
+    init_db()
+    months = -(-args.rows // (args.members * args.channels))
+    with engine.begin() as conn:
+        conn.execute(insert(Guild), [{"guild_id": GUILD_ID}])
+        conn.execute(insert(User), [{"user_id": user_id} for user_id in range(1, args.members + 1)])
+        conn.execute(insert(GuildUser), [{"id": user_id, "guild_id": GUILD_ID, "user_id": user_id} for user_id in range(1, args.members + 1)])
+        rows = []
+        for index in range(args.rows):
+            user_id = index % args.members + 1
+            channel_id = index // args.members % args.channels + 100
+            month = index // (args.members * args.channels) % months
+            rows.append({"id": user_id, "channel_id": channel_id, "year": 2000 + month // 12, "month": month % 12 + 1,
+                         "total_connection_time": index % 7200 + 60, "total_mic_on_time": index % 60})
+            if len(rows) == 10000:
+                conn.execute(insert(VCSummary), rows)
+                rows.clear()
+        if rows:
+            conn.execute(insert(VCSummary), rows)
+
+
+def buffered(args):
+    # 以前の読み方: 全部の行を読んでから、ファイル全体をメモリ上で作る
+    with crud.get_session() as session:
+        rows = session.execute(
+            select(VCSummary.channel_id, VCSummary.year, VCSummary.month, GuildUser.user_id, VCSummary.total_connection_time, VCSummary.total_mic_on_time)
+            .join(GuildUser, GuildUser.id == VCSummary.id).where(GuildUser.guild_id == GUILD_ID)
+        ).all()
+    out = io.StringIO()
+    writer = None
+    for rank, row in enumerate(rows, start=1):
+        entry = crud.VCRankingEntry(rank, row.user_id, row.total_connection_time, row.total_mic_on_time)
+        record = {"channel_id": row.channel_id, "year": row.year, "month": row.month, **entry.to_dict()}
+        if args.format == "csv":
+            record = flattenRow(record)
+            if writer is None:
+                writer = csv.writer(out, lineterminator="\n")
+                writer.writerow(record)
+            writer.writerow(record.values())
+        else:
+            out.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+    data = out.getvalue().encode("utf-8")
+    return len(rows), len(data), 1
+
+
+def streamed(args):
+    writer = ExportWriter("bench", args.format, args.part_size, max_parts=1000)
+    try:
+        with crud.get_session() as session:
+            rows = crud.exportVcSummary(session, GUILD_ID, writer, "month", args.chunk_size)
+        return rows, writer.size, len(writer)
+    finally:
+        writer.close()
+
+
+def measure(strategy, args):
+    # tracemalloc は遅くなるので、時間は測らずに別に1回まわす
+    started = time.perf_counter()
+    rows, size, files = strategy(args)
+    elapsed = time.perf_counter() - started
+    tracemalloc.start()
+    strategy(args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return rows, size, files, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=300000)
+    parser.add_argument("--members", type=int, default=2000)
+    parser.add_argument("--channels", type=int, default=5)
+    parser.add_argument("--format", choices=("csv", "ndjson"), default="csv")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--part-size", type=int, default=10 * 1024 * 1024 - 64 * 1024, help="bytes per file (default: Discord's 10MB limit minus headroom)")
+    args = parser.parse_args()
+
+    seed(args)
+    print(f"{args.rows} vc_summary rows, format={args.format}")
+    print(f"{'strategy':<10} {'rows':>8} {'time':>8} {'size':>10} {'files':>6} {'peak heap':>10}")
+    for name, strategy in (("buffered", buffered), ("streamed", streamed)):
+        rows, size, files, elapsed, peak = measure(strategy, args)
+        print(f"{name:<10} {rows:>8} {elapsed:>7.2f}s {size / 1024 / 1024:>8.1f}MB {files:>6} {peak / 1024 / 1024:>8.1f}MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Meme trigger matching: naive per-trigger scan vs. the compiled MemeMatcher.
+
+    py benchmarks/bench_meme_matching.py --messages 20000
+
+Uses the triggers from messages/memes.json plus synthetic substring
+triggers, against a synthetic chat stream where most messages match
+nothing (the common case in a busy guild).
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from memes import MemeMatcher, MemeRule, parseMemeRules
+
+HIRAGANA = "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをん"
+KATAKANA = "アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモヤユヨラリルレロワヲン"
+WORDS = ["草", "www", "それな", "了解", "おつ", "ok", "lol", "gg", "VC", "今日", "明日", "ランク", "神", "ｗ"]
+
+
+def random_word(rng: random.Random):
+    kind = rng.random()
+    if kind < 0.4:
+        return "".join(rng.choice(HIRAGANA) for _ in range(rng.randint(1, 6)))
+    if kind < 0.6:
+        return "".join(rng.choice(KATAKANA) for _ in range(rng.randint(2, 6)))
+    if kind < 0.8:
+        return rng.choice(WORDS)
+    return "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 8)))
+
+
+def build_stream(rng: random.Random, count: int, triggers: list[str], hit_rate: float):
+    stream = []
+    for _ in range(count):
+        length = min(200, int(rng.lognormvariate(3.0, 0.8)) + 1)
+        text = ""
+        while len(text) < length:
+            text += random_word(rng)
+        text = text[:length]
+        if rng.random() < hit_rate:
+            position = rng.randint(0, len(text))
+            text = text[:position] + rng.choice(triggers) + text[position:]
+        stream.append(text)
+    return stream
+
+
+def naive_match(rules: list[MemeRule], content: str):
+    for rule in rules:
+        if rule.mode == "exact" and content == rule.trigger:
+            return rule
+    for rule in rules:
+        if rule.mode == "substring" and rule.trigger in content:
+            return rule
+    return None
+
+
+def measure(label: str, func, stream: list[str]):
+    start = time.perf_counter()
+    hits = sum(1 for content in stream if func(content) is not None)
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<8} {len(stream) / elapsed:>12,.0f} msg/s  {elapsed / len(stream) * 1e6:8.2f} us/msg  hits={hits}")
+    return hits
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--hit-rate", type=float, default=0.05)
+    args = parser.parse_args()
+
+    with open(os.path.join(ROOT, "messages", "memes.json"), encoding="utf-8") as f:
+        base_rules = parseMemeRules(json.load(f))
+
+    for extra in (0, 100, 1000, 10000):
+        rng = random.Random(extra)
+        substring_triggers = list({"".join(rng.choice(HIRAGANA + KATAKANA) for _ in range(rng.randint(3, 8))) for _ in range(extra)})
+        rules = base_rules + [MemeRule(trigger, ["!"], "substring") for trigger in substring_triggers]
+        stream = build_stream(rng, args.messages, [rule.trigger for rule in rules], args.hit_rate)
+
+        start = time.perf_counter()
+        matcher = MemeMatcher(rules)
+        compile_ms = (time.perf_counter() - start) * 1000
+        print(f"triggers={len(rules):>6} (compile {compile_ms:.1f} ms)")
+        naive_hits = measure("naive", lambda content: naive_match(rules, content), stream)
+        compiled_hits = measure("compiled", matcher.match, stream)
+        if naive_hits != compiled_hits:
+            print("  mismatch between naive and compiled hit counts")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
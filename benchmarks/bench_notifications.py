@@ -0,0 +1,108 @@
+"""Voice notifications under Discord's per-channel rate limit: direct send vs. NotificationDispatcher.
+
+    py benchmarks/bench_notifications.py --squads 5 --squad-size 20
+
+A stub channel allows --rate messages per --per seconds and makes any
+further send wait for the bucket to refill, the way discord.py sleeps
+through a 429. Squads of --squad-size people join, one squad every
+--gap seconds, and every join is handled the way on_voice_state_update
+would:
+
+  direct      await channel.send() inside the handler (the old behaviour)
+  dispatcher  NotificationDispatcher.notify() and return
+
+Reported: handler latency, how many messages went out, and how long
+until the last join was delivered.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from notifications import TEMPLATES, NotificationDispatcher
+
+
+class RateLimitedChannel:
+    def __init__(self, rate: int, per: float):
+        self.id = 1
+        self.rate = rate
+        self.per = per
+        self.sent: list[str] = []
+        self.waited = 0.0
+        self._stamps: list[float] = []
+        self._lock = asyncio.Lock()
+
+    async def send(self, content=None, **kwargs):
+        async with self._lock:
+            now = time.monotonic()
+            self._stamps = [stamp for stamp in self._stamps if now - stamp < self.per]
+            if len(self._stamps) >= self.rate:
+                delay = self.per - (now - self._stamps[0])
+                self.waited += delay
+                await asyncio.sleep(delay)
+                self._stamps.pop(0)
+            self._stamps.append(time.monotonic())
+            self.sent.append(content)
+
+
+def percentile(samples: list[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else float("nan")
+
+
+async def scenario(args, strategy: str):
+    channel = RateLimitedChannel(args.rate, args.per)
+    dispatcher = NotificationDispatcher(window=args.window)
+    latency = []
+    started = time.monotonic()
+
+    async def handle(name: str):
+        handled = time.perf_counter()
+        if strategy == "direct":
+            await channel.send(TEMPLATES["join"].format("General", names=name))
+        else:
+            dispatcher.notify(channel, "join", ("General",), name)
+        latency.append(time.perf_counter() - handled)
+
+    for squad in range(args.squads):
+        await asyncio.gather(*(handle(f"user{squad}-{index}") for index in range(args.squad_size)))
+        await asyncio.sleep(args.gap)
+    if strategy == "dispatcher":
+        # 終了時の close と違い、ここでは window を待って普段どおりに送り切らせる
+        while len(dispatcher) or dispatcher.busy_channels:
+            await asyncio.sleep(0.05)
+    delivered = time.monotonic() - started
+    return {
+        "handler_p50_ms": percentile(latency, 0.5) * 1000,
+        "handler_p99_ms": percentile(latency, 0.99) * 1000,
+        "messages": len(channel.sent),
+        "rate_limited_s": channel.waited,
+        "delivered_s": delivered,
+        "longest": max(len(message) for message in channel.sent)
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--squads", type=int, default=5)
+    parser.add_argument("--squad-size", type=int, default=20)
+    parser.add_argument("--gap", type=float, default=0.5, help="seconds between squads")
+    parser.add_argument("--rate", type=int, default=5, help="messages allowed per --per seconds")
+    parser.add_argument("--per", type=float, default=5.0)
+    parser.add_argument("--window", type=float, default=1.5)
+    args = parser.parse_args()
+
+    print(f"{args.squads} squads x {args.squad_size} joins, limit {args.rate} messages / {args.per:g}s")
+    print(f"{'strategy':<11} {'handler p50':>12} {'handler p99':>12} {'messages':>9} {'429 wait':>9} {'delivered':>10} {'longest':>8}")
+    for strategy in ("direct", "dispatcher"):
+        result = await scenario(args, strategy)
+        print(f"{strategy:<11} {result['handler_p50_ms']:>10.2f}ms {result['handler_p99_ms']:>10.2f}ms {result['messages']:>9} "
+              f"{result['rate_limited_s']:>8.1f}s {result['delivered_s']:>9.1f}s {result['longest']:>8}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
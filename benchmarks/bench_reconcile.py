@@ -0,0 +1,147 @@
+"""Startup reconciliation of vc_sessions: in-memory reconcile + one checkpoint vs. one commit per member.
+
+    py benchmarks/bench_reconcile.py --guilds 2000 --members 10
+
+Seeds a fresh SQLite file with persisted sessions for --guilds guilds of
+--members people in voice, then builds a "current" voice state where
+--churn of them have left, changed mute or moved, and the same number
+have newly joined. Each strategy starts from a copy of the seeded file:
+
+  per-member  a one-row checkpointVcSessions (one commit) per member that
+              left, changed or joined, the way per-event writes behave
+  bulk        VoiceSessionTracker.load / reconcile / flush, the way on_ready
+              does it: the diff is made in memory and written by one
+              set-based checkpoint transaction
+
+Both end with the same vc_sessions rows, which the script checks.
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def build_states(args):
+    rng = random.Random(args.seed)
+    persisted = []
+    for guild_id in range(1, args.guilds + 1):
+        for index in range(args.members):
+            persisted.append((guild_id, guild_id * 10000 + index, guild_id * 100 + index % 3, rng.random() < 0.5))
+    current = []
+    for guild_id, user_id, channel_id, mic_on in persisted:
+        roll = rng.random()
+        if roll < args.churn / 3:
+            continue
+        if roll < args.churn * 2 / 3:
+            mic_on = not mic_on
+        elif roll < args.churn:
+            channel_id += 1
+        current.append((guild_id, user_id, channel_id, mic_on))
+    for guild_id in range(1, args.guilds + 1):
+        for index in range(int(args.members * args.churn)):
+            current.append((guild_id, guild_id * 10000 + 5000 + index, guild_id * 100, rng.random() < 0.5))
+    return persisted, current
+
+
+def per_member(session, crud, persisted, current, event_time, startup_time):
+    wanted = {(guild_id, user_id, channel_id): mic_on for guild_id, user_id, channel_id, mic_on in current}
+    kept = set()
+    for guild_id, user_id, channel_id, mic_on in persisted:
+        key = (guild_id, user_id, channel_id)
+        if wanted.get(key) == mic_on:
+            kept.add(key)
+        else:
+            crud.checkpointVcSessions(session, [(*key, startup_time, event_time, mic_on)], [], [key])
+    for (guild_id, user_id, channel_id), mic_on in wanted.items():
+        if (guild_id, user_id, channel_id) not in kept:
+            crud.checkpointVcSessions(session, [], [(guild_id, user_id, channel_id, event_time, mic_on)], [])
+
+
+async def tracked(startup_time: int, current):
+    from database.writebehind import VoiceSessionTracker
+
+    tracker = VoiceSessionTracker(startup_time)
+    await tracker.load()
+    tracker.reconcile(current)
+    await tracker.flush()
+
+
+def worker(args):
+    sys.path.insert(0, ROOT)
+    from sqlalchemy import select
+    from database import engine, init_db
+    from database.models import GuildUser, VCSession
+    import database.crud as crud
+
+    init_db()
+    persisted, current = build_states(args)
+    event_time = int(time.time())
+    if args.strategy == "seed":
+        with crud.get_session() as session:
+            crud.checkpointVcSessions(session, [], [(*state[:3], event_time - 3600, state[3]) for state in persisted], [])
+        # 接続を閉じて WAL をDB本体に書き戻しておかないと、ファイルをコピーしたときに中身が欠ける
+        engine.dispose()
+        return
+
+    started = time.perf_counter()
+    if args.strategy == "bulk":
+        asyncio.run(tracked(event_time - 3600, current))
+    else:
+        with crud.get_session() as session:
+            per_member(session, crud, persisted, current, event_time, event_time - 3600)
+    elapsed = time.perf_counter() - started
+    with crud.get_session() as session:
+        # guild_users.id は作った順で変わるので、(guild_id, user_id) で比べる
+        rows = session.execute(select(GuildUser.guild_id, GuildUser.user_id, VCSession.channel_id, VCSession.mic_on)
+                               .join(GuildUser, GuildUser.id == VCSession.id)).all()
+    print(f"{args.strategy} {elapsed:.3f} {len(rows)} {hash(frozenset(map(tuple, rows)))}")
+
+
+def run(args, strategy: str, path: str) -> list[str]:
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{path}", LEADERBOARD_CACHE_SIZE="0", FILE_LOG_LEVEL="WARNING")
+    forwarded = [f"--{name}={getattr(args, name)}" for name in ("guilds", "members", "churn", "seed")]
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", f"--strategy={strategy}", *forwarded],
+                            env=env, capture_output=True, text=True, check=True).stdout
+    return output.strip().splitlines()[-1].split() if output.strip() else []
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--guilds", type=int, default=2000)
+    parser.add_argument("--members", type=int, default=10)
+    parser.add_argument("--churn", type=float, default=0.3, help="fraction of persisted sessions that are stale at startup")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--dir", help="directory for the database files (default: the system temp dir)")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--strategy", default="bulk", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args)
+        return
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as workdir:
+        seeded = os.path.join(workdir, "seed.db")
+        run(args, "seed", seeded)
+        results = {}
+        for strategy in ("per-member", "bulk"):
+            path = os.path.join(workdir, f"{strategy}.db")
+            shutil.copy(seeded, path)
+            results[strategy] = run(args, strategy, path)
+    print(f"{args.guilds} guilds x {args.members} members in voice, churn={args.churn}")
+    for strategy, (_, seconds, rows, _) in results.items():
+        print(f"{strategy:<11} {float(seconds):8.3f}s  sessions after={rows}")
+    if results["per-member"][2:] != results["bulk"][2:]:
+        raise SystemExit("per-member and bulk ended with different vc_sessions")
+    print(f"speedup     {float(results['per-member'][1]) / float(results['bulk'][1]):8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
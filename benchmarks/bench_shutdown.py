@@ -0,0 +1,130 @@
+"""Time crud.endAllVcSessions against a large synthetic vc_sessions table.
+
+    py benchmarks/bench_shutdown.py --sessions 100000 --budget 5
+    py benchmarks/bench_shutdown.py --sessions 20000 --compare
+
+Seeds a fresh SQLite file with --sessions open sessions spread over
+--guilds guilds, most of which already have a vc_summary row for the
+current month (so the upsert hits the conflict path), then closes them
+all the way shutdown() does. Exits non-zero when the bulk close takes
+longer than --budget seconds, so it can gate a release.
+
+--compare also runs the old per-session loop (a GuildUser lookup and a
+one-row checkpointVcSessions commit for every row) on a copy of the same file
+and checks that both leave identical daily, monthly, yearly and all-time
+totals. Pass --event-time just after a UTC midnight to also exercise the
+sessions that have to be split across days.
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def voice_states(args):
+    per_guild = max(1, args.sessions // args.guilds)
+    states = []
+    for index in range(args.sessions):
+        guild_id = index // per_guild + 1
+        states.append((guild_id, 1_000_000 + index, guild_id * 100 + index % 3, index % 2 == 0))
+    return states
+
+
+def legacy_end_all(session, crud, event_time: int):
+    from database.models import GuildUser, VCSession
+
+    for s in session.query(VCSession.id, VCSession.channel_id, VCSession.event_time, VCSession.mic_on).all():
+        guild_user = session.query(GuildUser).filter_by(id=s.id).one()
+        key = (guild_user.guild_id, guild_user.user_id, s.channel_id)
+        crud.checkpointVcSessions(session, [(*key, s.event_time, event_time, bool(s.mic_on))], [], [key])
+
+
+def worker(args):
+    sys.path.insert(0, ROOT)
+    from sqlalchemy import func, select
+    from database import engine, init_db
+    from database.models import VCSession, VCSummary, VCDailySummary, VCYearlySummary, VCTotalSummary
+    import database.crud as crud
+
+    init_db()
+    event_time = args.event_time
+    if args.strategy == "seed":
+        states = voice_states(args)
+        with crud.get_session() as session:
+            # 大半の人には今月分の集計行を先に作っておき、終了時の upsert が更新側に入るようにする
+            crud.checkpointVcSessions(session, [], [(*state[:3], event_time - 7200, state[3]) for state in states[:len(states) * 9 // 10]], [])
+            crud.endAllVcSessions(session, event_time=event_time - 3600)
+            crud.checkpointVcSessions(session, [], [(*state[:3], event_time - 3600, state[3]) for state in states], [])
+        engine.dispose()
+        return
+
+    with crud.get_session() as session:
+        sessions = session.scalar(select(func.count()).select_from(VCSession))
+    started = time.perf_counter()
+    with crud.get_session() as session:
+        if args.strategy == "bulk":
+            crud.endAllVcSessions(session, event_time=event_time)
+        else:
+            legacy_end_all(session, crud, event_time)
+    elapsed = time.perf_counter() - started
+    with crud.get_session() as session:
+        remaining = session.scalar(select(func.count()).select_from(VCSession))
+        totals = [session.execute(select(func.count(), func.sum(model.total_connection_time), func.sum(model.total_mic_on_time))).one()
+                  for model in (VCSummary, VCDailySummary, VCYearlySummary, VCTotalSummary)]
+    print(f"{args.strategy} {elapsed:.3f} {sessions} {remaining} " + " ".join(f"{count}/{connection}/{mic_on}" for count, connection, mic_on in totals))
+
+
+def run(args, strategy: str, path: str) -> list[str]:
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{path}", LEADERBOARD_CACHE_SIZE="0")
+    forwarded = [f"--{name.replace('_', '-')}={getattr(args, name)}" for name in ("sessions", "guilds", "event_time")]
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", f"--strategy={strategy}", *forwarded],
+                            env=env, capture_output=True, text=True, check=True).stdout
+    return output.strip().splitlines()[-1].split() if output.strip() else []
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=100000)
+    parser.add_argument("--guilds", type=int, default=2000)
+    parser.add_argument("--budget", type=float, default=5.0, help="fail when the bulk close takes longer than this many seconds")
+    parser.add_argument("--compare", action="store_true", help="also time the old per-session loop")
+    parser.add_argument("--dir", help="directory for the database files (default: the system temp dir)")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--strategy", default="bulk", help=argparse.SUPPRESS)
+    parser.add_argument("--event-time", type=int, default=int(time.time()), help="when the sessions are closed (default: now)")
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args)
+        return
+
+    strategies = ("bulk", "per-session") if args.compare else ("bulk",)
+    results = {}
+    with tempfile.TemporaryDirectory(dir=args.dir) as workdir:
+        seeded = os.path.join(workdir, "seed.db")
+        run(args, "seed", seeded)
+        for strategy in strategies:
+            path = os.path.join(workdir, f"{strategy}.db")
+            shutil.copy(seeded, path)
+            results[strategy] = run(args, strategy, path)
+
+    for strategy, (_, seconds, sessions, remaining, monthly, daily, yearly, total) in results.items():
+        print(f"{strategy:<12} {float(seconds):8.3f}s  sessions={sessions} remaining={remaining} "
+              f"rows/connection/mic_on: monthly={monthly} daily={daily} yearly={yearly} all-time={total}")
+    if args.compare:
+        if results["bulk"][2:] != results["per-session"][2:]:
+            raise SystemExit("bulk and per-session closes left different summary totals")
+        print(f"speedup      {float(results['per-session'][1]) / float(results['bulk'][1]):8.1f}x")
+    seconds = float(results["bulk"][1])
+    if seconds > args.budget:
+        raise SystemExit(f"bulk close took {seconds:.3f}s, over the {args.budget:.1f}s budget")
+    print(f"bulk close within the {args.budget:.1f}s budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""Write throughput and read-during-write latency for each DATABASE_PROFILE.
+
+    py benchmarks/bench_storage_profiles.py --commits 300 --batch 20
+
+Each profile runs in its own subprocess (the engine is created when the
+database package is imported) against a fresh SQLite file in a temporary
+directory. Phases:
+
+1. write    --commits checkpoints of --batch voice changes (half opened
+            sessions, half closed intervals) with crud.checkpointVcSessions
+   commit   --commits single-interval crud.checkpointVcSessions transactions, which
+            isolates the per-commit journal/fsync cost
+2. idle     --reads ranking queries with no writer running
+3. contend  the same queries on a second connection while a writer
+            thread keeps committing batches
+
+Leaderboards are disabled (LEADERBOARD_CACHE_SIZE=0) so every ranking
+read actually hits SQLite.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROFILES = ("legacy", "balanced", "fast")
+
+
+def percentile(samples: list[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else float("nan")
+
+
+def make_batch(rng: random.Random, args, event_time: int):
+    # チェックポイント1回分: 半分は開いたセッション、半分は閉じた区間 (とそのセッションの削除)
+    intervals, opened, ended = [], [], []
+    for _ in range(args.batch):
+        guild_id = rng.randrange(1, args.guilds + 1)
+        user_id = rng.randrange(1, args.members + 1) + guild_id * 10000
+        channel_id = guild_id * 100 + rng.randrange(args.channels)
+        mic_on = rng.random() < 0.5
+        if rng.random() < 0.5:
+            opened.append((guild_id, user_id, channel_id, event_time, mic_on))
+        else:
+            intervals.append((guild_id, user_id, channel_id, event_time, event_time + rng.randrange(60, 3600), mic_on))
+            ended.append((guild_id, user_id, channel_id))
+    return intervals, opened, ended
+
+
+def worker(args):
+    sys.path.insert(0, ROOT)
+    from sqlalchemy.exc import OperationalError
+    from database import init_db, storage_config
+    import database.crud as crud
+
+    init_db()
+    rng = random.Random(args.seed)
+    event_time = int(time.time())
+
+    started = time.perf_counter()
+    for _ in range(args.commits):
+        with crud.get_session() as session:
+            crud.checkpointVcSessions(session, *make_batch(rng, args, event_time))
+    write_seconds = time.perf_counter() - started
+
+    commits = []
+    for _ in range(args.commits):
+        started = time.perf_counter()
+        with crud.get_session() as session:
+            crud.checkpointVcSessions(session, [(1, 10001, 100, 946684800, 946684860, False)], [], [])
+        commits.append(time.perf_counter() - started)
+
+    def read_once():
+        guild_id = rng.randrange(1, args.guilds + 1)
+        user_id = rng.randrange(1, args.members + 1) + guild_id * 10000
+        started = time.perf_counter()
+        with crud.get_session() as session:
+            crud.readVcRankPage(session, guild_id, user_id)
+        return time.perf_counter() - started
+
+    idle = [read_once() for _ in range(args.reads)]
+
+    stop = threading.Event()
+    written = [0]
+
+    def writer():
+        writer_rng = random.Random(args.seed + 1)
+        while not stop.is_set():
+            with crud.get_session() as session:
+                crud.checkpointVcSessions(session, *make_batch(writer_rng, args, event_time))
+            written[0] += 1
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    contended = []
+    errors = 0
+    try:
+        for _ in range(args.reads):
+            try:
+                contended.append(read_once())
+            except OperationalError:
+                errors += 1
+    finally:
+        stop.set()
+        thread.join()
+
+    print(json.dumps({
+        "profile": storage_config.profile,
+        "pragmas": dict(storage_config.pragmas()),
+        "write_events_per_sec": args.commits * args.batch / write_seconds,
+        "write_commits_per_sec": args.commits / write_seconds,
+        "commit_p50_ms": percentile(commits, 0.5) * 1000,
+        "commit_p99_ms": percentile(commits, 0.99) * 1000,
+        "idle_p50_ms": percentile(idle, 0.5) * 1000,
+        "idle_p99_ms": percentile(idle, 0.99) * 1000,
+        "contended_p50_ms": percentile(contended, 0.5) * 1000,
+        "contended_p99_ms": percentile(contended, 0.99) * 1000,
+        "contended_errors": errors,
+        "background_commits": written[0]
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--profiles", nargs="+", default=list(PROFILES))
+    parser.add_argument("--commits", type=int, default=300)
+    parser.add_argument("--batch", type=int, default=20)
+    parser.add_argument("--reads", type=int, default=300)
+    parser.add_argument("--guilds", type=int, default=20)
+    parser.add_argument("--members", type=int, default=200)
+    parser.add_argument("--channels", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--dir", help="directory for the database files (default: the system temp dir). Use a real disk to see fsync costs")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args)
+        return
+
+    forwarded = [f"--{name}={getattr(args, name)}" for name in ("commits", "batch", "reads", "guilds", "members", "channels", "seed")]
+    print(f"{'profile':<10} {'events/s':>10} {'batches/s':>10} {'commit p50':>11} {'commit p99':>11} {'idle p50':>9} {'idle p99':>9} {'busy p50':>9} {'busy p99':>9} {'errors':>7}")
+    for profile in args.profiles:
+        with tempfile.TemporaryDirectory(dir=args.dir) as workdir:
+            env = dict(os.environ, DATABASE_PROFILE=profile, LEADERBOARD_CACHE_SIZE="0",
+                       DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'bench.db')}")
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", *forwarded],
+                                    env=env, capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{profile:<10} {result['write_events_per_sec']:>10.0f} {result['write_commits_per_sec']:>10.1f} "
+              f"{result['commit_p50_ms']:>9.2f}ms {result['commit_p99_ms']:>9.2f}ms "
+              f"{result['idle_p50_ms']:>7.2f}ms {result['idle_p99_ms']:>7.2f}ms "
+              f"{result['contended_p50_ms']:>7.2f}ms {result['contended_p99_ms']:>7.2f}ms {result['contended_errors']:>7}")
+
+
+if __name__ == "__main__":
+    main()
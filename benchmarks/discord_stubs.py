@@ -0,0 +1,122 @@
+"""Minimal stand-ins for the discord.py objects the handlers in main.py touch.
+
+Only the attributes and coroutines the handlers actually use are
+implemented; everything is in memory and nothing talks to Discord.
+"""
+import itertools
+from types import SimpleNamespace
+
+import discord
+
+_message_ids = itertools.count(1)
+
+
+class StubMessage:
+    def __init__(self, content=None):
+        self.id = next(_message_ids)
+        self.content = content
+
+    async def edit(self, **kwargs):
+        self.content = kwargs.get("content", self.content)
+
+
+class StubChannel:
+    def __init__(self, channel_id: int, name: str, guild=None):
+        self.id = channel_id
+        self.name = name
+        self.guild = guild
+        self.sent = 0
+
+    def permissions_for(self, member):
+        return SimpleNamespace(send_messages=True)
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+        return StubMessage(content)
+
+    def __str__(self):
+        return self.name
+
+
+class StubMember:
+    def __init__(self, user_id: int, guild, display_name: str = None):
+        self.id = user_id
+        self.guild = guild
+        self.name = display_name or f"user{user_id}"
+        self.display_name = self.name
+        self.mention = f"<@{user_id}>"
+
+    def __str__(self):
+        return self.name
+
+
+class StubGuild:
+    def __init__(self, guild_id: int, name: str = None):
+        self.id = guild_id
+        self.name = name or f"guild{guild_id}"
+        self.system_channel = StubChannel(guild_id * 1000, "general", self)
+        self.me = StubMember(0, self, "vampire")
+        self.members: dict[int, StubMember] = {}
+        self.fetches = 0
+
+    def add_member(self, user_id: int) -> StubMember:
+        member = self.members[user_id] = StubMember(user_id, self)
+        return member
+
+    def get_member(self, user_id: int):
+        # 起動直後のようにメンバーキャッシュが空の状態を真似して、表示名はすべて fetch_member で引かせる
+        return None
+
+    async def fetch_member(self, user_id: int):
+        self.fetches += 1
+        member = self.members.get(user_id)
+        if member is None:
+            raise discord.NotFound(SimpleNamespace(status=404, reason="Not Found"), "Unknown Member")
+        return member
+
+
+class StubVoiceState:
+    def __init__(self, channel: StubChannel = None, self_mute: bool = False):
+        self.channel = channel
+        self.self_mute = self_mute
+
+
+class StubResponse:
+    def __init__(self):
+        self._done = False
+        self.messages = []
+
+    def is_done(self):
+        return self._done
+
+    async def send_message(self, content=None, **kwargs):
+        self._done = True
+        self.messages.append(content)
+
+    async def defer(self, **kwargs):
+        self._done = True
+
+    async def edit_message(self, **kwargs):
+        self._done = True
+        self.messages.append(kwargs.get("content"))
+
+
+class StubFollowup:
+    def __init__(self):
+        self.messages = []
+
+    async def send(self, content=None, wait: bool = False, **kwargs):
+        self.messages.append(content)
+        return StubMessage(content)
+
+
+class StubInteraction:
+    def __init__(self, user: StubMember, guild: StubGuild, channel: StubChannel = None):
+        self.user = user
+        self.guild = guild
+        self.guild_id = guild.id if guild is not None else None
+        self.channel = channel or (guild.system_channel if guild is not None else None)
+        self.response = StubResponse()
+        self.followup = StubFollowup()
+        self.extras = {}
+        self.command = None
@@ -0,0 +1,340 @@
+"""Offline load test for database.crud and the main.py handlers.
+
+    py benchmarks/loadtest.py --guilds 2000 --members 50 --channels 2 --months 5
+    py benchmarks/loadtest.py --compare <commit or results file>
+
+Everything runs against a throwaway SQLite file in a temporary directory
+with stubbed discord.py objects (benchmarks/discord_stubs.py); no token
+or network connection is needed. The phases are:
+
+1. seed    bulk-insert guilds x members x channels x months vc_summary rows
+2. voice   replay bursts of join / mute toggle / leave through
+           main.on_voice_state_update and write the final session checkpoint
+3. reads   p50/p99 of db.readVcRankEntries, db.readUserVcRankEntry and
+           db.readVcSummary, plus the /vc-rank and /vc-time handlers
+
+Results are written to benchmarks/results/<commit>.json so runs on
+different commits can be compared with --compare.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    import resource
+except ImportError:
+    # Windows にはないので、ピークメモリは出さない
+    resource = None
+
+
+def percentile(samples: list[float], q: float) -> float:
+    if not samples:
+        return float("nan")
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def latency_summary(samples: list[float]) -> dict:
+    return {
+        "count": len(samples),
+        "p50_ms": percentile(samples, 0.50) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "max_ms": max(samples) * 1000 if samples else float("nan")
+    }
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # Linux は KB、macOS は バイト
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{commit}-dirty" if dirty else commit
+
+
+def prepare_environment(workdir: str, args):
+    # main.py は import 時に環境変数を読み、カレントディレクトリの log/ に書き込むので先に整えておく
+    os.makedirs(os.path.join(workdir, "log"), exist_ok=True)
+    os.chdir(workdir)
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'loadtest.db')}"
+    os.environ.setdefault("DISCORD_TOKEN", "offline")
+    os.environ.setdefault("CHANNEL_ID", "0")
+    os.environ.setdefault("CONSOLE_LOG_LEVEL", args.log_level)
+    os.environ.setdefault("FILE_LOG_LEVEL", args.log_level)
+    os.environ["METRICS_FILE"] = ""
+    os.environ["METRICS_PORT"] = "0"
+    if args.leaderboard_cache is not None:
+        os.environ["LEADERBOARD_CACHE_SIZE"] = str(args.leaderboard_cache)
+
+
+def guild_user_id(args, guild_index: int, member_index: int) -> int:
+    return guild_index * args.members + member_index + 1
+
+
+def user_id(args, guild_index: int, member_index: int) -> int:
+    # 同じユーザーが複数のサーバーに入っている状態を作る
+    pool = max(args.members, args.guilds * args.members // 2)
+    return 10 ** 6 + (guild_index * args.members + member_index) % pool
+
+
+def guild_id(guild_index: int) -> int:
+    return 10 ** 5 + guild_index
+
+
+def channel_id(guild_index: int, channel_index: int) -> int:
+    return guild_id(guild_index) * 100 + channel_index + 1
+
+
+def recent_months(count: int):
+    now = datetime.now(timezone.utc)
+    year, month = now.year, now.month
+    months = []
+    for _ in range(count):
+        months.append((year, month))
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    return months
+
+
+def seed(args, rng: random.Random) -> dict:
+    from database import engine
+
+    months = recent_months(args.months)
+    started = time.perf_counter()
+    with engine.begin() as conn:
+        conn.exec_driver_sql("INSERT INTO guilds (guild_id, notification_channel) VALUES (?, NULL)",
+                             [(guild_id(g),) for g in range(args.guilds)])
+        users = {user_id(args, g, m) for g in range(args.guilds) for m in range(args.members)}
+        conn.exec_driver_sql("INSERT INTO users (user_id, speaker_id, command_count, likeability) VALUES (?, 1, 0, 0)",
+                             [(u,) for u in users])
+        conn.exec_driver_sql("INSERT INTO guild_users (id, guild_id, user_id) VALUES (?, ?, ?)",
+                             [(guild_user_id(args, g, m), guild_id(g), user_id(args, g, m))
+                              for g in range(args.guilds) for m in range(args.members)])
+        rows = 0
+        batch = []
+        for g in range(args.guilds):
+            for m in range(args.members):
+                for c in range(args.channels):
+                    for year, month in months:
+                        connection_time = rng.randint(60, 200 * 3600)
+                        batch.append((guild_user_id(args, g, m), channel_id(g, c), year, month,
+                                      connection_time, rng.randint(0, connection_time)))
+                if len(batch) >= 100_000:
+                    conn.exec_driver_sql("INSERT INTO vc_summary VALUES (?, ?, ?, ?, ?, ?)", batch)
+                    rows += len(batch)
+                    batch.clear()
+        if batch:
+            conn.exec_driver_sql("INSERT INTO vc_summary VALUES (?, ?, ?, ?, ?, ?)", batch)
+            rows += len(batch)
+        # 年別と全期間の集計も、マイグレーションと同じように月別から作っておく
+        conn.exec_driver_sql("INSERT INTO vc_yearly_summary SELECT id, channel_id, year, SUM(total_connection_time), SUM(total_mic_on_time) "
+                             "FROM vc_summary GROUP BY id, channel_id, year")
+        conn.exec_driver_sql("INSERT INTO vc_total_summary SELECT id, channel_id, SUM(total_connection_time), SUM(total_mic_on_time) "
+                             "FROM vc_summary GROUP BY id, channel_id")
+        conn.exec_driver_sql("ANALYZE")
+    elapsed = time.perf_counter() - started
+    return {"vc_summary_rows": rows, "seconds": elapsed, "rows_per_sec": rows / elapsed}
+
+
+def build_guilds(args):
+    from discord_stubs import StubChannel, StubGuild
+
+    guilds = []
+    for g in range(args.guilds):
+        guild = StubGuild(guild_id(g))
+        guild.voice_channels = [StubChannel(channel_id(g, c), f"vc{c}", guild) for c in range(args.channels)]
+        for m in range(args.members):
+            guild.add_member(user_id(args, g, m))
+        guilds.append(guild)
+    return guilds
+
+
+async def replay_voice(args, main, guilds, rng: random.Random) -> dict:
+    from discord_stubs import StubVoiceState
+
+    main.voice_sessions.start()
+    handler_latency = []
+    events = 0
+
+    async def handle(member, before, after):
+        started = time.perf_counter()
+        await main.on_voice_state_update(member, before, after)
+        handler_latency.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for _ in range(args.bursts):
+        guild = rng.choice(guilds)
+        members = rng.sample(list(guild.members.values()), min(args.burst_size, len(guild.members)))
+        channel = rng.choice(guild.voice_channels)
+        muted = {member.id: rng.random() < 0.5 for member in members}
+        # 全員がほぼ同時に参加して、何度かミュートを切り替えて、退出する
+        await asyncio.gather(*(handle(member, StubVoiceState(), StubVoiceState(channel, muted[member.id])) for member in members))
+        for _ in range(args.toggles):
+            togglers = [member for member in members if rng.random() < 0.5]
+            await asyncio.gather(*(handle(member, StubVoiceState(channel, muted[member.id]), StubVoiceState(channel, not muted[member.id])) for member in togglers))
+            for member in togglers:
+                muted[member.id] = not muted[member.id]
+            events += len(togglers)
+        await asyncio.gather(*(handle(member, StubVoiceState(channel, muted[member.id]), StubVoiceState()) for member in members))
+        events += 2 * len(members)
+    handled = time.perf_counter() - started
+    await main.voice_sessions.close()
+    await main.notifier.close()
+    drained = time.perf_counter() - started
+    return {
+        "events": events,
+        "handler_events_per_sec": events / handled,
+        "end_to_end_events_per_sec": events / drained,
+        "db_checkpoints": main.voice_sessions.checkpoints,
+        "db_checkpoints_failed": main.voice_sessions.failed_checkpoints,
+        "notification_messages": main.notifier.sent_messages,
+        "notification_events": main.notifier.sent_events,
+        "handler": latency_summary(handler_latency)
+    }
+
+
+async def measure_reads(args, main, guilds, rng: random.Random) -> dict:
+    import database.aio as db
+    from discord_stubs import StubInteraction
+
+    year, month = recent_months(1)[0]
+    samples = {"readVcRankEntries": [], "readUserVcRankEntry": [], "readVcSummary": [], "vc_rank": [], "vc_log": []}
+
+    async def timed(name, coroutine):
+        started = time.perf_counter()
+        await coroutine
+        samples[name].append(time.perf_counter() - started)
+
+    for _ in range(args.queries):
+        guild = rng.choice(guilds)
+        member = rng.choice(list(guild.members.values()))
+        channel = rng.choice(guild.voice_channels + [None])
+        channel_arg = channel.id if channel is not None else None
+        month_arg = rng.choice([month, None])
+        await timed("readVcRankEntries", db.readVcRankEntries(guild.id, channel_arg, year, month_arg))
+        await timed("readUserVcRankEntry", db.readUserVcRankEntry(guild.id, member.id, channel_arg, year, month_arg))
+        await timed("readVcSummary", db.readVcSummary(guild.id, member.id, (channel or guild.voice_channels[0]).id, year, month_arg))
+        await timed("vc_rank", main.vc_rank(StubInteraction(member, guild), channel, year, month_arg))
+        await timed("vc_log", main.vc_log(StubInteraction(member, guild), channel or guild.voice_channels[0], year, month_arg))
+    return {name: latency_summary(values) for name, values in samples.items()}
+
+
+def flatten(result: dict, prefix: str = "") -> dict:
+    flat = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def load_baseline(reference: str):
+    path = reference if os.path.exists(reference) else os.path.join(RESULTS_DIR, f"{reference}.json")
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def compare(current: dict, baseline: dict, threshold: float):
+    # 値が大きいほど良いもの (〜per_sec) と、小さいほど良いもの (それ以外) で悪化の向きを変える
+    if baseline.get("params") != current.get("params"):
+        print("warning: the baseline was run with different parameters")
+    now, before = flatten(current["results"]), flatten(baseline["results"])
+    regressions = 0
+    print(f"\n{'metric':<45} {baseline['revision']:>14} {current['revision']:>14} {'change':>8}")
+    for key in sorted(now.keys() & before.keys()):
+        if not before[key]:
+            continue
+        change = (now[key] - before[key]) / before[key]
+        worse = -change if key.endswith("per_sec") else change
+        mark = " !" if worse > threshold and not key.endswith(("count", "events", "checkpoints", "failed", "messages", "rows")) else ""
+        regressions += bool(mark)
+        print(f"{key:<45} {before[key]:>14.3f} {now[key]:>14.3f} {change:>+8.1%}{mark}")
+    return regressions
+
+
+async def run(args) -> dict:
+    import main
+
+    rng = random.Random(args.seed)
+    results = {"seed": seed(args, rng)}
+    guilds = build_guilds(args)
+    results["voice"] = await replay_voice(args, main, guilds, rng)
+    results["reads"] = await measure_reads(args, main, guilds, rng)
+    results["peak_rss_mb"] = peak_rss_mb()
+    main.db.shutdown()
+    main.dice_engine.shutdown()
+    main.log_pipeline.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--guilds", type=int, default=2000)
+    parser.add_argument("--members", type=int, default=50)
+    parser.add_argument("--channels", type=int, default=2)
+    parser.add_argument("--months", type=int, default=5)
+    parser.add_argument("--bursts", type=int, default=200)
+    parser.add_argument("--burst-size", type=int, default=20)
+    parser.add_argument("--toggles", type=int, default=3)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--leaderboard-cache", type=int, default=None, help="LEADERBOARD_CACHE_SIZE to run with (default: the bot's default)")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--compare", help="commit id or results file to compare with")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative change reported as a regression")
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args()
+
+    params = {key: value for key, value in vars(args).items() if key not in ("compare", "threshold", "no_save", "log_level")}
+    revision = git_revision()
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        prepare_environment(workdir, args)
+        try:
+            results = asyncio.run(run(args))
+        finally:
+            os.chdir(cwd)
+
+    report = {
+        "revision": revision,
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "params": params,
+        "results": results
+    }
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{revision}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"saved {path}")
+    if args.compare:
+        regressions = compare(report, load_baseline(args.compare), args.threshold)
+        if regressions:
+            print(f"{regressions} metric(s) regressed by more than {args.threshold:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
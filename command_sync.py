@@ -0,0 +1,63 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from discord import app_commands
+
+logger = logging.getLogger('vampire.command_sync')
+
+
+def commandTreeFingerprint(tree: app_commands.CommandTree) -> str:
+    # Discord に送る内容そのものから作るので、名前・説明・オプション・権限のどれが変わっても値が変わる
+    payload = sorted((command.to_dict(tree) for command in tree.get_commands()), key=lambda command: (command.get("type", 1), command["name"]))
+    encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class CommandTreeSyncer:
+    def __init__(self, tree: app_commands.CommandTree, path: str):
+        self.tree = tree
+        self.path = path
+        self._lock = asyncio.Lock()
+        self._fingerprint = None
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable command sync state {self.path}: {e}")
+            return {}
+        return state if isinstance(state, dict) else {}
+
+    def _save(self, state: dict):
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(state, f, indent=2)
+        os.replace(temporary, self.path)
+
+    async def sync(self, force: bool = False) -> bool:
+        async with self._lock:
+            fingerprint = commandTreeFingerprint(self.tree)
+            if not force and fingerprint == self._fingerprint:
+                # 同じプロセスで確認済み (再接続など)
+                return False
+            # botごとに登録されるコマンドは別なので、アプリケーションIDごとに覚えておく
+            application_id = str(self.tree.client.application_id)
+            state = await asyncio.to_thread(self._load)
+            if not force and state.get(application_id) == fingerprint:
+                self._fingerprint = fingerprint
+                logger.info(f"Command tree unchanged ({fingerprint[:12]}), skipping sync")
+                return False
+            synced = await self.tree.sync()
+            state[application_id] = fingerprint
+            try:
+                await asyncio.to_thread(self._save, state)
+            except OSError as e:
+                logger.warning(f"Failed to save command sync state to {self.path}: {e}")
+            self._fingerprint = fingerprint
+            logger.info(f"Synced {len(synced)} commands ({fingerprint[:12]}){' (forced)' if force else ''}")
+            return True
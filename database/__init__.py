@@ -1,11 +1,38 @@
-from sqlalchemy import create_engine
+import logging
+import time
 from sqlalchemy.orm import sessionmaker
-from .models import Base
+from .config import AUTO_VACUUM_MODES, createEngine, loadStorageConfig
+from .migrations import migrate
 
-DATABASE_URL = "sqlite:///vampire.db"
+logger = logging.getLogger('vampire.database')
 
-engine = create_engine(DATABASE_URL, echo=False,hide_parameters=True)
+storage_config = loadStorageConfig()
+DATABASE_URL = storage_config.url
+
+engine = createEngine(storage_config)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+def _applyAutoVacuum():
+    # 既にあるDBは auto_vacuum を変えても VACUUM し直すまで今のモードのまま
+    if storage_config.auto_vacuum is None or storage_config.is_memory:
+        return
+    wanted = AUTO_VACUUM_MODES.index(storage_config.auto_vacuum)
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        current = conn.exec_driver_sql("PRAGMA auto_vacuum").scalar()
+        if current == wanted:
+            return
+        if not storage_config.rebuild_for_auto_vacuum:
+            # DB全体を作り直すので大きなDBでは起動が長く止まる。明示的に許可されたときだけ行う
+            logger.warning(f"auto_vacuum is {AUTO_VACUUM_MODES[current]}, not {storage_config.auto_vacuum}: incremental vacuum stays inactive "
+                           "until the database is rebuilt (set SQLITE_REBUILD_FOR_AUTO_VACUUM=ON to do it once on startup)")
+            return
+        logger.info(f"Rebuilding the database to change auto_vacuum from {AUTO_VACUUM_MODES[current]} to {storage_config.auto_vacuum} (one time only)")
+        started = time.perf_counter()
+        conn.exec_driver_sql("VACUUM")
+        logger.info(f"Rebuilt the database in {time.perf_counter() - started:.1f}s")
+
 def init_db():
-    Base.metadata.create_all(bind=engine)
+    logger.info(f"Database storage: {storage_config}")
+    if storage_config.is_sqlite:
+        _applyAutoVacuum()
+    migrate(engine)
@@ -0,0 +1,70 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from . import crud, engine, storage_config
+from .crud import get_session
+
+logger = logging.getLogger('vampire.database')
+
+# SQLiteへの書き込みはどうせ直列化されるので、DB専用のスレッド1本にまとめて
+# イベントループ上でSQLAlchemyのI/Oが走らないようにする
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vampire-db")
+
+
+def _call(func, args, kwargs):
+    with get_session() as session:
+        return func(session, *args, **kwargs)
+
+
+async def run(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, _call, func, args, kwargs)
+
+
+async def runRead(func, *args, **kwargs):
+    # 長い読み込み用。WAL (とSQLite以外) では読み込みが書き込みを待たせないので、DB スレッドを塞がないように別スレッドで自分の接続から読む
+    # ロールバックジャーナルやインメモリDBでは、書き込みとぶつからないように DB スレッドで行う
+    if not storage_config.is_sqlite or (storage_config.journal_mode == "WAL" and not storage_config.is_memory):
+        return await asyncio.to_thread(_call, func, args, kwargs)
+    return await run(func, *args, **kwargs)
+
+
+def _wrap(func):
+    async def wrapper(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+    wrapper.__name__ = func.__name__
+    wrapper.__qualname__ = func.__qualname__
+    return wrapper
+
+
+async def readServerSetting(guild_id: int):
+    # キャッシュに載っていればDBスレッドに回さずにそのまま返す
+    setting = crud.guild_settings_cache.get(guild_id)
+    if setting is None:
+        setting = await run(crud.loadServerSetting, guild_id)
+    return setting
+
+
+async def exportVcSummary(guild_id: int, writer, period: str = "month", chunk_size: int = 1000):
+    return await runRead(crud.exportVcSummary, guild_id, writer, period, chunk_size)
+
+
+def shutdown(wait: bool = True):
+    logger.info("Shutting down database executor")
+    _executor.shutdown(wait=wait)
+    # 接続を全部閉じると、SQLite が WAL の内容をDB本体に書き戻して -wal ファイルを片付ける
+    engine.dispose()
+
+
+updateServerNotificationChannel = _wrap(crud.updateServerNotificationChannel)
+updateGuildRetention = _wrap(crud.updateGuildRetention)
+addUserCount = _wrap(crud.addUserCount)
+addUserCounts = _wrap(crud.addUserCounts)
+readVcSummary = _wrap(crud.readVcSummary)
+readVcRankEntries = _wrap(crud.readVcRankEntries)
+readUserVcRankEntry = _wrap(crud.readUserVcRankEntry)
+readVcRankPage = _wrap(crud.readVcRankPage)
+readMemeRules = _wrap(crud.readMemeRules)
+addMemeRule = _wrap(crud.addMemeRule)
+deleteMemeRule = _wrap(crud.deleteMemeRule)
+endAllVcSessions = _wrap(crud.endAllVcSessions)
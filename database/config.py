@@ -0,0 +1,173 @@
+import logging
+import os
+from typing import Mapping
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool, StaticPool
+
+logger = logging.getLogger('vampire.database')
+
+# SQLite のプロファイル。環境変数 SQLITE_* で個別に上書きできる
+#   legacy:   今までと同じ (ロールバックジャーナル / synchronous=FULL)
+#   balanced: WAL で読み込みが書き込みを待たない。synchronous=NORMAL は電源断で直前のコミットが消えることはあるが壊れはしない
+#   fast:     synchronous=OFF。OSごと落ちるとDBが壊れることがあるので、消えても困らない環境向け
+# balanced/fast は外部キー (ondelete="CASCADE") を有効にし、消した行の空きページを incremental_vacuum で少しずつ返せるようにする
+# ただし既にあるDBの auto_vacuum は作り直すまで変わらないので、SQLITE_REBUILD_FOR_AUTO_VACUUM=ON で一度起動するまで空きページは返らない
+# 外部キーは既存のDBにもすぐ効くので、サーバーやメンバーの行を消すとそのVCの記録やミームも消える (legacy では消えずに残る)
+PROFILES = {
+    "legacy": {
+        "auto_vacuum": None,
+        "foreign_keys": None,
+        "journal_mode": None,
+        "synchronous": None,
+        "mmap_size": None,
+        "cache_size": None,
+        "busy_timeout": None,
+    },
+    "balanced": {
+        "auto_vacuum": "INCREMENTAL",
+        "foreign_keys": "ON",
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,
+        "busy_timeout": 5000,
+    },
+    "fast": {
+        "auto_vacuum": "INCREMENTAL",
+        "foreign_keys": "ON",
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "mmap_size": 1024 * 1024 * 1024,
+        "cache_size": -256 * 1024,
+        "busy_timeout": 5000,
+    },
+}
+DEFAULT_PROFILE = "balanced"
+
+JOURNAL_MODES = ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF")
+SYNCHRONOUS_MODES = ("OFF", "NORMAL", "FULL", "EXTRA")
+AUTO_VACUUM_MODES = ("NONE", "FULL", "INCREMENTAL")
+SWITCHES = ("ON", "OFF")
+
+
+def _optionalInt(environ: Mapping[str, str], name: str, default):
+    value = environ.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer, got {value!r}")
+
+
+def _optionalChoice(environ: Mapping[str, str], name: str, default, choices):
+    value = environ.get(name)
+    if value is None or value == "":
+        return default
+    value = value.upper()
+    if value not in choices:
+        raise ValueError(f"{name} must be one of {', '.join(choices)}, got {value!r}")
+    return value
+
+
+class StorageConfig:
+    def __init__(self, url: str, profile: str = DEFAULT_PROFILE, journal_mode: str = None, synchronous: str = None, mmap_size: int = None,
+                 cache_size: int = None, busy_timeout: int = None, pool_size: int = 5, max_overflow: int = 10, auto_vacuum: str = None,
+                 foreign_keys: str = None, rebuild_for_auto_vacuum: bool = False):
+        self.url = url
+        self.profile = profile
+        self.auto_vacuum = auto_vacuum
+        self.foreign_keys = foreign_keys
+        # 既にあるDBの auto_vacuum を変えるための VACUUM (DB全体の作り直し) を起動時に行ってよいか
+        self.rebuild_for_auto_vacuum = rebuild_for_auto_vacuum
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.busy_timeout = busy_timeout
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+
+    @property
+    def is_sqlite(self):
+        return make_url(self.url).get_backend_name() == "sqlite"
+
+    @property
+    def is_memory(self):
+        return self.is_sqlite and make_url(self.url).database in (None, "", ":memory:")
+
+    def pragmas(self) -> list[tuple[str, object]]:
+        if not self.is_sqlite:
+            return []
+        pragmas = [
+            # auto_vacuum は最初のテーブルを作る前に設定しないと効かないので先頭に置く
+            ("auto_vacuum", self.auto_vacuum),
+            ("foreign_keys", self.foreign_keys),
+            ("journal_mode", self.journal_mode),
+            ("synchronous", self.synchronous),
+            ("mmap_size", self.mmap_size),
+            ("cache_size", self.cache_size),
+            ("busy_timeout", self.busy_timeout),
+        ]
+        if self.is_memory:
+            # インメモリDBには WAL も mmap もない
+            pragmas = [(name, value) for name, value in pragmas if name not in ("journal_mode", "mmap_size")]
+        return [(name, value) for name, value in pragmas if value is not None]
+
+    def __repr__(self):
+        url = make_url(self.url).render_as_string(hide_password=True)
+        return f"<StorageConfig(url={url}, profile={self.profile}, pragmas={dict(self.pragmas())})>"
+
+
+def loadStorageConfig(environ: Mapping[str, str] = os.environ) -> StorageConfig:
+    profile = environ.get("DATABASE_PROFILE", DEFAULT_PROFILE).lower()
+    if profile not in PROFILES:
+        raise ValueError(f"DATABASE_PROFILE must be one of {', '.join(PROFILES)}, got {profile!r}")
+    defaults = PROFILES[profile]
+    return StorageConfig(
+        url=environ.get("DATABASE_URL", "sqlite:///vampire.db"),
+        profile=profile,
+        journal_mode=_optionalChoice(environ, "SQLITE_JOURNAL_MODE", defaults["journal_mode"], JOURNAL_MODES),
+        synchronous=_optionalChoice(environ, "SQLITE_SYNCHRONOUS", defaults["synchronous"], SYNCHRONOUS_MODES),
+        mmap_size=_optionalInt(environ, "SQLITE_MMAP_SIZE", defaults["mmap_size"]),
+        cache_size=_optionalInt(environ, "SQLITE_CACHE_SIZE", defaults["cache_size"]),
+        busy_timeout=_optionalInt(environ, "SQLITE_BUSY_TIMEOUT", defaults["busy_timeout"]),
+        auto_vacuum=_optionalChoice(environ, "SQLITE_AUTO_VACUUM", defaults["auto_vacuum"], AUTO_VACUUM_MODES),
+        foreign_keys=_optionalChoice(environ, "SQLITE_FOREIGN_KEYS", defaults["foreign_keys"], SWITCHES),
+        rebuild_for_auto_vacuum=_optionalChoice(environ, "SQLITE_REBUILD_FOR_AUTO_VACUUM", "OFF", SWITCHES) == "ON",
+        pool_size=_optionalInt(environ, "DATABASE_POOL_SIZE", 5),
+        max_overflow=_optionalInt(environ, "DATABASE_MAX_OVERFLOW", 10),
+    )
+
+
+def createEngine(config: StorageConfig, **kwargs):
+    options = {"echo": False, "hide_parameters": True}
+    if config.is_memory:
+        # インメモリDBは接続ごとに別のDBになるので、全スレッドで1本の接続を使い回す
+        options.update(poolclass=StaticPool, connect_args={"check_same_thread": False})
+    elif config.is_sqlite:
+        # mmap や cache_size は接続ごとの設定なので、接続を使い回してページキャッシュを温かいまま保つ
+        options.update(poolclass=QueuePool, pool_size=config.pool_size, max_overflow=config.max_overflow)
+    else:
+        options.update(pool_size=config.pool_size, max_overflow=config.max_overflow, pool_pre_ping=True)
+    options.update(kwargs)
+    engine = create_engine(config.url, **options)
+
+    pragmas = config.pragmas()
+    if pragmas:
+        @event.listens_for(engine, "connect")
+        def _applyPragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            try:
+                for name, value in pragmas:
+                    cursor.execute(f"PRAGMA {name}={value}")
+                    if name == "journal_mode":
+                        mode = cursor.fetchone()[0].upper()
+                        if mode != value:
+                            # WAL にできないファイルシステムなどではそのまま動かす
+                            logger.warning(f"SQLite journal_mode is {mode} (requested {value})")
+            finally:
+                cursor.close()
+
+    return engine
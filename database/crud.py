@@ -1,19 +1,34 @@
-from sqlalchemy import func
+from sqlalchemy import Integer, Select, and_, event, func, insert, select, delete, or_, tuple_, bindparam, case, literal, true
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import Session
 from . import SessionLocal
-from .models import Guild, User, GuildUser, VCSummary, VCSession
+from .cache import LRUCache
+from .export import ExportWriter
+from .leaderboard import LeaderboardRegistry
+from .models import Guild, User, GuildUser, VCSummary, VCDailySummary, VCYearlySummary, VCTotalSummary, VCInterval, VCSession, GuildMemeRule
+from .rollup import DAY_SECONDS, VCRollup
+import json
 import logging
+import os
 import time
 from typing import Sequence
 from datetime import datetime, timezone
 from contextlib import contextmanager
 
 logger = logging.getLogger('vampire.database')
+session_logger = logging.getLogger('vampire.database.session')
+voice_logger = logging.getLogger('vampire.voice')
+
+guild_settings_cache = LRUCache(maxsize=int(os.getenv("GUILD_SETTINGS_CACHE_SIZE", "4096")))
+# (guild_id, user_id) -> guild_users.id
+guild_user_id_cache = LRUCache(maxsize=int(os.getenv("GUILD_USER_CACHE_SIZE", "65536")))
+leaderboards = LeaderboardRegistry(maxsize=int(os.getenv("LEADERBOARD_CACHE_SIZE", "1024")))
+RESOLVE_CHUNK_SIZE = 400
 
 @contextmanager
 def get_session():
     session = SessionLocal()
-    logger.debug("Opened new database session")
+    session_logger.debug("Opened new database session")
     try:
         yield session
     except FutureDateError:
@@ -22,11 +37,11 @@ def get_session():
         raise
     except Exception as e:
         session.rollback()
-        logger.error(f"DateBase error: {e}")
+        logger.error("DateBase error: %s", e)
         raise
     finally:
         session.close()
-        logger.debug("Closed database session")
+        session_logger.debug("Closed database session")
 
 
 class FormatTime:
@@ -46,6 +61,21 @@ class FormatTime:
         }
 
 
+class ServerSetting:
+    def __init__(self, guild_id: int, notification_channel: int | None):
+        self.guild_id = guild_id
+        self.notification_channel = notification_channel
+
+    def to_dict(self):
+        return {
+            "guild_id": self.guild_id,
+            "notification_channel": self.notification_channel
+        }
+
+    def __repr__(self):
+        return f"<ServerSetting(guild_id={self.guild_id}, notification_channel={self.notification_channel})>"
+
+
 def formatTime(seconds: int):
     if not isinstance(seconds, int):
         raise TypeError("The argument must be of type int.")
@@ -92,6 +122,38 @@ class VCRankingList:
     def __repr__(self):
         return f"<VCRankingList(entries={self.entries})>"
 
+class VCRankingPage:
+    def __init__(self, entries: Sequence[VCRankingEntry], user_entry: VCRankingEntry | None, page: int, per_page: int, total: int):
+        self.entries = list(entries)
+        self.user_entry = user_entry
+        self.page = page
+        self.per_page = per_page
+        self.total = total
+
+    @property
+    def page_count(self):
+        return max(1, -(-self.total // self.per_page))
+
+    @property
+    def has_previous(self):
+        return self.page > 1
+
+    @property
+    def has_next(self):
+        return self.page < self.page_count
+
+    def to_dict(self):
+        return {
+            "page": self.page,
+            "per_page": self.per_page,
+            "total": self.total,
+            "entries": [entry.to_dict() for entry in self.entries],
+            "user": self.user_entry.to_dict() if self.user_entry is not None else None
+        }
+
+    def __repr__(self):
+        return f"<VCRankingPage(page={self.page}/{self.page_count}, total={self.total}, entries={self.entries}, user_entry={self.user_entry})>"
+
 def convertRankingTuplesToList(ranking_tuples: Sequence[tuple]) -> list[VCRankingEntry]:
     entries = []
     for rank, (user_id, total_connection_time, total_mic_on_time) in enumerate(ranking_tuples, start=1):
@@ -125,30 +187,147 @@ def checkExistsUser(session: Session, user_id: int):
         logger.debug(f"User already exists with user_id={user_id}")
 
 
-def checkExistsGuildUser(session: Session, guild_id: int, user_id: int):
-    checkExistsGuild(session, guild_id)
-    checkExistsUser(session, user_id)
-    guild_user = session.query(GuildUser).filter_by(guild_id=guild_id, user_id=user_id).one_or_none()
-    if guild_user is None:
-        join_date = int(time.time())
-        guild_user = GuildUser(guild_id=guild_id, user_id=user_id, join_date=join_date)
-        session.add(guild_user)
-        session.flush()
-        logger.info(f"Guild user created with guild_user={guild_user}")
+def upsert(session: Session, model):
+    if session.get_bind().dialect.name == "postgresql":
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+
+@event.listens_for(SessionLocal, "after_commit")
+def _publishPending(session: Session):
+    # コミットされる前にキャッシュへ載せると、ロールバックされた内容を掴んでしまう
+    pending = session.info.pop("guild_user_ids", None)
+    if pending:
+        for key, guild_user_id in pending.items():
+            guild_user_id_cache.put(key, guild_user_id)
+    deltas = session.info.pop("vc_deltas", None)
+    if deltas:
+        leaderboards.apply(deltas)
+
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discardPending(session: Session):
+    session.info.pop("guild_user_ids", None)
+    session.info.pop("vc_deltas", None)
+
+
+def findGuildUserId(session: Session, guild_id: int, user_id: int):
+    guild_user_id = guild_user_id_cache.get((guild_id, user_id))
+    if guild_user_id is None:
+        guild_user_id = session.info.get("guild_user_ids", {}).get((guild_id, user_id))
+    if guild_user_id is None:
+        guild_user_id = session.execute(select(GuildUser.id).filter_by(guild_id=guild_id, user_id=user_id)).scalar_one_or_none()
+        if guild_user_id is not None:
+            guild_user_id_cache.put((guild_id, user_id), guild_user_id)
+    return guild_user_id
+
+
+def resolveGuildUserId(session: Session, guild_id: int, user_id: int) -> int:
+    guild_user_id = findGuildUserId(session, guild_id, user_id)
+    if guild_user_id is not None:
+        return guild_user_id
+    session.execute(upsert(session, Guild).values(guild_id=guild_id).on_conflict_do_nothing())
+    session.execute(upsert(session, User).values(user_id=user_id).on_conflict_do_nothing())
+    session.execute(upsert(session, GuildUser).values(guild_id=guild_id, user_id=user_id, join_date=int(time.time()))
+                    .on_conflict_do_nothing(index_elements=["guild_id", "user_id"]))
+    guild_user_id = session.execute(select(GuildUser.id).filter_by(guild_id=guild_id, user_id=user_id)).scalar_one()
+    session.info.setdefault("guild_user_ids", {})[(guild_id, user_id)] = guild_user_id
+    logger.debug("Resolved guild user guild_id=%s, user_id=%s to id=%s", guild_id, user_id, guild_user_id)
+    return guild_user_id
+
+
+def resolveGuildUserIds(session: Session, pairs) -> dict[tuple[int, int], int]:
+    # resolveGuildUserId をまとめて行う版。足りない行は executemany で一度に作る
+    pending = session.info.get("guild_user_ids", {})
+    resolved = {}
+    missing = []
+    for key in set(pairs):
+        guild_user_id = guild_user_id_cache.get(key)
+        if guild_user_id is None:
+            guild_user_id = pending.get(key)
+        if guild_user_id is None:
+            missing.append(key)
+        else:
+            resolved[key] = guild_user_id
+    if not missing:
+        return resolved
+    joined = int(time.time())
+    session.execute(upsert(session, Guild).on_conflict_do_nothing(), [{"guild_id": guild_id} for guild_id in {guild_id for guild_id, _ in missing}])
+    session.execute(upsert(session, User).on_conflict_do_nothing(), [{"user_id": user_id} for user_id in {user_id for _, user_id in missing}])
+    session.execute(upsert(session, GuildUser).on_conflict_do_nothing(index_elements=["guild_id", "user_id"]),
+                    [{"guild_id": guild_id, "user_id": user_id, "join_date": joined} for guild_id, user_id in missing])
+    # SQLite のバインド変数の上限に当たらないように区切って引く
+    for start in range(0, len(missing), RESOLVE_CHUNK_SIZE):
+        chunk = missing[start:start + RESOLVE_CHUNK_SIZE]
+        rows = session.execute(select(GuildUser.guild_id, GuildUser.user_id, GuildUser.id)
+                               .where(tuple_(GuildUser.guild_id, GuildUser.user_id).in_(chunk)))
+        for guild_id, user_id, guild_user_id in rows:
+            resolved[(guild_id, user_id)] = guild_user_id
+            session.info.setdefault("guild_user_ids", {})[(guild_id, user_id)] = guild_user_id
+    return resolved
+
+
+def _addTotals(session: Session, model, rows):
+    # 集計表の主キーと (total_connection_time, total_mic_on_time) を加算する。rows は行の dict のリストか、同じ順に列を返す SELECT
+    # 行数が多いので、ORM の一括 INSERT (1行ずつ属性を集め直す) を通さずに Core で実行する
+    table = model.__table__
+    if isinstance(rows, Select):
+        stmt = upsert(session, table).from_select([column.name for column in table.columns], rows)
+    elif rows:
+        stmt = upsert(session, table)
     else:
-        logger.debug(f"Guild user already exists with guild_user={guild_user}")
-
-
-def checkExistsVCSummary(session: Session, id: int, channel_id: int, year: int, month: int):
-    vc_summary = session.query(VCSummary).filter_by(id=id, channel_id=channel_id, year=year, month=month).one_or_none()
-    if vc_summary is None:
-        vc_summary = VCSummary(id=id, channel_id=channel_id, year=year, month=month)
-        session.add(vc_summary)
-        session.flush()
-        logger.info(f"VCSummary created with vc_summary={vc_summary}")
+        return
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[column.name for column in table.primary_key],
+        set_={
+            "total_connection_time": table.c.total_connection_time + stmt.excluded.total_connection_time,
+            "total_mic_on_time": table.c.total_mic_on_time + stmt.excluded.total_mic_on_time
+        }
+    )
+    if isinstance(rows, Select):
+        session.connection().execute(stmt)
     else:
-        logger.debug(f"VCSummary already exists with vc_summary={vc_summary}")
-    session.commit()
+        session.connection().execute(stmt, rows)
+
+
+def creditVcIntervals(session: Session, intervals: Sequence[tuple[int, int, int, int, int, int, bool]]):
+    # 閉じた区間 (guild_user_id, guild_id, user_id, channel_id, start_time, end_time, mic_on) を vc_intervals に追記し、
+    # 日付の境目で区切って 日別/月別 (vc_summary)/年別/全期間 の集計に加算する
+    intervals = [interval for interval in intervals if interval[5] > interval[4]]
+    if not intervals:
+        return
+    session.connection().execute(insert(VCInterval.__table__), [
+        {"guild_user_id": guild_user_id, "channel_id": channel_id, "start_time": start_time, "end_time": end_time, "mic_on": mic_on}
+        for guild_user_id, _, _, channel_id, start_time, end_time, mic_on in intervals
+    ])
+    rollup = VCRollup()
+    for guild_user_id, guild_id, user_id, channel_id, start_time, end_time, mic_on in intervals:
+        rollup.add((guild_user_id, guild_id, user_id, channel_id), start_time, end_time, mic_on)
+    _addTotals(session, VCDailySummary, [
+        {"id": guild_user_id, "channel_id": channel_id, "year": year, "month": month, "day": day,
+         "total_connection_time": connection_time, "total_mic_on_time": mic_on_time}
+        for (guild_user_id, _, _, channel_id, year, month, day), (connection_time, mic_on_time) in rollup.daily.items()
+    ])
+    _addTotals(session, VCSummary, [
+        {"id": guild_user_id, "channel_id": channel_id, "year": year, "month": month,
+         "total_connection_time": connection_time, "total_mic_on_time": mic_on_time}
+        for (guild_user_id, _, _, channel_id, year, month), (connection_time, mic_on_time) in rollup.monthly.items()
+    ])
+    _addTotals(session, VCYearlySummary, [
+        {"id": guild_user_id, "channel_id": channel_id, "year": year,
+         "total_connection_time": connection_time, "total_mic_on_time": mic_on_time}
+        for (guild_user_id, _, _, channel_id, year), (connection_time, mic_on_time) in rollup.yearly.items()
+    ])
+    _addTotals(session, VCTotalSummary, [
+        {"id": guild_user_id, "channel_id": channel_id,
+         "total_connection_time": connection_time, "total_mic_on_time": mic_on_time}
+        for (guild_user_id, _, _, channel_id), (connection_time, mic_on_time) in rollup.total.items()
+    ])
+    # ランキングには月ごとの加算分を渡す (年間/全期間のランキングにも LeaderboardRegistry.keys で振り分けられる)
+    session.info.setdefault("vc_deltas", []).extend(
+        (guild_id, user_id, channel_id, year, month, connection_time, mic_on_time)
+        for (_, guild_id, user_id, channel_id, year, month), (connection_time, mic_on_time) in rollup.monthly.items()
+    )
 
 
 def updateServerNotificationChannel(session: Session, guild_id: int, notificationChannel_id: int):
@@ -157,20 +336,78 @@ def updateServerNotificationChannel(session: Session, guild_id: int, notificatio
     guild.notification_channel = notificationChannel_id
     logger.info(f"Updated notification channel to {notificationChannel_id} for guild_id={guild_id}")
     session.commit()
+    guild_settings_cache.put(guild_id, ServerSetting(guild_id, notificationChannel_id))
 
 
-def readServerSetting(session: Session, guild_id: int):
+def updateGuildRetention(session: Session, guild_id: int, retention_months: int | None):
     checkExistsGuild(session, guild_id)
     guild = session.query(Guild).filter_by(guild_id=guild_id).one()
-    return guild
+    guild.retention_months = retention_months
+    session.commit()
+    logger.info(f"Updated VC retention to {retention_months} month(s) for guild_id={guild_id}")
 
 
-def addUserCount(session: Session, user_id: int):
-    checkExistsUser(session, user_id)
-    user = session.query(User).filter_by(user_id=user_id).one()
-    user.command_count += 1
-    logger.debug(f"Updated command count for user_id={user_id} to {user.command_count}")
+def loadServerSetting(session: Session, guild_id: int):
+    checkExistsGuild(session, guild_id)
+    guild = session.query(Guild).filter_by(guild_id=guild_id).one()
+    setting = ServerSetting(guild.guild_id, guild.notification_channel)
+    guild_settings_cache.put(guild_id, setting)
+    return setting
+
+
+def readServerSetting(session: Session, guild_id: int):
+    setting = guild_settings_cache.get(guild_id)
+    if setting is None:
+        setting = loadServerSetting(session, guild_id)
+    return setting
+
+
+def readMemeRules(session: Session, guild_id: int):
+    rules = session.query(GuildMemeRule).filter_by(guild_id=guild_id).order_by(GuildMemeRule.id).all()
+    return [(rule.trigger, rule.mode, json.loads(rule.responses)) for rule in rules]
+
+
+def addMemeRule(session: Session, guild_id: int, trigger: str, mode: str, response: str, max_rules: int = 200):
+    checkExistsGuild(session, guild_id)
+    rule = session.query(GuildMemeRule).filter_by(guild_id=guild_id, trigger=trigger, mode=mode).one_or_none()
+    if rule is None:
+        if session.query(func.count(GuildMemeRule.id)).filter_by(guild_id=guild_id).scalar() >= max_rules:
+            raise TooManyRulesError(f"guild_id={guild_id} already has {max_rules} meme rules")
+        rule = GuildMemeRule(guild_id=guild_id, trigger=trigger, mode=mode, responses=json.dumps([response], ensure_ascii=False))
+        session.add(rule)
+        responses = [response]
+    else:
+        responses = json.loads(rule.responses)
+        if response not in responses:
+            responses.append(response)
+        rule.responses = json.dumps(responses, ensure_ascii=False)
+    session.commit()
+    logger.info(f"Added meme rule trigger='{trigger}' mode={mode} for guild_id={guild_id}")
+    return len(responses)
+
+
+def deleteMemeRule(session: Session, guild_id: int, trigger: str):
+    deleted = session.query(GuildMemeRule).filter_by(guild_id=guild_id, trigger=trigger).delete()
     session.commit()
+    logger.info(f"Deleted {deleted} meme rule(s) trigger='{trigger}' for guild_id={guild_id}")
+    return deleted
+
+
+def addUserCounts(session: Session, counts: dict[int, int]):
+    if not counts:
+        return
+    stmt = upsert(session, User)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["user_id"],
+        set_={"command_count": User.command_count + stmt.excluded.command_count}
+    )
+    session.execute(stmt, [{"user_id": user_id, "command_count": count} for user_id, count in counts.items()])
+    session.commit()
+    logger.debug("Flushed command counts for %d users", len(counts))
+
+
+def addUserCount(session: Session, user_id: int):
+    addUserCounts(session, {user_id: 1})
 
 
 class FutureDateError(ValueError):
@@ -179,132 +416,416 @@ class FutureDateError(ValueError):
 class NoDataError(ValueError):
     pass
 
-def readVcSummary(session: Session, guild_id: int, user_id: int, channel_id: int, year: int = None, month: int = None):
-    checkExistsGuildUser(session, guild_id, user_id)
+class TooManyRulesError(ValueError):
+    pass
+
+def _summaryTable(year: int = None, month: int = None, day: int = None):
+    # 期間に合う集計表と、その期間の行を選ぶ条件。どの期間でも1人1チャンネルにつき1行を読むだけで済む
+    if day is not None:
+        return VCDailySummary, (VCDailySummary.year == year, VCDailySummary.month == month, VCDailySummary.day == day)
+    if month is not None:
+        return VCSummary, (VCSummary.year == year, VCSummary.month == month)
+    if year is not None:
+        return VCYearlySummary, (VCYearlySummary.year == year,)
+    return VCTotalSummary, ()
+
+
+def readVcSummary(session: Session, guild_id: int, user_id: int, channel_id: int, year: int = None, month: int = None, day: int = None, all_time: bool = False):
     now_utc = datetime.now(timezone.utc)
-    if (year or now_utc.year, month or 1) > (now_utc.year, now_utc.month):
+    if all_time:
+        year = month = day = None
+    elif year is None or month is not None or day is not None:
+        # 年だけを指定したときは年間、それ以外は指定のない部分を今月 (今年) で埋める
+        year = year or now_utc.year
+        month = month or now_utc.month
+    if year is not None and (year, month or 1, day or 1) > (now_utc.year, now_utc.month, now_utc.day):
         logger.debug(f"Input error: The year and month are in the future.")
         raise FutureDateError("指定された年月は未来です")
 
-    guild_user = session.query(GuildUser).filter_by(guild_id=guild_id, user_id=user_id).one()
-    if month is None and year is not None:
-        total_connection_time, total_mic_on_time = session.query(func.coalesce(func.sum(VCSummary.total_connection_time), 0), func.coalesce(func.sum(VCSummary.total_mic_on_time), 0)).filter_by(id=guild_user.id, channel_id=channel_id, year=year).one()
-        connection_time = formatTime(total_connection_time)
-        mic_on_time = formatTime(total_mic_on_time)
-    else:
-        year = year or now_utc.year
-        month = month or now_utc.month
-        vc_summary = session.query(VCSummary).filter_by(id=guild_user.id, channel_id=channel_id, year=year, month=month).one_or_none()
-        if vc_summary is None:
-            logger.debug(f"No VCSummary data found")
-            raise NoDataError
-        connection_time = formatTime(vc_summary.total_connection_time)
-        mic_on_time = formatTime(vc_summary.total_mic_on_time)
-    return connection_time, mic_on_time
-
-def readVcRankEntries(session: Session, guild_id: int, channel_id: int = None, year: int = None, month: int = None, limit: int = 10):
-    checkExistsGuild(session, guild_id)
+    guild_user_id = findGuildUserId(session, guild_id, user_id)
+    model, period = _summaryTable(year, month, day)
+    totals = session.execute(select(model.total_connection_time, model.total_mic_on_time)
+                             .where(model.id == guild_user_id, model.channel_id == channel_id, *period)).one_or_none()
+    if totals is None:
+        logger.debug(f"No VCSummary data found")
+        raise NoDataError
+    return formatTime(totals.total_connection_time), formatTime(totals.total_mic_on_time)
+
+def _vcRankQuery(session: Session, guild_id: int, channel_id: int, year: int, month: int):
+    model, period = _summaryTable(year, month)
+    query = session.query(GuildUser.user_id, func.sum(model.total_connection_time).label("total_connection_time"), func.sum(model.total_mic_on_time).label("total_mic_on_time")
+                          ).join(model, model.id == GuildUser.id).filter(GuildUser.guild_id == guild_id, *period)
+
+    if channel_id is not None:
+        query = query.filter(model.channel_id == channel_id)
+
+    return query.group_by(GuildUser.user_id)
+
+
+def readLeaderboard(session: Session, guild_id: int, channel_id: int, year: int, month: int):
+    # 初回だけDBから集計して作り、以降は creditVcIntervals での加算をそのまま反映していく
+    def load():
+        rows = _vcRankQuery(session, guild_id, channel_id, year, month).all()
+        logger.debug("Loaded leaderboard guild_id=%s, channel_id=%s, year=%s, month=%s with %d users", guild_id, channel_id, year, month, len(rows))
+        return rows
+    return leaderboards.get((guild_id, channel_id, year, month), load)
+
+
+def readVcRankEntries(session: Session, guild_id: int, channel_id: int = None, year: int = None, month: int = None, limit: int = 10, all_time: bool = False):
     now_utc = datetime.now(timezone.utc)
-    if (year or now_utc.year, month or 1) > (now_utc.year, now_utc.month):
+    if not all_time and (year or now_utc.year, month or 1) > (now_utc.year, now_utc.month):
         logger.warning(f"Input error: The year and month are in the future.")
         raise FutureDateError("指定された年月は未来です")
     
-    year = year or now_utc.year
-    query = session.query(GuildUser.user_id, func.sum(VCSummary.total_connection_time).label("total_connection_time"), func.sum(VCSummary.total_mic_on_time).label("total_mic_on_time")
-                          ).join(VCSummary, VCSummary.id == GuildUser.id).filter(GuildUser.guild_id == guild_id, VCSummary.year == year)
-    
-    if channel_id is not None:
-        query = query.filter(VCSummary.channel_id == channel_id)
-
-    if month is not None:
-        query = query.filter(VCSummary.month == month)
-
-    ranking_tuples = query.group_by(GuildUser.user_id).order_by((func.sum(VCSummary.total_connection_time) - func.sum(VCSummary.total_mic_on_time)).desc(), func.sum(VCSummary.total_connection_time).desc()).limit(limit).all()
-    ranking = convertRankingTuplesToList(ranking_tuples)
+    # all_time のときは年も月も絞らない (全期間の集計表から読む)
+    year, month = (None, None) if all_time else (year or now_utc.year, month)
+    board = readLeaderboard(session, guild_id, channel_id, year, month)
+    ranking = [VCRankingEntry(rank, user_id, total_connection_time, total_mic_on_time) for rank, user_id, total_connection_time, total_mic_on_time in board.top(limit)]
     return VCRankingList(ranking)
 
-def readUserVcRankEntry(session: Session, guild_id: int, user_id: int, channel_id: int = None, year: int = None, month: int = None, limit: int = 10):
-    checkExistsGuildUser(session, guild_id, user_id)
+def readUserVcRankEntry(session: Session, guild_id: int, user_id: int, channel_id: int = None, year: int = None, month: int = None, limit: int = 10, all_time: bool = False):
     now_utc = datetime.now(timezone.utc)
-    if (year or now_utc.year, month or 1) > (now_utc.year, now_utc.month):
+    if not all_time and (year or now_utc.year, month or 1) > (now_utc.year, now_utc.month):
         logger.warning(f"Input error: The year and month are in the future.")
         raise FutureDateError("指定された年月は未来です")
     
-    year = year or now_utc.year
-    user_query = (session.query(GuildUser.user_id, func.sum(VCSummary.total_connection_time).label("total_connection_time"), func.sum(VCSummary.total_mic_on_time).label("total_mic_on_time"))
-                  .join(VCSummary, VCSummary.id == GuildUser.id).filter(GuildUser.guild_id == guild_id, VCSummary.year == year))
-    
-    diff_subquery = (session.query(GuildUser.user_id, (func.sum(VCSummary.total_connection_time) - func.sum(VCSummary.total_mic_on_time)).label("diff_time"))
-                            .join(VCSummary, VCSummary.id == GuildUser.id).filter(GuildUser.guild_id == guild_id, VCSummary.year == year))
-    
-    if channel_id is not None:
-        user_query = user_query.filter(VCSummary.channel_id == channel_id)
-        diff_subquery = diff_subquery.filter(VCSummary.channel_id == channel_id)
-
-    if month is not None:
-        user_query = user_query.filter(VCSummary.month == month)
-        diff_subquery = diff_subquery.filter(VCSummary.month == month)
-
-    my_totals = user_query.filter(GuildUser.user_id == user_id).one_or_none()
-    diff_subquery = diff_subquery.group_by(GuildUser.user_id).subquery()
-
-    if my_totals.total_connection_time is None or my_totals.total_mic_on_time is None:
+    # all_time のときは年も月も絞らない (全期間の集計表から読む)
+    year, month = (None, None) if all_time else (year or now_utc.year, month)
+    board = readLeaderboard(session, guild_id, channel_id, year, month)
+    my_totals = board.totals(user_id)
+    if my_totals is None:
         logger.debug(f"No VCSummary data found")
         raise NoDataError
-    
-    my_diff = my_totals.total_connection_time - my_totals.total_mic_on_time
-    
-    rank = (session.query(func.count()).select_from(diff_subquery).filter(diff_subquery.c.diff_time > my_diff).scalar()) + 1
 
-    return VCRankingEntry(user_id=user_id, total_connection_time = formatTime(my_totals.total_connection_time), total_mic_on_time = formatTime(my_totals.total_mic_on_time), rank = rank)
+    total_connection_time, total_mic_on_time = my_totals
+    return VCRankingEntry(user_id=user_id, total_connection_time = formatTime(total_connection_time), total_mic_on_time = formatTime(total_mic_on_time), rank = board.rank(user_id))
 
-def clearVcSessions(session: Session):
-    session.query(VCSession).delete()
-    logger.info("cleared vc_sessions table")
+def readVcRankPage(session: Session, guild_id: int, user_id: int, channel_id: int = None, year: int = None, month: int = None, page: int = 1, per_page: int = 10, all_time: bool = False):
+    now_utc = datetime.now(timezone.utc)
+    if not all_time and (year or now_utc.year, month or 1) > (now_utc.year, now_utc.month):
+        logger.warning(f"Input error: The year and month are in the future.")
+        raise FutureDateError("指定された年月は未来です")
+
+    # all_time のときは年も月も絞らない (全期間の集計表から読む)
+    year, month = (None, None) if all_time else (year or now_utc.year, month)
+    page = max(1, page)
+    offset = (page - 1) * per_page
+
+    if leaderboards.enabled:
+        board = readLeaderboard(session, guild_id, channel_id, year, month)
+        entries = [VCRankingEntry(rank, entry_user_id, total_connection_time, total_mic_on_time) for rank, entry_user_id, total_connection_time, total_mic_on_time in board.top(per_page, offset)]
+        my_totals = board.totals(user_id)
+        user_entry = VCRankingEntry(board.rank(user_id), user_id, *my_totals) if my_totals is not None else None
+        return VCRankingPage(entries, user_entry, page, per_page, len(board))
+
+    # ランキングをメモリに持たない設定のときは、ページと自分の順位を1回のクエリで取る
+    totals = _vcRankQuery(session, guild_id, channel_id, year, month).subquery()
+    diff_time = totals.c.total_connection_time - totals.c.total_mic_on_time
+    ranked = select(
+        totals.c.user_id,
+        totals.c.total_connection_time,
+        totals.c.total_mic_on_time,
+        func.rank().over(order_by=diff_time.desc()).label("rank"),
+        func.row_number().over(order_by=(diff_time.desc(), totals.c.total_connection_time.desc(), totals.c.user_id)).label("position"),
+        func.count().over().label("total")
+    ).subquery()
+    rows = session.execute(
+        select(ranked)
+        .where(or_(ranked.c.position.between(offset + 1, offset + per_page), ranked.c.user_id == user_id))
+        .order_by(ranked.c.position)
+    ).all()
+
+    entries = []
+    user_entry = None
+    for row in rows:
+        entry = VCRankingEntry(row.rank, row.user_id, row.total_connection_time, row.total_mic_on_time)
+        if offset < row.position <= offset + per_page:
+            entries.append(entry)
+        if row.user_id == user_id:
+            user_entry = entry
+    if rows:
+        total = rows[0].total
+    else:
+        # 最後のページより後ろで自分の行もないときは、窓関数の行が1つも返らないので人数は別に数える
+        total = session.scalar(select(func.count()).select_from(totals))
+    return VCRankingPage(entries, user_entry, page, per_page, total)
+
+# エクスポートできる期間ごとの集計表と、期間を表す列
+EXPORT_PERIODS = {
+    "day": (VCDailySummary, ("year", "month", "day")),
+    "month": (VCSummary, ("year", "month")),
+    "year": (VCYearlySummary, ("year",)),
+    "all_time": (VCTotalSummary, ()),
+}
+
+
+def exportVcSummary(session: Session, guild_id: int, writer: ExportWriter, period: str = "month", chunk_size: int = 1000) -> int:
+    # サーバーの集計を チャンネル → 期間 → 順位 の順に writer へ書き込み、書いた行数を返す
+    # yield_per で chunk_size 行ずつ読むので、行数が多くても全部をメモリに載せない
+    model, period_names = EXPORT_PERIODS[period]
+    period_columns = [getattr(model, name) for name in period_names]
+    diff_time = model.total_connection_time - model.total_mic_on_time
+    rank = func.rank().over(partition_by=(model.channel_id, *period_columns), order_by=diff_time.desc()).label("rank")
+    stmt = (select(model.channel_id, *period_columns, GuildUser.user_id, model.total_connection_time, model.total_mic_on_time, rank)
+            .join(GuildUser, GuildUser.id == model.id)
+            .where(GuildUser.guild_id == guild_id)
+            .order_by(model.channel_id, *period_columns, rank, GuildUser.user_id))
+    result = session.execute(stmt, execution_options={"yield_per": chunk_size})
+    try:
+        for row in result:
+            entry = VCRankingEntry(row.rank, row.user_id, row.total_connection_time, row.total_mic_on_time)
+            if not writer.write({"channel_id": row.channel_id, **{name: getattr(row, name) for name in period_names}, **entry.to_dict()}):
+                break
+    finally:
+        result.close()
+    logger.info(f"Exported {writer.rows} {period} VC rows for guild_id={guild_id} ({writer.size} bytes in {len(writer)} file(s), truncated={writer.truncated})")
+    return writer.rows
+
+
+def shardFilter(guild_id_column, shard_ids: Sequence[int], shard_count: int):
+    # Discord と同じ割り当て (guild_id >> 22) % shard_count で、担当するシャードのサーバーだけに絞る
+    return (guild_id_column.op(">>", return_type=Integer)(22) % shard_count).in_(list(shard_ids))
+
+
+def readVcSessions(session: Session, shard_ids: Sequence[int] = None, shard_count: int = None) -> list[tuple[int, int, int, int, bool]]:
+    stmt = (select(GuildUser.guild_id, GuildUser.user_id, VCSession.channel_id, VCSession.event_time, VCSession.mic_on)
+            .join(GuildUser, GuildUser.id == VCSession.id))
+    if shard_ids is not None:
+        stmt = stmt.where(shardFilter(GuildUser.guild_id, shard_ids, shard_count))
+    rows = session.execute(stmt).all()
+    return [(row.guild_id, row.user_id, row.channel_id, row.event_time, bool(row.mic_on)) for row in rows]
+
+
+def checkpointVcSessions(session: Session, intervals: Sequence[tuple[int, int, int, int, int, bool]],
+                         opened: Sequence[tuple[int, int, int, int, bool]], ended: Sequence[tuple[int, int, int]]):
+    # メモリ上のセッション表の変更分を1トランザクションで書き込む
+    #   intervals: 閉じた区間の (guild_id, user_id, channel_id, start_time, end_time, mic_on)
+    #   opened:    今開いているセッションの (guild_id, user_id, channel_id, event_time, mic_on)。同じキーの行は置き換える
+    #   ended:     閉じたセッションの (guild_id, user_id, channel_id)
+    guild_user_ids = resolveGuildUserIds(session, [(guild_id, user_id) for guild_id, user_id, *_ in (*intervals, *opened, *ended)])
+    creditVcIntervals(session, [(guild_user_ids[(guild_id, user_id)], guild_id, user_id, *rest) for guild_id, user_id, *rest in intervals])
+    if ended:
+        _deleteRows(session, VCSession, [(guild_user_ids[(guild_id, user_id)], channel_id) for guild_id, user_id, channel_id in ended])
+    if opened:
+        stmt = upsert(session, VCSession)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["id", "channel_id"],
+            set_={"event_time": stmt.excluded.event_time, "mic_on": stmt.excluded.mic_on}
+        )
+        session.execute(stmt, [
+            {"id": guild_user_ids[(guild_id, user_id)], "channel_id": channel_id, "event_time": event_time, "mic_on": mic_on}
+            for guild_id, user_id, channel_id, event_time, mic_on in opened
+        ])
+    session.commit()
+    voice_logger.debug("Checkpointed vc_sessions: intervals=%d, opened=%d, ended=%d", len(intervals), len(opened), len(ended))
+
+def endAllVcSessions(session: Session, event_time: int = None, shard_ids: Sequence[int] = None, shard_count: int = None) -> int:
+    # 開いているセッションをすべて閉じた区間として集計に加算し、DELETE 1文で消す
+    # shard_ids を渡すと、そのシャードのサーバーのセッションだけを閉じる (他のプロセスのセッションには触らない)
+    end_time = event_time or int(time.time())
+    end_utc = datetime.fromtimestamp(end_time, timezone.utc)
+    day_start = end_time - end_time % DAY_SECONDS
+    scope = true()
+    if shard_ids is not None:
+        scope = VCSession.id.in_(select(GuildUser.id).where(shardFilter(GuildUser.guild_id, shard_ids, shard_count)))
+    sessions = (select(VCSession.id, GuildUser.guild_id, GuildUser.user_id, VCSession.channel_id, VCSession.event_time, VCSession.mic_on)
+                .join(GuildUser, GuildUser.id == VCSession.id))
+
+    # 日付をまたいでいるセッションは行を読んで、日付の境目で区切ってから加算する
+    crossing = session.execute(sessions.where(scope, VCSession.event_time < day_start)).all()
+    creditVcIntervals(session, [(*row[:5], end_time, bool(row.mic_on)) for row in crossing])
+
+    # 残り (今日始まったセッション) はどれも今日の1日分だけなので、INSERT ... SELECT で集計表ごとに1文で足し込む
+    today = and_(scope, VCSession.event_time >= day_start, VCSession.event_time < end_time)
+    if len(leaderboards):
+        # 読み込み済みのランキングがあるときだけ、反映用に1行ずつの加算分を集める
+        session.info.setdefault("vc_deltas", []).extend(
+            (row.guild_id, row.user_id, row.channel_id, end_utc.year, end_utc.month,
+             end_time - row.event_time, end_time - row.event_time if row.mic_on else 0)
+            for row in session.execute(sessions.where(today))
+        )
+    session.connection().execute(insert(VCInterval.__table__).from_select(
+        ["guild_user_id", "channel_id", "start_time", "end_time", "mic_on"],
+        select(VCSession.id, VCSession.channel_id, VCSession.event_time, literal(end_time), VCSession.mic_on).where(today)
+    ))
+    elapsed_time = literal(end_time) - VCSession.event_time
+    mic_on_time = case((VCSession.mic_on != 0, elapsed_time), else_=0)
+    for model, period in ((VCDailySummary, (end_utc.year, end_utc.month, end_utc.day)), (VCSummary, (end_utc.year, end_utc.month)),
+                          (VCYearlySummary, (end_utc.year,)), (VCTotalSummary, ())):
+        # SQLite は INSERT ... SELECT に ON CONFLICT を付けるとき、SELECT に WHERE がないと構文を解釈できない (today が WHERE になる)
+        _addTotals(session, model, select(VCSession.id, VCSession.channel_id, *map(literal, period), elapsed_time, mic_on_time).where(today))
+
+    closed = session.execute(delete(VCSession).where(scope).execution_options(synchronize_session=False)).rowcount
     session.commit()
+    logger.info(f"Ended {closed} VC sessions")
+    return closed
+
+
+# ---- 保存期間の整理 (database/maintenance.py から1バッチずつ呼ぶ) ----
+# どれも1回の呼び出しで最大 batch_size 行だけ消してコミットし、消した行数を返す。0 を返すまで繰り返す
+# 1回の書き込みを短く保って、その間にDBスレッドでVCのチェックポイントなどが割り込めるようにする
+VC_HISTORY_TABLES = (VCInterval, VCDailySummary, VCSummary, VCYearlySummary, VCTotalSummary)
+
+
+def _foreignKeysEnforced(session: Session) -> bool:
+    if session.get_bind().dialect.name != "sqlite":
+        return True
+    return bool(session.connection().exec_driver_sql("PRAGMA foreign_keys").scalar())
+
 
+def _deleteRows(session: Session, model, rows: Sequence[tuple]):
+    # 主キーの組で1行ずつ消す。ORM の delete は executemany に対応していないので Core で実行する
+    table = model.__table__
+    columns = list(table.primary_key)
+    session.connection().execute(
+        delete(table).where(*(column == bindparam(f"pk_{column.name}") for column in columns)),
+        [{f"pk_{column.name}": value for column, value in zip(columns, row)} for row in rows]
+    )
 
-def addVcSessions(session: Session, guild_id: int, user_id: int, channel_id: int, mic_on: bool):
-    checkExistsGuildUser(session, guild_id, user_id)
-    event_time = int(time.time())
-    guild_user = session.query(GuildUser).filter_by(guild_id=guild_id, user_id=user_id).one_or_none()
-    vc_session = VCSession(id=guild_user.id, channel_id=channel_id, event_time=event_time, mic_on=mic_on)
-    session.add(vc_session)
+
+def _ownerColumn(model):
+    # guild_users.id を指す列
+    return VCInterval.guild_user_id if model is VCInterval else model.id
+
+
+def _retentionMonths(default_months: int):
+    # サーバーごとの保存月数。未設定なら default_months、0 なら消さない
+    return func.coalesce(Guild.retention_months, default_months)
+
+
+def _monthIndex(year, month):
+    return year * 12 + month
+
+
+def compactVcSummaries(session: Session, default_months: int, batch_size: int, now: int = None) -> int:
+    # 保存期間を過ぎた月別の行を消す。年別/全期間の集計は同じ区間から加算済みなので、古い月は年単位に畳まれた形で残る
+    now_utc = datetime.fromtimestamp(now or int(time.time()), timezone.utc)
+    retention = _retentionMonths(default_months)
+    rows = session.execute(
+        select(VCSummary.id, VCSummary.channel_id, VCSummary.year, VCSummary.month, GuildUser.guild_id)
+        .join(GuildUser, GuildUser.id == VCSummary.id)
+        .outerjoin(Guild, Guild.guild_id == GuildUser.guild_id)
+        .where(retention > 0, _monthIndex(VCSummary.year, VCSummary.month) <= _monthIndex(now_utc.year, now_utc.month) - retention)
+        .limit(batch_size)
+    ).all()
+    if not rows:
+        return 0
+    _deleteRows(session, VCSummary, [row[:4] for row in rows])
     session.commit()
-    logger.debug(f"Added VCSession: {vc_session}")
+    for guild_id in {row.guild_id for row in rows}:
+        leaderboards.invalidate_guild(guild_id)
+    logger.debug("Compacted %d monthly VC rows", len(rows))
+    return len(rows)
+
+
+def purgeVcDailySummaries(session: Session, default_months: int, max_days: int, batch_size: int, now: int = None) -> int:
+    # 日別の行は、サーバーの保存月数を過ぎたものと max_days 日より前のものを消す
+    now = now or int(time.time())
+    now_utc = datetime.fromtimestamp(now, timezone.utc)
+    retention = _retentionMonths(default_months)
+    expired = and_(retention > 0, _monthIndex(VCDailySummary.year, VCDailySummary.month) <= _monthIndex(now_utc.year, now_utc.month) - retention)
+    if max_days > 0:
+        cutoff = datetime.fromtimestamp(now - max_days * DAY_SECONDS, timezone.utc)
+        expired = or_(expired, VCDailySummary.year * 10000 + VCDailySummary.month * 100 + VCDailySummary.day
+                      < cutoff.year * 10000 + cutoff.month * 100 + cutoff.day)
+    rows = session.execute(
+        select(VCDailySummary.id, VCDailySummary.channel_id, VCDailySummary.year, VCDailySummary.month, VCDailySummary.day)
+        .join(GuildUser, GuildUser.id == VCDailySummary.id)
+        .outerjoin(Guild, Guild.guild_id == GuildUser.guild_id)
+        .where(expired)
+        .limit(batch_size)
+    ).all()
+    if not rows:
+        return 0
+    _deleteRows(session, VCDailySummary, rows)
+    session.commit()
+    logger.debug("Purged %d daily VC rows", len(rows))
+    return len(rows)
 
 
-def endVcSessions(session: Session, guild_id: int, user_id: int, channel_id: int, mic_on: bool, startup_time: int):
-    logger.debug(f"Ending VC session for user_id={user_id}, guild_id={guild_id}, channel_id={channel_id}, mic_on={mic_on}")
-    checkExistsGuildUser(session, guild_id, user_id)
-    end_time = int(time.time())
-    now_utc = datetime.now(timezone.utc)
-    guild_user = session.query(GuildUser).filter_by(guild_id=guild_id, user_id=user_id).one()
-    checkExistsVCSummary(session, id=guild_user.id, channel_id=channel_id, year=now_utc.year, month=now_utc.month)
-    vc_session = session.query(VCSession).filter_by(id=guild_user.id, channel_id=channel_id).one_or_none()
-    if vc_session is None:
-        elapsed_time = end_time - startup_time
-        mic_on_session = mic_on
+def purgeVcIntervals(session: Session, max_days: int, batch_size: int, now: int = None) -> int:
+    # 区間のログは集計に加算済みなので、max_days 日より前に終わったものは消してよい
+    if max_days <= 0:
+        return 0
+    cutoff = (now or int(time.time())) - max_days * DAY_SECONDS
+    expired = select(VCInterval.id).where(VCInterval.end_time < cutoff).limit(batch_size)
+    deleted = session.execute(delete(VCInterval).where(VCInterval.id.in_(expired)).execution_options(synchronize_session=False)).rowcount
+    session.commit()
+    if deleted:
+        logger.debug("Purged %d VC intervals", deleted)
+    return deleted
+
+
+def readVcChannels(session: Session, shard_ids: Sequence[int] = None, shard_count: int = None) -> dict[int, set[int]]:
+    # 集計が残っているチャンネルをサーバーごとに返す (全期間の集計表には、記録のあるチャンネルが必ず1行以上ある)
+    stmt = (select(GuildUser.guild_id, VCTotalSummary.channel_id).distinct()
+            .join(GuildUser, GuildUser.id == VCTotalSummary.id))
+    if shard_ids is not None:
+        stmt = stmt.where(shardFilter(GuildUser.guild_id, shard_ids, shard_count))
+    channels = {}
+    for guild_id, channel_id in session.execute(stmt):
+        channels.setdefault(guild_id, set()).add(channel_id)
+    return channels
+
+
+def purgeVcChannels(session: Session, guild_id: int, channel_ids: Sequence[int], batch_size: int) -> int:
+    # 削除されたチャンネルの記録を消す。全期間の集計を最後に消すので、途中で止まっても次の readVcChannels でまた見つかる
+    members = select(GuildUser.id).where(GuildUser.guild_id == guild_id)
+    for model in VC_HISTORY_TABLES:
+        rows = session.execute(
+            select(*model.__table__.primary_key).where(model.channel_id.in_(list(channel_ids)), _ownerColumn(model).in_(members)).limit(batch_size)
+        ).all()
+        if rows:
+            _deleteRows(session, model, rows)
+            session.commit()
+            leaderboards.invalidate_guild(guild_id)
+            logger.debug("Purged %d rows from %s for deleted channels in guild_id=%s", len(rows), model.__tablename__, guild_id)
+            return len(rows)
+    return 0
+
+
+def readGuildIds(session: Session, shard_ids: Sequence[int] = None, shard_count: int = None) -> list[int]:
+    stmt = select(Guild.guild_id)
+    if shard_ids is not None:
+        stmt = stmt.where(shardFilter(Guild.guild_id, shard_ids, shard_count))
+    return list(session.execute(stmt).scalars())
+
+
+def purgeGuild(session: Session, guild_id: int, batch_size: int) -> int:
+    # 抜けたサーバーのメンバーを消す。VCの記録などは外部キーの ondelete="CASCADE" で一緒に消える
+    # メンバーがいなくなったらサーバーの行 (とミーム) を消して 0 を返す
+    guild_user_ids = list(session.execute(select(GuildUser.id).where(GuildUser.guild_id == guild_id).limit(batch_size)).scalars())
+    cascade = _foreignKeysEnforced(session)
+    if guild_user_ids:
+        if not cascade:
+            # 外部キーが無効な接続 (legacy プロファイル) では子の行を自分で消す
+            for model in (*VC_HISTORY_TABLES, VCSession):
+                session.execute(delete(model).where(_ownerColumn(model).in_(guild_user_ids)).execution_options(synchronize_session=False))
+        session.execute(delete(GuildUser).where(GuildUser.id.in_(guild_user_ids)).execution_options(synchronize_session=False))
     else:
-        elapsed_time = end_time - vc_session.event_time
-        mic_on_session = vc_session.mic_on
-        session.delete(vc_session)
-    
-    if mic_on and mic_on_session:
-        vc_summary = session.query(VCSummary).filter_by(id=guild_user.id, channel_id=channel_id, year=now_utc.year, month=now_utc.month).one()
-        vc_summary.total_connection_time += elapsed_time
-        vc_summary.total_mic_on_time += elapsed_time
-        logger.debug("mic_on and mic_on_session")
-    elif not mic_on and not mic_on_session:
-        vc_summary = session.query(VCSummary).filter_by(id=guild_user.id, channel_id=channel_id, year=now_utc.year, month=now_utc.month).one()
-        vc_summary.total_connection_time += elapsed_time
-        logger.debug("not mic_on and not mic_on_session")
+        if not cascade:
+            session.execute(delete(GuildMemeRule).where(GuildMemeRule.guild_id == guild_id).execution_options(synchronize_session=False))
+        session.execute(delete(Guild).where(Guild.guild_id == guild_id).execution_options(synchronize_session=False))
+    session.commit()
+    # 消した guild_users.id をキャッシュから引いて書き込むと外部キー違反になる
+    guild_user_id_cache.invalidate_where(lambda key: key[0] == guild_id)
+    guild_settings_cache.invalidate(guild_id)
+    leaderboards.invalidate_guild(guild_id)
+    if guild_user_ids:
+        logger.debug("Purged %d members of departed guild_id=%s", len(guild_user_ids), guild_id)
     else:
-        logger.error(f'Integrity violation argument: {mic_on} db: {mic_on_session}')
+        logger.info(f"Purged departed guild_id={guild_id}")
+    return len(guild_user_ids)
+
+
+def vacuumStep(session: Session, pages: int) -> tuple[int, int]:
+    # auto_vacuum=INCREMENTAL のDBで、空きページを最大 pages ページだけファイルから返す。(返したページ数, 残りの空きページ数)
+    if session.get_bind().dialect.name != "sqlite":
+        return 0, 0
+    connection = session.connection()
+    free_pages = connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+    if free_pages and connection.exec_driver_sql("PRAGMA auto_vacuum").scalar() == 2:
+        connection.exec_driver_sql(f"PRAGMA incremental_vacuum({int(pages)})")
+    remaining = connection.exec_driver_sql("PRAGMA freelist_count").scalar()
     session.commit()
-
-def endAllVcSessions(session: Session, startup_time: int):
-    allSession = session.query(VCSession).all()
-    for s in allSession:
-        guild_user = session.query(GuildUser).filter_by(id = s.id).one()
-        endVcSessions(session, guild_user.guild_id, guild_user.user_id, s.channel_id, s.mic_on, startup_time)
\ No newline at end of file
+    return free_pages - remaining, remaining
@@ -0,0 +1,94 @@
+import csv
+import io
+import json
+from tempfile import SpooledTemporaryFile
+
+EXPORT_FORMATS = ("csv", "ndjson")
+# これを超えた分は一時ファイルに書き出すので、行数が多くてもメモリはこれ以上使わない
+SPOOL_SIZE = 1024 * 1024
+
+
+def flattenRow(row: dict, prefix: str = "") -> dict:
+    # CSV 用に {"connection_time": {"hour": 1}} を {"connection_time_hour": 1} にする
+    flat = {}
+    for key, value in row.items():
+        if isinstance(value, dict):
+            flat.update(flattenRow(value, f"{prefix}{key}_"))
+        else:
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+class ExportWriter:
+    # 行を1行ずつ CSV/NDJSON にして一時ファイルに書き込む。1ファイルが part_size バイトを超えそうになったら次のファイルに分け、
+    # max_parts を超える分は書かずに truncated を立てる (Discord に添付できる大きさと数に合わせる)
+    def __init__(self, name: str, fmt: str, part_size: int, max_parts: int = 10):
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"fmt must be one of {', '.join(EXPORT_FORMATS)}, got {fmt!r}")
+        self.name = name
+        self.fmt = fmt
+        self.part_size = part_size
+        self.max_parts = max_parts
+        self.rows = 0
+        self.truncated = False
+        self._parts: list[list] = []
+        self._fields = None
+        self._line = io.StringIO()
+        self._csv = csv.writer(self._line, lineterminator="\n")
+
+    def __len__(self):
+        return len(self._parts)
+
+    def _encode(self, values) -> bytes:
+        self._line.seek(0)
+        self._line.truncate()
+        self._csv.writerow(values)
+        return self._line.getvalue().encode("utf-8")
+
+    def _startPart(self) -> bool:
+        if len(self._parts) >= self.max_parts:
+            self.truncated = True
+            return False
+        spool = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        size = 0
+        if self.fmt == "csv":
+            size = spool.write(self._encode(self._fields))
+        self._parts.append([spool, size])
+        return True
+
+    def write(self, row: dict) -> bool:
+        # 書けなかった (ファイル数の上限に達した) ときは False を返すので、呼び出し側は読むのをやめる
+        if self.truncated:
+            return False
+        if self.fmt == "csv":
+            row = flattenRow(row)
+            if self._fields is None:
+                self._fields = list(row)
+            line = self._encode(row.values())
+        else:
+            line = (json.dumps(row, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        if not self._parts or (self._parts[-1][1] + len(line) > self.part_size and self.rows):
+            if not self._startPart():
+                return False
+        part = self._parts[-1]
+        part[1] += part[0].write(line)
+        self.rows += 1
+        return True
+
+    def files(self) -> list[tuple[str, SpooledTemporaryFile]]:
+        # (ファイル名, 先頭に戻したファイル)。分けたときは name-1.csv, name-2.csv, ...
+        files = []
+        for index, (spool, _) in enumerate(self._parts, start=1):
+            spool.seek(0)
+            suffix = f"-{index}" if len(self._parts) > 1 else ""
+            files.append((f"{self.name}{suffix}.{self.fmt}", spool))
+        return files
+
+    @property
+    def size(self):
+        return sum(size for _, size in self._parts)
+
+    def close(self):
+        for spool, _ in self._parts:
+            spool.close()
+        self._parts.clear()
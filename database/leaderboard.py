@@ -0,0 +1,116 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Iterable
+from sortedcontainers import SortedList
+
+
+class Leaderboard:
+    def __init__(self, rows: Iterable[tuple[int, int, int]] = ()):
+        self._totals: dict[int, tuple[int, int]] = {}
+        self._order = SortedList()
+        for user_id, connection_time, mic_on_time in rows:
+            self._totals[user_id] = (connection_time, mic_on_time)
+        self._order.update(self._key(user_id, *totals) for user_id, totals in self._totals.items())
+
+    def __len__(self):
+        return len(self._totals)
+
+    @staticmethod
+    def _key(user_id: int, connection_time: int, mic_on_time: int):
+        # (接続時間 - ミュート時間) の降順、同点なら接続時間の降順
+        return (mic_on_time - connection_time, -connection_time, user_id)
+
+    def add(self, user_id: int, connection_time: int, mic_on_time: int):
+        old = self._totals.get(user_id)
+        if old is not None:
+            self._order.remove(self._key(user_id, *old))
+            connection_time += old[0]
+            mic_on_time += old[1]
+        self._totals[user_id] = (connection_time, mic_on_time)
+        self._order.add(self._key(user_id, connection_time, mic_on_time))
+
+    def totals(self, user_id: int):
+        return self._totals.get(user_id)
+
+    def _rank(self, diff_key: int):
+        # 自分より (接続時間 - ミュート時間) が大きい人の数 + 1 (SQLの RANK() と同じ)
+        return self._order.bisect_left((diff_key,)) + 1
+
+    def top(self, limit: int, offset: int = 0):
+        return [(self._rank(diff_key), user_id, *self._totals[user_id])
+                for diff_key, _, user_id in self._order.islice(offset, offset + limit)]
+
+    def rank(self, user_id: int):
+        totals = self._totals.get(user_id)
+        if totals is None:
+            return None
+        return self._rank(self._key(user_id, *totals)[0])
+
+
+class LeaderboardRegistry:
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._boards: OrderedDict[tuple, Leaderboard] = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._boards)
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0
+
+    @staticmethod
+    def keys(guild_id: int, channel_id: int, year: int, month: int):
+        # 1回の加算で影響を受けるランキング: チャンネル別/サーバー全体 × 月別/年間/全期間
+        return (
+            (guild_id, channel_id, year, month),
+            (guild_id, None, year, month),
+            (guild_id, channel_id, year, None),
+            (guild_id, None, year, None),
+            (guild_id, channel_id, None, None),
+            (guild_id, None, None, None),
+        )
+
+    def get(self, key: tuple, load: Callable[[], Iterable[tuple[int, int, int]]]) -> Leaderboard:
+        with self._lock:
+            board = self._boards.get(key)
+            if board is not None:
+                self._boards.move_to_end(key)
+                self.hits += 1
+                return board
+            self.misses += 1
+            board = Leaderboard(load())
+            self._boards[key] = board
+            while len(self._boards) > self.maxsize:
+                self._boards.popitem(last=False)
+            return board
+
+    def apply(self, deltas: Iterable[tuple[int, int, int, int, int, int, int]]):
+        # まだ読み込まれていないランキングは、必要になったときにDBから作り直すので無視してよい
+        with self._lock:
+            for guild_id, user_id, channel_id, year, month, connection_time, mic_on_time in deltas:
+                for key in self.keys(guild_id, channel_id, year, month):
+                    board = self._boards.get(key)
+                    if board is not None:
+                        board.add(user_id, connection_time, mic_on_time)
+
+    def invalidate_guild(self, guild_id: int):
+        with self._lock:
+            for key in [key for key in self._boards if key[0] == guild_id]:
+                del self._boards[key]
+
+    def clear(self):
+        with self._lock:
+            self._boards.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._boards),
+                "maxsize": self.maxsize
+            }
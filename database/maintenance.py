@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import time
+from collections import Counter
+from typing import Callable, Mapping
+from . import aio
+from . import crud
+
+logger = logging.getLogger('vampire.database')
+
+
+class MaintenanceJob:
+    # 古いVCの記録の整理と、空いたページの返却を定期的に行う
+    # どの処理も crud の1バッチ (=1トランザクション) ずつ DB スレッドに回し、合間に pause 秒休んで
+    # ボイスのチェックポイントやコマンドの書き込みを先に通す
+    def __init__(self, live_channels: Callable[[], Mapping[int, set[int] | None] | None], interval: float = 3600.0, retention_months: int = 0,
+                 daily_retention_days: int = 400, interval_retention_days: int = 90, batch_size: int = 500, vacuum_pages: int = 256,
+                 pause: float = 0.05, global_cleanup: bool = True, departed_guild_days: float = 0, shard_ids: list[int] = None,
+                 shard_count: int = None):
+        # live_channels: 今いるサーバーごとのボイス/ステージチャンネルのID。取得できないサーバーは None、
+        #                まだ接続が揃っていないなど判断できないときは None を返す
+        self.live_channels = live_channels
+        self.interval = interval
+        self.retention_months = retention_months
+        self.daily_retention_days = daily_retention_days
+        self.interval_retention_days = interval_retention_days
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.pause = pause
+        # 期間での整理と VACUUM はDB全体が対象なので、複数プロセスで動かすときは1プロセスだけが行う
+        self.global_cleanup = global_cleanup
+        # botが抜けたサーバーのデータは、この日数のあいだ続けて見当たらなかったときだけ消す。0 なら消さない
+        # (Discord の障害や権限の変更で一時的に見えないだけのサーバーのデータを消さないように、既定では消さない)
+        self.departed_guild_days = departed_guild_days
+        self.scope = {"shard_ids": shard_ids, "shard_count": shard_count} if shard_ids is not None else {}
+        self.deleted = Counter()
+        self.runs = 0
+        self.failed_runs = 0
+        self.vacuumed_pages = 0
+        self.free_pages = 0
+        # 前回の実行で見当たらなかったチャンネル。2回続けて見当たらなければ消す (一時的に取得できなかっただけのものを消さないように)
+        self._missing_channels: set[tuple[int, int]] = set()
+        # 見当たらないサーバーと、見当たらなくなった時刻 (time.monotonic)。再起動すると数え直すので、消すのが遅れることはあっても早まることはない
+        self._missing_guilds: dict[int, float] = {}
+        self._task = None
+        self._closed = False
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run(), name="database-maintenance")
+
+    async def _run(self):
+        while not self._closed:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception:
+                self.failed_runs += 1
+                logger.exception("Database maintenance failed")
+
+    async def run_once(self):
+        started = time.perf_counter()
+        before = Counter(self.deleted)
+        if self.global_cleanup:
+            await self._drain("monthly", crud.compactVcSummaries, self.retention_months, self.batch_size)
+            await self._drain("daily", crud.purgeVcDailySummaries, self.retention_months, self.daily_retention_days, self.batch_size)
+            await self._drain("intervals", crud.purgeVcIntervals, self.interval_retention_days, self.batch_size)
+        await self._purgeRemoved()
+        if self.global_cleanup:
+            await self._vacuum()
+        self.runs += 1
+        deleted = dict(self.deleted - before)
+        if deleted:
+            logger.info(f"Database maintenance finished in {time.perf_counter() - started:.1f}s: deleted {deleted}, {self.free_pages} free page(s) left")
+        else:
+            logger.debug("Database maintenance finished in %.1fs with nothing to delete", time.perf_counter() - started)
+
+    async def _drain(self, kind: str, func, *args):
+        while not self._closed:
+            deleted = await aio.run(func, *args)
+            if not deleted:
+                return
+            self.deleted[kind] += deleted
+            await asyncio.sleep(self.pause)
+
+    async def _purgeRemoved(self):
+        # DB を読んでから今の状態を見る。逆だと、見た後に作られて記録されたチャンネルを消してしまう
+        stored_channels = await aio.run(crud.readVcChannels, **self.scope)
+        stored_guilds = await aio.run(crud.readGuildIds, **self.scope)
+        live = self.live_channels()
+        if not live:
+            # 接続が揃っていないときや、サーバーが1つも見えないときは何も消さない
+            return
+
+        missing_channels = set()
+        for guild_id, channel_ids in stored_channels.items():
+            if live.get(guild_id) is not None:
+                missing_channels.update((guild_id, channel_id) for channel_id in channel_ids - live[guild_id])
+        deleted_channels = {}
+        for guild_id, channel_id in missing_channels & self._missing_channels:
+            deleted_channels.setdefault(guild_id, []).append(channel_id)
+        self._missing_channels = missing_channels
+        for guild_id, channel_ids in deleted_channels.items():
+            logger.info(f"Purging VC history of {len(channel_ids)} deleted channel(s) in guild_id={guild_id}")
+            await self._drain("channels", crud.purgeVcChannels, guild_id, sorted(channel_ids), self.batch_size)
+
+        now = time.monotonic()
+        self._missing_guilds = {guild_id: self._missing_guilds.get(guild_id, now) for guild_id in stored_guilds if guild_id not in live}
+        if self.departed_guild_days <= 0:
+            return
+        for guild_id, since in list(self._missing_guilds.items()):
+            if now - since < self.departed_guild_days * 86400:
+                continue
+            logger.info(f"Purging data of guild_id={guild_id}, missing for {(now - since) / 86400:.1f} day(s)")
+            await self._drain("guild_members", crud.purgeGuild, guild_id, self.batch_size)
+            if not self._closed:
+                self.deleted["guilds"] += 1
+
+    async def _vacuum(self):
+        while not self._closed:
+            freed, self.free_pages = await aio.run(crud.vacuumStep, self.vacuum_pages)
+            self.vacuumed_pages += freed
+            if not freed or not self.free_pages:
+                return
+            await asyncio.sleep(self.pause)
+
+    async def close(self):
+        self._closed = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,68 @@
+import logging
+import time
+from sqlalchemy import inspect, select, func, insert
+from sqlalchemy.engine import Connection, Engine
+from .models import Base, SchemaVersion
+
+logger = logging.getLogger('vampire.database')
+
+
+def _addRankingIndexes(conn: Connection):
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_vc_summary_rank "
+        "ON vc_summary (id, year, month, channel_id, total_connection_time, total_mic_on_time)"
+    )
+
+
+def _backfillRollups(conn: Connection):
+    # 新しい表は migrate の create_all で作られているので、これまでの月別の集計から年別と全期間の分を作る
+    # 日別の集計は月の中の内訳が残っていないので作れない (これから記録される分だけになる)
+    conn.exec_driver_sql(
+        "INSERT INTO vc_yearly_summary (id, channel_id, year, total_connection_time, total_mic_on_time) "
+        "SELECT id, channel_id, year, SUM(total_connection_time), SUM(total_mic_on_time) "
+        "FROM vc_summary WHERE year IS NOT NULL GROUP BY id, channel_id, year"
+    )
+    conn.exec_driver_sql(
+        "INSERT INTO vc_total_summary (id, channel_id, total_connection_time, total_mic_on_time) "
+        "SELECT id, channel_id, SUM(total_connection_time), SUM(total_mic_on_time) "
+        "FROM vc_summary GROUP BY id, channel_id"
+    )
+
+
+def _addRetention(conn: Connection):
+    conn.exec_driver_sql("ALTER TABLE guilds ADD COLUMN retention_months INTEGER")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_vc_intervals_guild_user_id ON vc_intervals (guild_user_id)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_vc_intervals_end_time ON vc_intervals (end_time)")
+
+
+# (version, 説明, 適用関数) 追加するときは末尾に足していく
+MIGRATIONS = [
+    (1, "add covering index for vc ranking queries", _addRankingIndexes),
+    (2, "add vc interval log and daily/yearly/all-time rollups", _backfillRollups),
+    (3, "add per-guild retention and vc_intervals indexes", _addRetention),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def currentVersion(conn: Connection) -> int:
+    return conn.execute(select(func.coalesce(func.max(SchemaVersion.version), 0))).scalar_one()
+
+
+def migrate(engine: Engine):
+    fresh = not inspect(engine).has_table("guilds")
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        if fresh:
+            # create_all で最新のスキーマができているので、マイグレーションは適用済みとして記録するだけ
+            conn.execute(insert(SchemaVersion), [{"version": version, "applied_at": int(time.time())} for version, _, _ in MIGRATIONS])
+            logger.info(f"Initialized new database at schema version {LATEST_VERSION}")
+            return
+        version = currentVersion(conn)
+        for target, description, apply in MIGRATIONS:
+            if target <= version:
+                continue
+            logger.info(f"Applying migration {target}: {description}")
+            apply(conn)
+            conn.execute(insert(SchemaVersion).values(version=target, applied_at=int(time.time())))
+        if version < LATEST_VERSION:
+            logger.info(f"Database migrated from version {version} to {LATEST_VERSION}")
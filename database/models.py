@@ -1,5 +1,5 @@
 from sqlalchemy import (
-    Column, Integer, ForeignKey, String, TIMESTAMP, create_engine, PrimaryKeyConstraint, UniqueConstraint
+    Column, Integer, ForeignKey, String, TIMESTAMP, create_engine, Index, PrimaryKeyConstraint, UniqueConstraint
 )
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
@@ -19,6 +19,8 @@ class Guild(ReprMixin, Base):
     __tablename__ = "guilds"
     guild_id = Column(Integer, primary_key=True)
     notification_channel = Column(Integer, nullable=True)
+    # 月別・日別のVC集計を残す月数。NULL なら VC_RETENTION_MONTHS、0 なら消さない
+    retention_months = Column(Integer, nullable=True)
 
 class User(ReprMixin, Base):
     __tablename__ = "users"
@@ -47,6 +49,58 @@ class VCSummary(ReprMixin, Base):
     total_mic_on_time = Column(Integer, default=0)
     __table_args__ = (
         PrimaryKeyConstraint("id", "channel_id", "year", "month"),
+        # ランキング/集計用の被覆インデックス (guild_users 側は _guild_user_uc が guild_id -> id を被覆している)
+        Index("ix_vc_summary_rank", "id", "year", "month", "channel_id", "total_connection_time", "total_mic_on_time"),
+    )
+
+class VCDailySummary(ReprMixin, Base):
+    __tablename__ = "vc_daily_summary"
+    id = Column(Integer, ForeignKey("guild_users.id", ondelete="CASCADE"), nullable=False)
+    channel_id = Column(Integer, nullable=False)
+    year = Column(Integer, nullable=False)
+    month = Column(Integer, nullable=False)
+    day = Column(Integer, nullable=False)
+    total_connection_time = Column(Integer, default=0)
+    total_mic_on_time = Column(Integer, default=0)
+    __table_args__ = (
+        PrimaryKeyConstraint("id", "channel_id", "year", "month", "day"),
+    )
+
+class VCYearlySummary(ReprMixin, Base):
+    __tablename__ = "vc_yearly_summary"
+    id = Column(Integer, ForeignKey("guild_users.id", ondelete="CASCADE"), nullable=False)
+    channel_id = Column(Integer, nullable=False)
+    year = Column(Integer, nullable=False)
+    total_connection_time = Column(Integer, default=0)
+    total_mic_on_time = Column(Integer, default=0)
+    __table_args__ = (
+        PrimaryKeyConstraint("id", "channel_id", "year"),
+        Index("ix_vc_yearly_summary_rank", "id", "year", "channel_id", "total_connection_time", "total_mic_on_time"),
+    )
+
+class VCTotalSummary(ReprMixin, Base):
+    __tablename__ = "vc_total_summary"
+    id = Column(Integer, ForeignKey("guild_users.id", ondelete="CASCADE"), nullable=False)
+    channel_id = Column(Integer, nullable=False)
+    total_connection_time = Column(Integer, default=0)
+    total_mic_on_time = Column(Integer, default=0)
+    __table_args__ = (
+        PrimaryKeyConstraint("id", "channel_id"),
+        Index("ix_vc_total_summary_rank", "id", "channel_id", "total_connection_time", "total_mic_on_time"),
+    )
+
+class VCInterval(ReprMixin, Base):
+    __tablename__ = "vc_intervals"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    guild_user_id = Column(Integer, ForeignKey("guild_users.id", ondelete="CASCADE"), nullable=False)
+    channel_id = Column(Integer, nullable=False)
+    start_time = Column(Integer, nullable=False)
+    end_time = Column(Integer, nullable=False)
+    mic_on = Column(Integer, nullable=False)
+    __table_args__ = (
+        # 外部キーの CASCADE で guild_users から消すときと、保存期間を過ぎた区間を消すときに使う
+        Index("ix_vc_intervals_guild_user_id", "guild_user_id"),
+        Index("ix_vc_intervals_end_time", "end_time"),
     )
 
 class VCSession(ReprMixin, Base):
@@ -58,3 +112,20 @@ class VCSession(ReprMixin, Base):
     __table_args__ = (
         PrimaryKeyConstraint("id", "channel_id"),
     )
+
+
+class GuildMemeRule(ReprMixin, Base):
+    __tablename__ = "meme_rules"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    guild_id = Column(Integer, ForeignKey("guilds.guild_id", ondelete="CASCADE"), nullable=False)
+    trigger = Column(String, nullable=False)
+    mode = Column(String, nullable=False, default="exact")
+    responses = Column(String, nullable=False)
+    __table_args__ = (
+        UniqueConstraint("guild_id", "trigger", "mode", name="_meme_rule_uc"),
+    )
+
+class SchemaVersion(ReprMixin, Base):
+    __tablename__ = "schema_version"
+    version = Column(Integer, primary_key=True)
+    applied_at = Column(Integer, nullable=False)
@@ -0,0 +1,35 @@
+from datetime import datetime, timezone
+
+DAY_SECONDS = 86400
+
+
+def splitInterval(start_time: int, end_time: int):
+    # [start_time, end_time) を UTC の日付の境目で区切って (year, month, day, 秒数) を順に返す
+    # 月や年の境目も日付の境目なので、日をまたいだ区間もそれぞれの日/月/年に正しく振り分けられる
+    while start_time < end_time:
+        piece_end = min(end_time, start_time - start_time % DAY_SECONDS + DAY_SECONDS)
+        date = datetime.fromtimestamp(start_time, timezone.utc)
+        yield date.year, date.month, date.day, piece_end - start_time
+        start_time = piece_end
+
+
+class VCRollup:
+    # 閉じた区間を 日/月/年/全期間 ごとに足し合わせる
+    # owner はどの行に足すかを表すタプル (crud では (guild_user_id, guild_id, user_id, channel_id))
+    def __init__(self):
+        self.daily: dict[tuple, list[int]] = {}
+        self.monthly: dict[tuple, list[int]] = {}
+        self.yearly: dict[tuple, list[int]] = {}
+        self.total: dict[tuple, list[int]] = {}
+
+    def add(self, owner: tuple, start_time: int, end_time: int, mic_on: bool):
+        for year, month, day, seconds in splitInterval(start_time, end_time):
+            mic_on_time = seconds if mic_on else 0
+            for totals, key in ((self.daily, (*owner, year, month, day)), (self.monthly, (*owner, year, month)),
+                                (self.yearly, (*owner, year)), (self.total, owner)):
+                entry = totals.get(key)
+                if entry is None:
+                    totals[key] = [seconds, mic_on_time]
+                else:
+                    entry[0] += seconds
+                    entry[1] += mic_on_time
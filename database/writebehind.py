@@ -0,0 +1,222 @@
+import asyncio
+import logging
+import time
+from abc import ABC, abstractmethod
+from collections import Counter
+from . import aio
+from . import crud
+
+logger = logging.getLogger('vampire.database')
+
+
+class WriteBehindBuffer(ABC):
+    name = "write-behind"
+
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self._wakeup = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = None
+        self._closed = False
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name=self.name)
+
+    async def _run(self):
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception(f"Failed to flush {self.name}")
+
+    @abstractmethod
+    async def flush(self):
+        ...
+
+    async def close(self):
+        self._closed = True
+        self._wakeup.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+        try:
+            await self.flush()
+        except Exception:
+            # 終了処理の残りを止めないように、書けなかったことだけ残して続ける
+            logger.exception(f"Failed to drain {self.name}")
+            return
+        logger.info(f"{self.name} drained")
+
+
+class VoiceSessionTracker(WriteBehindBuffer):
+    name = "voice-session-tracker"
+
+    def __init__(self, startup_time: int, checkpoint_size: int = 1000, checkpoint_interval: float = 30.0, max_retries: int = 3):
+        super().__init__(checkpoint_interval)
+        self.startup_time = startup_time
+        self.checkpoint_size = checkpoint_size
+        # 続けてこの回数失敗したら、書けない行を探して捨てる
+        self.max_retries = max_retries
+        # (guild_id, user_id, channel_id) -> (区間の開始時刻, mic_on)
+        self._active: dict[tuple[int, int, int], tuple[int, bool]] = {}
+        # 閉じた区間の (guild_id, user_id, channel_id, start_time, end_time, mic_on)。日付の境目での振り分けは書き込むときに行う
+        self._intervals: list[tuple[int, int, int, int, int, bool]] = []
+        # 前回のチェックポイントから vc_sessions の行が変わったキー
+        self._dirty: set[tuple[int, int, int]] = set()
+        self.checkpoints = 0
+        self.failed_checkpoints = 0
+        self.dropped_rows = 0
+        self._retries = 0
+
+    def __len__(self):
+        return len(self._active)
+
+    @property
+    def pending(self):
+        return len(self._dirty) + len(self._intervals)
+
+    @property
+    def guild_ids(self) -> set[int]:
+        return {guild_id for guild_id, _, _ in self._active}
+
+    async def load(self, shard_ids: list[int] = None, shard_count: int = None):
+        # 前回落ちたときに開いていたセッションを引き継ぐ。イベントを受け始める前 (setup_hook) に呼ぶ
+        # シャードごとに別プロセスで動かすときは、自分のシャードのサーバーの分だけを読む
+        rows = await aio.run(crud.readVcSessions, shard_ids, shard_count)
+        for guild_id, user_id, channel_id, event_time, mic_on in rows:
+            self._active.setdefault((guild_id, user_id, channel_id), (event_time, mic_on))
+        logger.info(f"Loaded {len(rows)} open VC sessions")
+
+    def add(self, guild_id: int, user_id: int, channel_id: int, mic_on: bool, event_time: int = None):
+        self._check_open()
+        event_time = event_time or int(time.time())
+        key = (guild_id, user_id, channel_id)
+        if key in self._active:
+            self._close(key, event_time)
+        self._active[key] = (event_time, bool(mic_on))
+        self._touch(key)
+
+    def end(self, guild_id: int, user_id: int, channel_id: int, mic_on: bool, event_time: int = None):
+        self._check_open()
+        event_time = event_time or int(time.time())
+        key = (guild_id, user_id, channel_id)
+        if key in self._active:
+            self._close(key, event_time)
+        else:
+            # 起動前から接続していた人など、開始が分からないときは起動時刻から数える
+            self._intervals.append((*key, self.startup_time, event_time, bool(mic_on)))
+        self._touch(key)
+
+    def reconcile(self, voice_states, guild_ids=None) -> tuple[int, int, int]:
+        # voice_states は今VCにいる (guild_id, user_id, channel_id, mic_on) の一覧
+        # 同じ状態で残っているセッションはそのまま続け、いなくなった/状態が変わったものは閉じ、足りないものを開く
+        # guild_ids を渡すと、そのサーバーのセッションだけを突き合わせる (1つのシャードが再接続したときなど)
+        self._check_open()
+        event_time = int(time.time())
+        current = {(guild_id, user_id, channel_id): bool(mic_on) for guild_id, user_id, channel_id, mic_on in voice_states}
+        closed = 0
+        for key, (_, mic_on) in list(self._active.items()):
+            if guild_ids is not None and key[0] not in guild_ids:
+                continue
+            if current.get(key) != mic_on:
+                self._close(key, event_time)
+                self._dirty.add(key)
+                closed += 1
+        opened = 0
+        for key, mic_on in current.items():
+            if key not in self._active:
+                self._active[key] = (event_time, mic_on)
+                self._dirty.add(key)
+                opened += 1
+        return len(current) - opened, closed, opened
+
+    def _check_open(self):
+        if self._closed:
+            raise RuntimeError("VoiceSessionTracker is closed")
+
+    def _close(self, key: tuple[int, int, int], event_time: int):
+        since, mic_on = self._active.pop(key)
+        self._intervals.append((*key, since, event_time, mic_on))
+
+    def _touch(self, key: tuple[int, int, int]):
+        self._dirty.add(key)
+        if self.pending >= self.checkpoint_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        async with self._lock:
+            if not self._dirty and not self._intervals:
+                return
+            # ここから await するまでに取った内容を書く。書いている間の変更は次のチェックポイントに回る
+            intervals, self._intervals = self._intervals, []
+            dirty, self._dirty = self._dirty, set()
+            opened = [(*key, *self._active[key]) for key in dirty if key in self._active]
+            ended = [key for key in dirty if key not in self._active]
+            try:
+                await aio.run(crud.checkpointVcSessions, intervals, opened, ended)
+                self.checkpoints += 1
+                self._retries = 0
+                return
+            except Exception:
+                self.failed_checkpoints += 1
+                self._retries += 1
+                if self._retries < self.max_retries and not self._closed:
+                    # DB が一時的に使えないだけかもしれないので、何回かはそのまま次回に持ち越す
+                    logger.exception(f"Voice checkpoint failed ({self._retries}/{self.max_retries}), retrying {len(intervals) + len(dirty)} row(s) later")
+                    self._intervals[:0] = intervals
+                    self._dirty |= dirty
+                    return
+                logger.exception(f"Voice checkpoint failed {self._retries} time(s), writing {len(intervals) + len(dirty)} row(s) in smaller batches")
+            # 何度も失敗するときは書けない行が混ざっている。持ち越し続けると後のチェックポイントがすべて失敗して溜まる一方になるので、
+            # 分けて書いて書けない行だけを捨てる
+            self._retries = 0
+            await self._checkpointSplit(intervals, opened, ended)
+
+    async def _checkpointSplit(self, intervals: list, opened: list, ended: list):
+        # 3つの一覧を (種類, 行) の1列に並べて半分ずつにしていき、1行でも書けないものは捨てる
+        pending = [[(0, row) for row in intervals] + [(1, row) for row in opened] + [(2, row) for row in ended]]
+        while pending:
+            part = pending.pop()
+            batch = ([], [], [])
+            for kind, row in part:
+                batch[kind].append(row)
+            try:
+                await aio.run(crud.checkpointVcSessions, *batch)
+            except Exception:
+                if len(part) == 1:
+                    self.dropped_rows += 1
+                    logger.exception(f"Dropping voice checkpoint row: {part[0][1]}")
+                else:
+                    pending += [part[len(part) // 2:], part[:len(part) // 2]]
+
+
+class CommandCounter(WriteBehindBuffer):
+    name = "command-counter"
+
+    def __init__(self, flush_interval: float = 30.0):
+        super().__init__(flush_interval)
+        self._counts = Counter()
+
+    def __len__(self):
+        return len(self._counts)
+
+    def increment(self, user_id: int, amount: int = 1):
+        self._counts[user_id] += amount
+
+    async def flush(self):
+        async with self._lock:
+            if not self._counts:
+                return
+            counts, self._counts = self._counts, Counter()
+            try:
+                await aio.run(crud.addUserCounts, dict(counts))
+            except Exception:
+                # 書き込めなかった分は次回に持ち越す
+                self._counts.update(counts)
+                raise
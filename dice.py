@@ -0,0 +1,124 @@
+import asyncio
+import math
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import discord
+from discord import app_commands
+
+# これ以下の回数は1個ずつ振る
+DIRECT_LIMIT = 64
+# 面の数がこれ以下なら、出た目ごとの個数を二項分布で順に決めて正確に合計を出す (面の数に比例した時間)
+MULTINOMIAL_SIDES = 4096
+# 回数がこれ以下なら、まとめて振って正確に合計を出す (回数に比例した時間)
+CHUNKED_LIMIT = 1 << 16
+CHUNK_SIZE = 1 << 12
+# random.choices は浮動小数点で目を選ぶので、面の数がこれより多いときは randrange で振る
+CHOICES_SIDES = 1 << 32
+# randrange で振るのはこの回数まで。それより多いときは正規分布で近似する
+LARGE_SIDE_LIMIT = 4096
+# オプションの桁数の上限。結果は 2 * MAX_DIGITS 桁以下になるので Discord の2000文字に収まる
+MAX_DIGITS = 900
+
+
+def _rollDirect(rng: random.Random, roll: int, side: int) -> int:
+    return sum(rng.randrange(side) for _ in range(roll)) + roll
+
+
+def _rollMultinomial(rng: random.Random, roll: int, side: int) -> int:
+    # 1 の目の個数、残りのうち 2 の目の個数、... と順に決めると多項分布から正確にサンプリングできる
+    total = 0
+    remaining = roll
+    for face in range(1, side):
+        if remaining == 0:
+            break
+        count = rng.binomialvariate(remaining, 1 / (side - face + 1))
+        total += face * count
+        remaining -= count
+    return total + side * remaining
+
+
+def _rollChunked(rng: random.Random, roll: int, side: int) -> int:
+    total = 0
+    faces = range(1, side + 1)
+    while roll > 0:
+        k = min(roll, CHUNK_SIZE)
+        total += sum(rng.choices(faces, k=k))
+        roll -= k
+    return total
+
+
+def _rollNormal(rng: random.Random, roll: int, side: int) -> int:
+    # 回数が十分多いので中心極限定理で正規分布に近似する。
+    # 平均と分散は整数のまま計算して、桁数がいくら大きくても精度が落ちないようにする
+    doubled_mean = roll * (side + 1)
+    variance_12 = roll * (side * side - 1)
+    scale = 64
+    sd = math.isqrt((variance_12 << (2 * scale)) // 12)
+    z = int(rng.gauss(0.0, 1.0) * (1 << 53))
+    offset = (z * sd) >> (scale + 53)
+    # 浮動小数点の精度より下の桁は一様な乱数で埋める
+    noise_bits = (sd >> scale).bit_length() - 53
+    if noise_bits > 0:
+        offset += rng.getrandbits(noise_bits) - (1 << (noise_bits - 1))
+    result = (doubled_mean >> 1) + offset
+    if doubled_mean & 1 and rng.getrandbits(1):
+        result += 1
+    return min(max(result, roll), roll * side)
+
+
+def rollSum(roll: int, side: int, rng: random.Random = random) -> int:
+    if roll <= 0 or side <= 0:
+        raise ValueError("roll and side must be positive")
+    if side == 1:
+        return roll
+    if roll <= DIRECT_LIMIT:
+        return _rollDirect(rng, roll, side)
+    if side <= MULTINOMIAL_SIDES and roll < (1 << 53):
+        return _rollMultinomial(rng, roll, side)
+    if roll <= CHUNKED_LIMIT and side <= CHOICES_SIDES:
+        return _rollChunked(rng, roll, side)
+    if roll <= LARGE_SIDE_LIMIT:
+        return _rollDirect(rng, roll, side)
+    return _rollNormal(rng, roll, side)
+
+
+_local = threading.local()
+
+
+def _rollInThread(roll: int, side: int) -> int:
+    # モジュールの random はスレッド間で共有されていて gauss() はスレッドセーフではないので、ワーカーごとに別の Random を使う
+    rng = getattr(_local, "rng", None)
+    if rng is None:
+        rng = _local.rng = random.Random()
+    return rollSum(roll, side, rng)
+
+
+class DiceEngine:
+    def __init__(self, max_workers: int = 2):
+        # asyncio.to_thread の既定のスレッドプールとは分けて、重い計算が他の処理を待たせないようにする
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="vampire-dice")
+
+    async def roll(self, roll: int, side: int) -> int:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, _rollInThread, roll, side)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class BigIntTransformer(app_commands.Transformer):
+    # Discord の integer オプションは 2^53 までなので、文字列で受け取って Python の int にする
+    # 整数として読めない値や桁数が多すぎる値は None にして、コマンド側でメッセージを返す
+    @property
+    def type(self):
+        return discord.AppCommandOptionType.string
+
+    async def transform(self, interaction, value: str):
+        text = value.strip().replace(",", "").replace("_", "")
+        if len(text) > MAX_DIGITS + 1:
+            return None
+        try:
+            return int(text)
+        except ValueError:
+            return None
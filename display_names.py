@@ -0,0 +1,74 @@
+import asyncio
+import logging
+import time
+from typing import Iterable
+import discord
+from database.cache import LRUCache
+
+logger = logging.getLogger('vampire.display_names')
+
+UNKNOWN_NAME = "unknown"
+
+
+class DisplayNameResolver:
+    def __init__(self, ttl: float = 600.0, maxsize: int = 16384, concurrency: int = 5):
+        self.ttl = ttl
+        self.concurrency = concurrency
+        # (guild_id, user_id) -> (display_name, 期限)
+        self._cache = LRUCache(maxsize=maxsize)
+
+    def remember(self, member: discord.Member):
+        self._put(member.guild.id, member.id, member.display_name)
+
+    def _put(self, guild_id: int, user_id: int, name: str):
+        self._cache.put((guild_id, user_id), (name, time.monotonic() + self.ttl))
+
+    def get(self, guild_id: int, user_id: int):
+        cached = self._cache.get((guild_id, user_id))
+        if cached is None:
+            return None
+        name, expires_at = cached
+        if expires_at < time.monotonic():
+            self._cache.invalidate((guild_id, user_id))
+            return None
+        return name
+
+    async def resolve(self, guild: discord.Guild, user_ids: Iterable[int]) -> dict[int, str]:
+        names = {}
+        misses = []
+        for user_id in dict.fromkeys(user_ids):
+            name = self.get(guild.id, user_id)
+            if name is None:
+                member = guild.get_member(user_id)
+                if member is not None:
+                    self._put(guild.id, user_id, member.display_name)
+                    name = member.display_name
+            if name is None:
+                misses.append(user_id)
+            else:
+                names[user_id] = name
+
+        if misses:
+            semaphore = asyncio.Semaphore(self.concurrency)
+
+            async def fetch(user_id: int):
+                async with semaphore:
+                    try:
+                        member = await guild.fetch_member(user_id)
+                    except discord.NotFound:
+                        # サーバーから抜けた人。何度も問い合わせないように unknown として覚えておく
+                        self._put(guild.id, user_id, UNKNOWN_NAME)
+                        return UNKNOWN_NAME
+                    except discord.HTTPException as e:
+                        logger.warning(f"Failed to fetch member user_id={user_id} in guild_id={guild.id}: {e}")
+                        return UNKNOWN_NAME
+                self._put(guild.id, user_id, member.display_name)
+                return member.display_name
+
+            fetched = await asyncio.gather(*(fetch(user_id) for user_id in misses))
+            names.update(zip(misses, fetched))
+            logger.debug("Resolved %d display names by REST in guild_id=%s", len(misses), guild.id)
+        return names
+
+    def stats(self):
+        return self._cache.stats()
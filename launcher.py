@@ -0,0 +1,166 @@
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import discord
+from dotenv import load_dotenv
+
+logger = logging.getLogger('vampire.launcher')
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# Discord は max_concurrency 個の IDENTIFY を5秒に1回まで受け付ける
+IDENTIFY_INTERVAL = 5.0
+RESTART_MAX_DELAY = 60.0
+RESTART_RESET = 300.0
+
+
+def split_shards(shard_count: int, processes: int) -> list[list[int]]:
+    # 連続した範囲に分ける。余りは前のプロセスから1つずつ多く持つ
+    processes = max(1, min(processes, shard_count))
+    size, extra = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for index in range(processes):
+        end = start + size + (1 if index < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+def format_shard_ids(shard_ids: list[int]) -> str:
+    return f"{shard_ids[0]}-{shard_ids[-1]}" if len(shard_ids) > 1 else str(shard_ids[0])
+
+
+async def fetch_recommended_shards(token: str) -> tuple[int, int]:
+    http = discord.http.HTTPClient()
+    try:
+        await http.static_login(token)
+        shards, _, session_start_limit = await http.get_bot_gateway()
+    finally:
+        await http.close()
+    return shards, session_start_limit.get("max_concurrency", 1)
+
+
+class Worker:
+    def __init__(self, index: int, shard_ids: list[int], shard_count: int, environ: dict):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.environ = environ
+        self.process = None
+        self.started_at = 0.0
+        self.restarts = 0
+        self.restart_at = None
+
+    def start(self):
+        env = dict(self.environ, SHARD_COUNT=str(self.shard_count), SHARD_IDS=format_shard_ids(self.shard_ids), LOG_FILE=f"log/vampire-{self.index}.log",
+                   ERROR_LOG_FILE=f"log/error-{self.index}.log")
+        # メトリクスの出力先はプロセスごとに分ける
+        if env.get("METRICS_PORT", "0") not in ("", "0"):
+            env["METRICS_PORT"] = str(int(env["METRICS_PORT"]) + self.index)
+        if env.get("METRICS_FILE"):
+            base, ext = os.path.splitext(env["METRICS_FILE"])
+            env["METRICS_FILE"] = f"{base}-{self.index}{ext}"
+        # Ctrl+C がワーカーに直接届かないようにし、止めるときは launcher から順に送る
+        self.process = subprocess.Popen([sys.executable, os.path.join(ROOT, "main.py")], cwd=ROOT, env=env, start_new_session=os.name != "nt")
+        self.started_at = time.monotonic()
+        self.restart_at = None
+        logger.info(f"Started worker {self.index} (pid={self.process.pid}) for shards {format_shard_ids(self.shard_ids)}/{self.shard_count}")
+
+    def stop(self):
+        if self.process is None or self.process.poll() is not None:
+            return
+        if os.name == "nt":
+            self.process.terminate()
+        else:
+            # main.py は KeyboardInterrupt を受けて VC セッションを閉じてから終了する
+            self.process.send_signal(signal.SIGINT)
+
+
+def run(args):
+    load_dotenv()
+    token = os.getenv("DISCORD_TOKEN")
+    shard_count = args.shards or int(os.getenv("SHARD_COUNT", "0"))
+    max_concurrency = args.max_concurrency
+    if not shard_count:
+        if not token:
+            raise SystemExit("DISCORD_TOKEN is not set and --shards was not given.")
+        shard_count, max_concurrency = asyncio.run(fetch_recommended_shards(token))
+        logger.info(f"Discord recommends {shard_count} shard(s), max_concurrency={max_concurrency}")
+
+    environ = dict(os.environ)
+    environ.pop("SHARD_IDS", None)
+    workers = [Worker(index, shard_ids, shard_count, environ) for index, shard_ids in enumerate(split_shards(shard_count, args.processes))]
+
+    stopping = False
+
+    def request_stop(signum, frame):
+        nonlocal stopping
+        if not stopping:
+            logger.info("Stopping workers")
+        stopping = True
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    for index, worker in enumerate(workers):
+        if stopping:
+            break
+        worker.start()
+        if index + 1 < len(workers):
+            # 次のプロセスの IDENTIFY がこのプロセスのシャードとぶつからないように間を空ける
+            wait_until = time.monotonic() + len(worker.shard_ids) * IDENTIFY_INTERVAL / max_concurrency
+            while not stopping and time.monotonic() < wait_until:
+                time.sleep(0.2)
+
+    while not stopping:
+        now = time.monotonic()
+        for worker in workers:
+            if worker.process is None:
+                continue
+            if worker.restart_at is not None:
+                if now >= worker.restart_at:
+                    worker.start()
+                continue
+            code = worker.process.poll()
+            if code is None:
+                continue
+            # しばらく動いていたなら、続けて落ちたわけではないので待ち時間を戻す
+            worker.restarts = 1 if now - worker.started_at > RESTART_RESET else worker.restarts + 1
+            delay = min(RESTART_MAX_DELAY, 2.0 ** worker.restarts)
+            worker.restart_at = now + delay
+            logger.warning(f"Worker {worker.index} exited with code {code}, restarting in {delay:.0f}s")
+        time.sleep(1.0)
+
+    for worker in workers:
+        worker.stop()
+    deadline = time.monotonic() + args.grace
+    for worker in workers:
+        if worker.process is None or worker.restart_at is not None:
+            continue
+        try:
+            worker.process.wait(timeout=max(0.0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            logger.warning(f"Worker {worker.index} did not stop within {args.grace:.0f}s, killing it")
+            worker.process.kill()
+            worker.process.wait()
+    logger.info("All workers stopped")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the bot as several processes, each with its own range of shards.")
+    parser.add_argument("--shards", type=int, default=0, help="total number of shards (default: SHARD_COUNT or Discord's recommendation)")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--max-concurrency", type=int, default=1, help="IDENTIFY max_concurrency when --shards is given")
+    parser.add_argument("--grace", type=float, default=30.0, help="seconds to wait for workers to shut down")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(levelname)-8s] %(name)s: %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
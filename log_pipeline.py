@@ -0,0 +1,72 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+from typing import Iterable
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    # 標準の QueueHandler は別プロセスに渡すためにここでメッセージを組み立ててしまうので、
+    # 同じプロセスのスレッドに渡すだけのこのbotではレコードをそのまま渡して、組み立ても出力スレッドでやる
+    def prepare(self, record):
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    # rate の割合だけ通す (1.0 で全部、0.1 で10件に1件、0 で全部捨てる)。WARNING 以上は常に通す
+    def __init__(self, rate: float = 1.0):
+        super().__init__()
+        self.rate = min(max(rate, 0.0), 1.0)
+        self._credit = 0.0
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.rate >= 1.0:
+            return True
+        with self._lock:
+            self._credit += self.rate
+            if self._credit >= 1.0:
+                self._credit -= 1.0
+                return True
+            self.dropped += 1
+            return False
+
+
+class LazyStr:
+    # ログが実際に出力されるときだけ func(*args) を呼ぶ
+    __slots__ = ("func", "args")
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+class LogPipeline:
+    def __init__(self, handlers: Iterable[logging.Handler]):
+        self.queue = queue.SimpleQueue()
+        self.handler = LazyQueueHandler(self.queue)
+        self.listener = logging.handlers.QueueListener(self.queue, *handlers, respect_handler_level=True)
+        self._started = False
+
+    def start(self, logger: logging.Logger = None):
+        (logger or logging.getLogger()).addHandler(self.handler)
+        self.listener.start()
+        self._started = True
+        # shutdown() を通らずに終了したときもキューに残ったログを書き出す
+        atexit.register(self.stop)
+
+    def stop(self):
+        # 溜まっているログを全部出力してから止まる
+        if self._started:
+            self._started = False
+            self.listener.stop()
+
+    def sample(self, name: str, rate: float) -> SamplingFilter:
+        sampling = SamplingFilter(rate)
+        logging.getLogger(name).addFilter(sampling)
+        return sampling
@@ -8,14 +8,28 @@ import json
 import uuid
 import traceback
 import asyncio
+import functools
+import inspect
 import logging
 import logging.handlers
+import math
+from collections import Counter
 from rich.logging import RichHandler
-from datetime import datetime
+from log_pipeline import LazyStr, LogPipeline
+from datetime import datetime, timezone
 from version import VERSION
-from database import init_db
+from database import engine, init_db
 import database.crud as crud
-from database.crud import get_session
+import database.aio as db
+from database.export import ExportWriter
+from database.maintenance import MaintenanceJob
+from database.writebehind import CommandCounter, VoiceSessionTracker
+from display_names import DisplayNameResolver
+from dice import MAX_DIGITS, BigIntTransformer, DiceEngine
+from memes import GUILD_MODES, MemeEngine, MemeFileWatcher, MemeRule, loadMemeFile
+from metrics import MetricsExporter, instrumentEngine, registry
+from command_sync import CommandTreeSyncer
+from notifications import NotificationDispatcher
 
 load_dotenv()
 
@@ -26,13 +40,46 @@ FILE_LEVEL_NAME = os.getenv("FILE_LOG_LEVEL", "DEBUG").upper()
 LEVEL_NAME = os.getenv("LOG_LEVEL", "INFO").upper()
 ADVANCED_LEVEL_NAME = os.getenv("ADVANCED_LOG_LEVEL", "WARNING").upper()
 EVENT_LEVEL_NAME = os.getenv("EVENT_LOG_LEVEL", "INFO").upper()
+VOICE_LOG_SAMPLE_RATE = float(os.getenv("VOICE_LOG_SAMPLE_RATE", "1.0"))
+DB_SESSION_LOG_SAMPLE_RATE = float(os.getenv("DB_SESSION_LOG_SAMPLE_RATE", "1.0"))
+VOICE_CHECKPOINT_INTERVAL = float(os.getenv("VOICE_CHECKPOINT_INTERVAL", "30.0"))
+VOICE_CHECKPOINT_SIZE = int(os.getenv("VOICE_CHECKPOINT_SIZE", "1000"))
+COMMAND_COUNT_FLUSH_INTERVAL = float(os.getenv("COMMAND_COUNT_FLUSH_INTERVAL", "30.0"))
+VC_RANK_PAGE_SIZE = int(os.getenv("VC_RANK_PAGE_SIZE", "10"))
+DISPLAY_NAME_TTL = float(os.getenv("DISPLAY_NAME_TTL", "600"))
+MEMBER_FETCH_CONCURRENCY = int(os.getenv("MEMBER_FETCH_CONCURRENCY", "5"))
+MEME_RULES_PER_GUILD = int(os.getenv("MEME_RULES_PER_GUILD", "200"))
+MEMES_PATH = "messages/memes.json"
+MEMES_RELOAD_INTERVAL = float(os.getenv("MEMES_RELOAD_INTERVAL", "5"))
+DICE_WORKERS = int(os.getenv("DICE_WORKERS", "2"))
+NOTIFY_WINDOW = float(os.getenv("NOTIFY_WINDOW", "1.5"))
+NOTIFY_MAX_PENDING = int(os.getenv("NOTIFY_MAX_PENDING", "200"))
+METRICS_FILE = os.getenv("METRICS_FILE", "")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", "15"))
+SHARDED = os.getenv("SHARDED", "false").lower() in ("1", "true", "yes")
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) or None
+SHARD_IDS = os.getenv("SHARD_IDS", "")
+LOG_FILE = os.getenv("LOG_FILE", "log/vampire.log")
+ERROR_LOG_FILE = os.getenv("ERROR_LOG_FILE", "log/error.log")
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "1000"))
+EXPORT_MAX_FILES = int(os.getenv("EXPORT_MAX_FILES", "10"))
+MAINTENANCE_INTERVAL = float(os.getenv("MAINTENANCE_INTERVAL", "3600"))
+VC_RETENTION_MONTHS = int(os.getenv("VC_RETENTION_MONTHS", "0"))
+VC_DAILY_RETENTION_DAYS = int(os.getenv("VC_DAILY_RETENTION_DAYS", "400"))
+VC_INTERVAL_RETENTION_DAYS = int(os.getenv("VC_INTERVAL_RETENTION_DAYS", "90"))
+DEPARTED_GUILD_PURGE_DAYS = float(os.getenv("DEPARTED_GUILD_PURGE_DAYS", "0"))
+MAINTENANCE_BATCH_SIZE = int(os.getenv("MAINTENANCE_BATCH_SIZE", "500"))
+VACUUM_STEP_PAGES = int(os.getenv("VACUUM_STEP_PAGES", "256"))
+COMMAND_SYNC_STATE_PATH = os.getenv("COMMAND_SYNC_STATE_PATH", "command_sync.json")
+FORCE_COMMAND_SYNC = os.getenv("FORCE_COMMAND_SYNC", "false").lower() in ("1", "true", "yes")
 CONSOLE_LOG_LEVEL = getattr(logging, CONSOLE_LEVEL_NAME, logging.INFO)
 FILE_LOG_LEVEL = getattr(logging, FILE_LEVEL_NAME, logging.DEBUG)
 LOG_LEVEL = getattr(logging, LEVEL_NAME, logging.DEBUG)
 ADVANCED_LOG_LEVEL = getattr(logging, ADVANCED_LEVEL_NAME, logging.INFO)
 EVENT_LOG_LEVEL = getattr(logging, EVENT_LEVEL_NAME, logging.INFO)
 startup_time = int(time.time())
-memes_enabled = True
+process_started = time.perf_counter()
 
 # logging setting reset
 root = logging.getLogger()
@@ -51,26 +98,29 @@ console_handler = RichHandler(
 )
 console_handler.setLevel(CONSOLE_LOG_LEVEL)
 console_handler.setFormatter(logging.Formatter(LOG_CONSOLE_FMT, DATE_FMT))
-root.addHandler(console_handler)
 
 # log file
 file_handler = logging.handlers.RotatingFileHandler(
-    filename='log/vampire.log',
+    filename=LOG_FILE,
     encoding='utf-8',
     maxBytes=32 * 1024 * 1024,
     backupCount=7,
 )
 file_handler.setLevel(FILE_LOG_LEVEL)
 file_handler.setFormatter(logging.Formatter(LOG_FILE_FMT, DATE_FMT))
-root.addHandler(file_handler)  
 
 error_handler = logging.handlers.RotatingFileHandler(
-    filename='log/error.log',
+    filename=ERROR_LOG_FILE,
     encoding='utf-8',
 )
 error_handler.setLevel(logging.ERROR)
 error_handler.setFormatter(logging.Formatter(LOG_FILE_FMT, DATE_FMT))
-root.addHandler(error_handler)
+
+# 出力はキュー経由で別スレッドに任せて、イベントループではレコードを積むだけにする
+log_pipeline = LogPipeline([console_handler, file_handler, error_handler])
+log_pipeline.start(root)
+log_pipeline.sample('vampire.voice', VOICE_LOG_SAMPLE_RATE)
+log_pipeline.sample('vampire.database.session', DB_SESSION_LOG_SAMPLE_RATE)
 
 # Discord log setting
 discord_logger = logging.getLogger('discord')
@@ -89,59 +139,244 @@ logging.getLogger('sqlalchemy.orm').setLevel(ADVANCED_LOG_LEVEL)
 logging.getLogger('sqlalchemy.pool').setLevel(ADVANCED_LOG_LEVEL)
 
 logger = logging.getLogger('vampire')
+voice_logger = logging.getLogger('vampire.voice')
 logger.info(f"Logging start")
 logger.info(f"Log Levels - Console: {CONSOLE_LEVEL_NAME}, File: {FILE_LEVEL_NAME}, Event: {EVENT_LEVEL_NAME}")
 logger.info(f"Version: {VERSION}")
 
 # 初期準備
+def interaction_place(interaction: discord.Interaction) -> str:
+    return f"guild id={interaction.guild.id}" if interaction.guild else f"{interaction.channel.type.name} id={interaction.channel.id}"
+
 def log_error(error: Exception, context: str = "") -> str:
     error_code = f"E-{uuid.uuid4()}"
     tb = "".join(traceback.format_exception(type(error), error, error.__traceback__))
     logger.error(f"{error_code} | {context}\n{tb}")
     return error_code
 
+def parse_shard_ids(value: str) -> list[int] | None:
+    # "0,1,2" / "0-3" / "0-3,8" の形式
+    if not value.strip():
+        return None
+    shard_ids = []
+    for part in value.split(","):
+        start, _, end = part.strip().partition("-")
+        shard_ids.extend(range(int(start), int(end or start) + 1))
+    return shard_ids
+
+shard_ids = parse_shard_ids(SHARD_IDS)
+if shard_ids is not None and SHARD_COUNT is None:
+    raise ValueError("SHARD_IDS requires SHARD_COUNT.")
+if shard_ids is not None and any(shard_id >= SHARD_COUNT for shard_id in shard_ids):
+    raise ValueError(f"SHARD_IDS must be less than SHARD_COUNT ({SHARD_COUNT}).")
+# SHARD_IDS を指定したときは、他のシャードのサーバーのVCセッションは別のプロセスが持っている
+shard_scope = {"shard_ids": shard_ids, "shard_count": SHARD_COUNT} if shard_ids is not None else {}
+
 if not DISCORD_TOKEN:
     logger.critical("DISCORD_TOKEN is not set. The bot cannot start.")
     raise ValueError("DISCORD_TOKEN is missing. Please set the environment variable.")
 
 init_db()
+sql_duration = instrumentEngine(engine)
+meme_rules = []
 try:
-    with open("messages/memes.json", "r", encoding="utf-8") as f:
-        meme_dict = json.load(f)
+    meme_rules = loadMemeFile(MEMES_PATH)
 except FileNotFoundError:
     logger.warning("memes.json not found. Meme feature disabled.")
-    memes_enabled = False
 except json.JSONDecodeError:
     logger.warning("memes.json is invalid. Check JSON format. Meme feature disabled.")
-    memes_enabled = False
 except Exception as e:
     logger.warning(f"Unexpected error loading memes.json: {e}. Meme feature disabled.")
-    memes_enabled = False
 
-trigger_set = set(meme_dict.keys())
+async def load_guild_meme_rules(guild_id: int):
+    rules = []
+    for trigger, mode, responses in await db.readMemeRules(guild_id):
+        try:
+            rules.append(MemeRule(trigger, responses, mode))
+        except ValueError as e:
+            logger.warning(f"Skipped invalid meme rule in guild_id={guild_id}: {e}")
+    return rules
+
+meme_engine = MemeEngine(meme_rules, load_guild_rules=load_guild_meme_rules)
+meme_watcher = MemeFileWatcher(MEMES_PATH, meme_engine, interval=MEMES_RELOAD_INTERVAL)
+voice_sessions = VoiceSessionTracker(startup_time, checkpoint_size=VOICE_CHECKPOINT_SIZE, checkpoint_interval=VOICE_CHECKPOINT_INTERVAL)
+command_counter = CommandCounter(flush_interval=COMMAND_COUNT_FLUSH_INTERVAL)
+display_names = DisplayNameResolver(ttl=DISPLAY_NAME_TTL, concurrency=MEMBER_FETCH_CONCURRENCY)
+dice_engine = DiceEngine(max_workers=DICE_WORKERS)
 
 # Discord
 intents = discord.Intents.default()
 intents.message_content = True
-client = discord.Client(intents=intents)
-tree = app_commands.CommandTree(client)
+if SHARDED or SHARD_COUNT is not None:
+    client = discord.AutoShardedClient(intents=intents, shard_count=SHARD_COUNT, shard_ids=shard_ids)
+    logger.info(f"Sharded mode: shard_count={SHARD_COUNT or 'auto'}, shard_ids={shard_ids or 'all'}")
+else:
+    client = discord.Client(intents=intents)
+
+class InstrumentedCommandTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        # 処理時間は on_app_command_completion / on_app_command_error で記録する
+        interaction.extras["started"] = time.perf_counter()
+        return True
+
+tree = InstrumentedCommandTree(client)
+
+def live_voice_channels() -> dict[int, set[int] | None] | None:
+    # 整理ジョブ用に、今いるサーバーのボイス/ステージチャンネルを返す。全シャードが揃うまでは何も消させない
+    if not client.is_ready():
+        return None
+    return {guild.id: None if guild.unavailable else {channel.id for channel in (*guild.voice_channels, *guild.stage_channels)}
+            for guild in client.guilds}
+
+# 期間での整理と VACUUM はDB全体に効くので、複数プロセスで動かすときはシャード0を持つプロセスだけが行う
+maintenance = MaintenanceJob(live_voice_channels, interval=MAINTENANCE_INTERVAL, retention_months=VC_RETENTION_MONTHS,
+                             daily_retention_days=VC_DAILY_RETENTION_DAYS, interval_retention_days=VC_INTERVAL_RETENTION_DAYS,
+                             batch_size=MAINTENANCE_BATCH_SIZE, vacuum_pages=VACUUM_STEP_PAGES, departed_guild_days=DEPARTED_GUILD_PURGE_DAYS,
+                             global_cleanup=shard_ids is None or 0 in shard_ids, **shard_scope)
+command_syncer = CommandTreeSyncer(tree, COMMAND_SYNC_STATE_PATH)
+
+# Metrics
+command_latency = registry.histogram("vampire_command_duration_seconds", "Time spent handling application commands", ("command", "status"))
+voice_events = registry.counter("vampire_voice_events_total", "Voice state updates handled", ("kind",))
+registry.gauge("vampire_gateway_latency_seconds", "Discord gateway heartbeat latency", func=lambda: client.latency)
+
+def shard_health() -> list[tuple[int, float, bool, int]]:
+    # このプロセスが持っているシャードごとの (shard_id, 遅延, 接続中か, サーバー数)
+    if isinstance(client, discord.AutoShardedClient):
+        guilds = Counter(guild.shard_id for guild in client.guilds)
+        return [(shard_id, shard.latency, not shard.is_closed(), guilds[shard_id]) for shard_id, shard in sorted(client.shards.items())]
+    return [(client.shard_id or 0, client.latency, client.is_ready() and not client.is_closed(), len(client.guilds))]
+
+registry.gauge("vampire_shard_latency_seconds", "Gateway heartbeat latency per shard", ("shard",),
+               func=lambda: {(str(shard_id),): latency for shard_id, latency, _, _ in shard_health()})
+registry.gauge("vampire_shard_up", "Whether each shard is connected to the gateway", ("shard",),
+               func=lambda: {(str(shard_id),): float(up) for shard_id, _, up, _ in shard_health()})
+registry.gauge("vampire_shard_guilds", "Guilds served by each shard", ("shard",),
+               func=lambda: {(str(shard_id),): guilds for shard_id, _, _, guilds in shard_health()})
+registry.gauge("vampire_voice_active_sessions", "Voice sessions currently tracked in memory", func=lambda: len(voice_sessions))
+registry.gauge("vampire_voice_pending_changes", "Voice session changes waiting for the next checkpoint", func=lambda: voice_sessions.pending)
+registry.counter("vampire_voice_checkpoints_total", "Voice session checkpoints written to the database", ("result",), func=lambda: {("ok",): voice_sessions.checkpoints, ("failed",): voice_sessions.failed_checkpoints})
+registry.counter("vampire_voice_dropped_rows_total", "Voice session rows dropped after they kept failing to be written", func=lambda: voice_sessions.dropped_rows)
+notification_delay = registry.histogram("vampire_notification_delay_seconds", "Time voice notifications waited before being sent")
+notifier = NotificationDispatcher(window=NOTIFY_WINDOW, max_pending=NOTIFY_MAX_PENDING, observe_delay=notification_delay.observe)
+registry.gauge("vampire_notifications_pending", "Voice notifications waiting to be sent", func=lambda: len(notifier))
+registry.gauge("vampire_notification_channels_busy", "Channels with a notification worker running", func=lambda: notifier.busy_channels)
+registry.counter("vampire_notifications_total", "Voice notifications by outcome", ("result",),
+                 func=lambda: {("queued",): notifier.queued, ("sent",): notifier.sent_events, ("dropped",): notifier.dropped})
+registry.counter("vampire_notification_messages_total", "Notification messages sent to Discord", ("result",),
+                 func=lambda: {("ok",): notifier.sent_messages, ("failed",): notifier.failed})
+registry.counter("vampire_maintenance_deleted_rows_total", "Rows removed by the database maintenance job", ("kind",),
+                 func=lambda: {(kind,): count for kind, count in maintenance.deleted.items()})
+registry.counter("vampire_maintenance_runs_total", "Database maintenance runs", ("result",), func=lambda: {("ok",): maintenance.runs, ("failed",): maintenance.failed_runs})
+registry.counter("vampire_maintenance_vacuumed_pages_total", "Pages returned to the file system by incremental_vacuum", func=lambda: maintenance.vacuumed_pages)
+registry.gauge("vampire_database_free_pages", "Free pages left in the database file after the last maintenance run", func=lambda: maintenance.free_pages)
+registry.gauge("vampire_start_time_seconds", "Unix time the bot started", func=lambda: startup_time)
+
+def cache_stats():
+    caches = {
+        "guild_settings": crud.guild_settings_cache.stats(),
+        "guild_user_id": crud.guild_user_id_cache.stats(),
+        "leaderboards": crud.leaderboards.stats(),
+        "display_names": display_names.stats()
+    }
+    return {(name, stat): value for name, stats in caches.items() for stat, value in stats.items()}
+
+registry.gauge("vampire_cache", "Cache statistics", ("cache", "stat"), func=cache_stats)
+metrics_exporter = MetricsExporter(registry, path=METRICS_FILE, port=METRICS_PORT, interval=METRICS_INTERVAL)
+
+first_interaction_seconds = None
+registry.gauge("vampire_first_interaction_seconds", "Seconds from process start to the first handled interaction", func=lambda: first_interaction_seconds if first_interaction_seconds is not None else float("nan"))
+
+def record_command(interaction: discord.Interaction, status: str):
+    global first_interaction_seconds
+    started = interaction.extras.get("started")
+    if started is not None and interaction.command is not None:
+        command_latency.observe(time.perf_counter() - started, interaction.command.qualified_name, status)
+    if first_interaction_seconds is None:
+        first_interaction_seconds = time.perf_counter() - process_started
+        logger.info(f"First interaction handled {first_interaction_seconds:.2f}s after startup")
+
 # Command Group
 serverSettings = app_commands.Group(name="server-settings", description="サーバー設定", guild_only=True, default_permissions=discord.Permissions(manage_guild=True))
 
+@client.event
+async def setup_hook():
+    try:
+        await voice_sessions.load(**shard_scope)
+    except Exception as e:
+        logger.error(f"Failed to load open VC sessions: {e}")
+    voice_sessions.start()
+    command_counter.start()
+    meme_watcher.start()
+    maintenance.start()
+    await metrics_exporter.start()
+    # on_ready は再接続のたびに呼ばれるので、同期は起動時にここで1回だけ行う
+    # コマンドはアプリケーション全体で1つなので、複数プロセスで動かすときはシャード0を持つプロセスだけが同期する
+    if shard_ids is not None and 0 not in shard_ids:
+        logger.info("Skipping command sync (shard 0 is handled by another process)")
+        return
+    try:
+        await command_syncer.sync(force=FORCE_COMMAND_SYNC)
+    except discord.HTTPException as e:
+        logger.error(f"Failed to sync command tree: {e}")
+
+def voice_snapshot(guilds) -> list[tuple[int, int, int, bool]]:
+    states = []
+    for guild in guilds:
+        if guild.unavailable:
+            continue
+        for channel in (*guild.voice_channels, *guild.stage_channels):
+            # channel.members はメンバーキャッシュに載っている人しか返さないので voice_states を使う
+            for user_id, state in channel.voice_states.items():
+                states.append((guild.id, user_id, channel.id, state.self_mute))
+    return states
+
+async def reconcile_voice_sessions(guilds, departed_ids: set[int] = frozenset()):
+    # 突き合わせはメモリ上で同期的に行うので、途中でイベントが割り込むことはない。書き込みはその後のチェックポイント1回
+    # 見えているサーバーのセッションだけを見る。一時的に利用できないサーバーは閉じずに、利用できるようになったとき (on_guild_available) に突き合わせる
+    # departed_ids のサーバー (いない間に抜けたサーバー) は全員いなくなったものとして閉じる
+    started = time.perf_counter()
+    guilds = [guild for guild in guilds if not guild.unavailable]
+    guild_ids = {guild.id for guild in guilds} | departed_ids
+    kept, closed, opened = voice_sessions.reconcile(voice_snapshot(guilds), guild_ids)
+    await voice_sessions.flush()
+    logger.info(f"Voice sessions reconciled for {len(guilds)} guild(s) in {time.perf_counter() - started:.2f}s "
+                f"(kept={kept}, closed={closed}, opened={opened})")
+
 @client.event
 async def on_ready():
-    logger.info(f"Bot is ready as {client.user} (ID: {client.user.id})")
+    logger.info(f"Bot is ready as {client.user} (ID: {client.user.id}) {time.perf_counter() - process_started:.2f}s after startup")
     logger.info(f"Connected to {len(client.guilds)} guild(s)")
     logger.info(f"Startup Time: {datetime.fromtimestamp(startup_time)}")
 
     logger.debug("Debug ON")
-    with get_session() as session:
-        crud.clearVcSessions(session)
-    await tree.sync()
+    await reconcile_voice_sessions(client.guilds, voice_sessions.guild_ids - {guild.id for guild in client.guilds})
+
+@client.event
+async def on_shard_ready(shard_id: int):
+    # AutoShardedClient では1つのシャードだけが繋ぎ直したときは on_ready が来ないので、そのシャードのサーバーだけ突き合わせる
+    # 起動時は全シャードが揃った後の on_ready でまとめて突き合わせるので、ここでは何もしない
+    guilds = [guild for guild in client.guilds if guild.shard_id == shard_id]
+    logger.info(f"Shard {shard_id} is ready with {len(guilds)} guild(s)")
+    if client.is_ready():
+        await reconcile_voice_sessions(guilds)
+
+@client.event
+async def on_guild_available(guild):
+    # 起動時は on_ready でまとめて突き合わせるので、準備ができた後に利用できるようになったサーバーだけを見る
+    if client.is_ready():
+        await reconcile_voice_sessions([guild])
+
+@client.event
+async def on_guild_remove(guild):
+    logger.info(f"Left the guild {guild.name} id={guild.id}")
+    await reconcile_voice_sessions([], {guild.id})
 
 @client.event
 async def on_guild_join(guild):
     logger.info(f"Joined the guild {guild.name} id={guild.id}")
+    if client.is_ready():
+        await reconcile_voice_sessions([guild])
     message = f"初めまして！{guild.name}の皆さん！\n{client.user.name}です！"
     if guild.system_channel:
         if guild.system_channel.permissions_for(guild.me).send_messages:
@@ -174,27 +409,125 @@ async def on_message(message: discord.Message):
     if isinstance(message.channel, discord.DMChannel):
         return
     
-    if not memes_enabled:
-        return
-
-    if content in trigger_set:
-        responses = meme_dict[content]
-        response = random.choice(responses)
-        logger.debug(f"Triggered meme response to '{content}' by {message.author} in {message.guild.name}")
+    matcher = await meme_engine.matcher(message.guild.id if message.guild else None)
+    rule = matcher.match(content)
+    if rule is not None:
+        response = rule.choose()
+        logger.debug("Triggered meme response to '%s' (%s) by %s in %s", rule.trigger, rule.mode, message.author, message.guild.name if message.guild else message.channel.id)
         await message.channel.send(response)
 
 
+async def is_owner(user: discord.abc.User):
+    application = client.application or await client.application_info()
+    if application.team is not None:
+        return user.id in {member.id for member in application.team.members}
+    return application.owner is not None and user.id == application.owner.id
+
+@client.event
+async def on_app_command_completion(interaction: discord.Interaction, command):
+    record_command(interaction, "ok")
+
 @tree.error
 async def on_app_command_error(interaction: discord.Interaction, error):
+    record_command(interaction, "error")
     error_code = log_error(error, f"user={interaction.user} command={interaction.command}")
     if not interaction.response.is_done():
         await interaction.response.send_message(f"予期しないエラーが発生しました (エラーコード: `{error_code}`)", ephemeral=True)
 
 
+async def reload_memes(interaction: discord.Interaction):
+    logger.debug("%s executed /reload-memes command", interaction.user.id)
+    if not await is_owner(interaction.user):
+        await interaction.response.send_message("このコマンドはbot管理者しか使えないよ！", ephemeral=True)
+        return
+    try:
+        await meme_watcher.reload(force=True)
+    except Exception as e:
+        logger.warning(f"Failed to reload {MEMES_PATH}: {e}")
+        await interaction.response.send_message(f"memes.json の読み込みに失敗しました。今のままで動かします。\n`{e}`", ephemeral=True)
+        return
+    await interaction.response.send_message(f"memes.json を読み込み直しました！ ({len(meme_engine.global_matcher)}個)", ephemeral=True)
+
+@tree.command(name = 'reload-memes', description = 'memes.jsonを読み込み直します。(bot管理者用)')
+@app_commands.default_permissions(administrator=True)
+@app_commands.allowed_contexts(guilds=True, dms=True, private_channels=False)
+async def reload_memes_slash(interaction: discord.Interaction):
+    await reload_memes(interaction = interaction)
+
+
+async def sync_commands(interaction: discord.Interaction):
+    logger.debug("%s executed /sync-commands command", interaction.user.id)
+    if not await is_owner(interaction.user):
+        await interaction.response.send_message("このコマンドはbot管理者しか使えないよ！", ephemeral=True)
+        return
+    await interaction.response.defer(thinking=True, ephemeral=True)
+    try:
+        await command_syncer.sync(force=True)
+    except discord.HTTPException as e:
+        logger.error(f"Failed to sync command tree: {e}")
+        await interaction.followup.send(f"コマンドの同期に失敗しました。\n`{e}`", ephemeral=True)
+        return
+    await interaction.followup.send("コマンドを同期しました！反映まで少し時間がかかることがあります。", ephemeral=True)
+
+@tree.command(name = 'sync-commands', description = 'スラッシュコマンドをDiscordに同期し直します。(bot管理者用)')
+@app_commands.default_permissions(administrator=True)
+@app_commands.allowed_contexts(guilds=True, dms=True, private_channels=False)
+async def sync_commands_slash(interaction: discord.Interaction):
+    await sync_commands(interaction = interaction)
+
+
+def format_seconds(seconds: float) -> str:
+    return f"{seconds * 1000:.1f}ms" if math.isfinite(seconds) else "-"
+
+def build_stats_message() -> str:
+    uptime = int(time.time()) - startup_time
+    lines = [
+        f"**botの統計** (起動から {uptime // 3600}時間{uptime % 3600 // 60}分)",
+        f"Gatewayの遅延: {format_seconds(client.latency)}",
+        *(f"シャード{shard_id}: {format_seconds(latency)} / {guilds}サーバー{'' if up else ' (切断中)'}" for shard_id, latency, up, guilds in shard_health()[:10]
+          if isinstance(client, discord.AutoShardedClient)),
+        "",
+        "**コマンド** (回数 / p50 / p99)"
+    ]
+    commands = sorted(command_latency.snapshot().items(), key=lambda item: -item[1][2])
+    for (command, status), (counts, total, count) in commands[:10]:
+        lines.append(f"`/{command}` {status}: {count}回 / {format_seconds(command_latency.quantile(0.5, counts))} / {format_seconds(command_latency.quantile(0.99, counts))}")
+    statements = sorted(sql_duration.snapshot().items(), key=lambda item: -item[1][1])
+    lines += ["", "**SQL** (回数 / 合計 / p99)"]
+    for (operation, table), (counts, total, count) in statements[:8]:
+        lines.append(f"`{operation} {table}`: {count}回 / {format_seconds(total)} / {format_seconds(sql_duration.quantile(0.99, counts))}")
+    events = voice_events.items()
+    lines += [
+        "",
+        f"**VCイベント**: {', '.join(f'{kind} {int(value)}' for (kind,), value in sorted(events.items())) or 'なし'}"
+        f" (接続中 {len(voice_sessions)}件 / 書き込み待ち {voice_sessions.pending}件 / チェックポイント {voice_sessions.checkpoints}回, 失敗 {voice_sessions.failed_checkpoints}回)",
+        f"**通知**: {notifier.sent_events}件を{notifier.sent_messages}通で送信 (待ち {len(notifier)}件 / 破棄 {notifier.dropped}件 / 失敗 {notifier.failed}通)",
+        f"**DB整理**: {maintenance.runs}回 (失敗 {maintenance.failed_runs}回) / 削除 {', '.join(f'{kind} {count}' for kind, count in sorted(maintenance.deleted.items())) or 'なし'}"
+        f" / 空きページ {maintenance.free_pages}",
+        "",
+        "**キャッシュ** (ヒット / ミス / 件数)"
+    ]
+    for name, stats in (("サーバー設定", crud.guild_settings_cache.stats()), ("メンバーID", crud.guild_user_id_cache.stats()), ("ランキング", crud.leaderboards.stats()), ("表示名", display_names.stats())):
+        lines.append(f"{name}: {stats['hits']} / {stats['misses']} / {stats['size']}/{stats['maxsize']}")
+    return "\n".join(lines)[:2000]
+
+async def stats(interaction: discord.Interaction):
+    logger.debug("%s executed /stats command", interaction.user.id)
+    if not await is_owner(interaction.user):
+        await interaction.response.send_message("このコマンドはbot管理者しか使えないよ！", ephemeral=True)
+        return
+    await interaction.response.send_message(build_stats_message(), ephemeral=True)
+
+@tree.command(name = 'stats', description = 'botの統計を表示します。(bot管理者用)')
+@app_commands.default_permissions(administrator=True)
+@app_commands.allowed_contexts(guilds=True, dms=True, private_channels=False)
+async def stats_slash(interaction: discord.Interaction):
+    await stats(interaction = interaction)
+
+
 async def ping(interaction: discord.Interaction):
-    logger.debug(f"{interaction.user.id} executed /ping command in {f"guild id={interaction.guild.id}" if interaction.guild else f"{interaction.channel.type.name} id={interaction.channel.id}"}")
-    with get_session() as session:
-        crud.addUserCount(session, interaction.user.id)
+    logger.debug("%s executed /ping command in %s", interaction.user.id, LazyStr(interaction_place, interaction))
+    command_counter.increment(interaction.user.id)
     await interaction.response.send_message("pong!")
 
 @tree.command(name = 'ping', description = 'pingを返します')
@@ -204,9 +537,8 @@ async def ping_slash(interaction: discord.Interaction):
 
 
 async def notification_channel(interaction: discord.Integration, channel: discord.TextChannel):
-    logger.debug(f"{interaction.user.id} executed /notification-channel command in {f"guild id={interaction.guild.id}" if interaction.guild else f"{interaction.channel.type.name} id={interaction.channel.id}"}")
-    with get_session() as session:
-        crud.updateServerNotificationChannel(session, interaction.guild.id, channel.id)
+    logger.debug("%s executed /notification-channel command in %s", interaction.user.id, LazyStr(interaction_place, interaction))
+    await db.updateServerNotificationChannel(interaction.guild.id, channel.id)
     await interaction.response.send_message(f"通知チャンネルを <#{channel.id}> に設定しました！")
 
 @serverSettings.command(name = 'notification-channel', description = 'botの通知チャンネルを変更します。')
@@ -215,72 +547,243 @@ async def notification_channel_slash(interaction: discord.Integration, channel:
     await notification_channel(interaction = interaction, channel = channel)
 
 
-async def vc_log(interaction: discord.Interaction, channel: discord.VoiceChannel, year: app_commands.Range[int, 2025, 2099] = None, month: app_commands.Range[int, 1, 12] = None, ephemeral: bool = True):
+async def vc_retention(interaction: discord.Interaction, months: int = None):
+    logger.debug("%s executed /vc-retention command in guild id=%s", interaction.user.id, interaction.guild.id)
+    await db.updateGuildRetention(interaction.guild.id, months)
+    if months is None:
+        default = f"{VC_RETENTION_MONTHS}か月" if VC_RETENTION_MONTHS else "無期限"
+        message = f"VCの月別・日別の記録の保存期間をbotの設定 ({default}) に戻しました！"
+    elif months == 0:
+        message = "VCの月別・日別の記録をずっと残すようにしました！"
+    else:
+        message = f"VCの月別・日別の記録を{months}か月分残すようにしました！それより前の分は年別・これまでの合計にまとめて残ります。"
+    await interaction.response.send_message(message, ephemeral=True)
+
+@serverSettings.command(name = 'vc-retention', description = 'VCの月別・日別の記録を残す期間を設定します。')
+@app_commands.describe(months="残す月数です。0で無期限、省略するとbotの設定に戻します。")
+async def vc_retention_slash(interaction: discord.Interaction, months: app_commands.Range[int, 0, 120] = None):
+    await vc_retention(interaction = interaction, months = months)
+
+
+# 添付ファイルの大きさの上限から、multipart の見出しなどの分を引いておく
+EXPORT_PART_MARGIN = 64 * 1024
+EXPORT_PERIOD_NAMES = {"day": "日別", "month": "月別", "year": "年別", "all_time": "これまで"}
+exporting_guilds = set()
+
+async def export(interaction: discord.Interaction, fmt: str, period: str):
+    logger.debug("%s executed /export command in guild id=%s", interaction.user.id, interaction.guild.id)
+    guild_id = interaction.guild.id
+    if guild_id in exporting_guilds:
+        await interaction.response.send_message("このサーバーのエクスポートはいま作っているところだよ！終わるまで待ってね。", ephemeral=True)
+        return
+    exporting_guilds.add(guild_id)
+    writer = ExportWriter(f"vc-{period}-{guild_id}", fmt, interaction.guild.filesize_limit - EXPORT_PART_MARGIN, EXPORT_MAX_FILES)
     try:
-        with get_session() as session:
-            connection_time, mic_on_time  = crud.readVcSummary(session, interaction.guild.id, interaction.user.id, channel.id, year, month)
-    except crud.FutureDateError:
-        await interaction.response.send_message(f"ごめんね～\n私、未来のことはわかんないんだよね......\nその時まで一緒にいれると嬉しいな！", ephemeral=True)
+        await interaction.response.defer(thinking=True, ephemeral=True)
+        # 行を読んでファイルにするところまでイベントループの外で行い、ここでは送るだけにする
+        rows = await db.exportVcSummary(guild_id, writer, period, EXPORT_CHUNK_SIZE)
+        if not rows:
+            await interaction.followup.send("まだVCの記録がないよ！", ephemeral=True)
+            return
+        content = f"VCの記録 ({EXPORT_PERIOD_NAMES[period]}) を{rows}行エクスポートしました！"
+        if writer.truncated:
+            content += f"\n大きすぎるので、最初の{EXPORT_MAX_FILES}ファイル分だけです。"
+        for filename, fp in writer.files():
+            # 1つのメッセージに付けられる大きさの合計にも上限があるので、1ファイルずつ送る
+            await interaction.followup.send(content, file=discord.File(fp, filename=filename), ephemeral=True)
+            content = None
+    finally:
+        writer.close()
+        exporting_guilds.discard(guild_id)
+
+@serverSettings.command(name = 'export', description = 'このサーバーのVCの記録をファイルでエクスポートします。')
+@app_commands.describe(format="ファイルの形式です。defaultでCSVです。", period="集計の単位です。defaultで月別です。")
+@app_commands.choices(format=[
+    app_commands.Choice(name="CSV", value="csv"),
+    app_commands.Choice(name="NDJSON", value="ndjson"),
+], period=[app_commands.Choice(name=name, value=value) for value, name in EXPORT_PERIOD_NAMES.items()])
+async def export_slash(interaction: discord.Interaction, format: app_commands.Choice[str] = None, period: app_commands.Choice[str] = None):
+    await export(interaction = interaction, fmt = format.value if format else "csv", period = period.value if period else "month")
+
+
+async def meme_add(interaction: discord.Interaction, trigger: str, response: str, mode: str):
+    logger.debug("%s executed /meme-add command in guild id=%s", interaction.user.id, interaction.guild.id)
+    trigger = trigger.strip()
+    if not trigger or len(trigger) > 100 or len(response) > 1000:
+        await interaction.response.send_message("トリガーは1～100文字、返事は1000文字までだよ！", ephemeral=True)
         return
-    except crud.NoDataError:
-        await interaction.response.send_message(f"{year or datetime.now().year}年 {month or datetime.now().month}月のデータがなかったよ！", ephemeral = ephemeral)
+    try:
+        count = await db.addMemeRule(interaction.guild.id, trigger, mode, response, MEME_RULES_PER_GUILD)
+    except crud.TooManyRulesError:
+        await interaction.response.send_message(f"このサーバーにはもう{MEME_RULES_PER_GUILD}個まで登録されてるよ！いらないものを消してね。", ephemeral=True)
         return
-    logger.debug(f"{interaction.user.id} queried vc-time for {channel.name}: Connection Time: {connection_time}, Mic Time: {mic_on_time}")
-    if year is not None and month is None:
-        await interaction.response.send_message(f"{year or datetime.now().year}年に <#{channel.id}> に接続していた時間の発表です！\n接続時間: {connection_time}\nミュート: {mic_on_time}", ephemeral = ephemeral)
+    meme_engine.invalidate(interaction.guild.id)
+    await interaction.response.send_message(f"「{trigger}」({mode}) に返事を登録しました！ (返事の数: {count})", ephemeral=True)
+
+@serverSettings.command(name = 'meme-add', description = 'このサーバーだけの反応するメッセージを登録します。')
+@app_commands.describe(trigger="反応する言葉", response="botの返事", mode="一致のしかたです。defaultで完全一致です。")
+@app_commands.choices(mode=[
+    app_commands.Choice(name="完全一致", value="exact"),
+    app_commands.Choice(name="前方一致", value="prefix"),
+    app_commands.Choice(name="部分一致", value="substring"),
+])
+async def meme_add_slash(interaction: discord.Interaction, trigger: str, response: str, mode: app_commands.Choice[str] = None):
+    await meme_add(interaction = interaction, trigger = trigger, response = response, mode = mode.value if mode else GUILD_MODES[0])
+
+
+async def meme_remove(interaction: discord.Interaction, trigger: str):
+    logger.debug("%s executed /meme-remove command in guild id=%s", interaction.user.id, interaction.guild.id)
+    deleted = await db.deleteMemeRule(interaction.guild.id, trigger.strip())
+    meme_engine.invalidate(interaction.guild.id)
+    if deleted:
+        await interaction.response.send_message(f"「{trigger.strip()}」を削除しました！", ephemeral=True)
     else:
-        await interaction.response.send_message(f"{year or datetime.now().year}年 {month or datetime.now().month}月に <#{channel.id}> に接続していた時間の発表です！\n接続時間: {connection_time}\nミュート: {mic_on_time}", ephemeral = ephemeral)
+        await interaction.response.send_message(f"「{trigger.strip()}」は登録されてないよ？", ephemeral=True)
 
-@tree.command(name= 'vc-time', description= 'あなたのvc接続時間を表示します。')
-@app_commands.guild_only()
-@app_commands.describe(channel="閲覧するチャンネル", ephemeral="自分にしか表示しないかどうかです。defaultでTrueです。")
-async def vc_log_slash(interaction: discord.Interaction, channel: discord.VoiceChannel, year: app_commands.Range[int, 2025, 2099] = None, month: app_commands.Range[int, 1, 12] = None, ephemeral: bool = True):
-    await vc_log(interaction = interaction, channel = channel, year = year, month = month, ephemeral = ephemeral)
+@serverSettings.command(name = 'meme-remove', description = 'このサーバーだけの反応するメッセージを削除します。')
+@app_commands.describe(trigger="削除する言葉")
+async def meme_remove_slash(interaction: discord.Interaction, trigger: str):
+    await meme_remove(interaction = interaction, trigger = trigger)
 
 
-async def vc_rank(interaction: discord.Integration, channel: discord.VoiceChannel = None, year: app_commands.Range[int, 2025, 2099] = None, month: app_commands.Range[int, 1, 12] = None, ephemeral: bool = False):
-    channel_id = channel.id if channel is not None else None
-    user_nodata = False
+async def meme_list(interaction: discord.Interaction):
+    rules = await db.readMemeRules(interaction.guild.id)
+    if not rules:
+        await interaction.response.send_message("このサーバーだけの反応はまだ登録されてないよ！", ephemeral=True)
+        return
+    lines = ["このサーバーだけの反応一覧です！"]
+    for trigger, mode, responses in rules:
+        line = f"- {trigger} ({mode}) 返事{len(responses)}個"
+        if sum(len(l) + 1 for l in lines) + len(line) > 1900:
+            lines.append("…")
+            break
+        lines.append(line)
+    await interaction.response.send_message("\n".join(lines), ephemeral=True)
+
+@serverSettings.command(name = 'meme-list', description = 'このサーバーだけの反応するメッセージの一覧を表示します。')
+async def meme_list_slash(interaction: discord.Interaction):
+    await meme_list(interaction = interaction)
+
+
+def format_period(year: int = None, month: int = None, day: int = None, all_time: bool = False) -> str:
+    if all_time:
+        return "これまで"
+    if year is not None and month is None and day is None:
+        return f"{year}年"
+    # crud と同じく UTC の日付で数えるので、ラベルも UTC の今日・今月にする
+    now = datetime.now(timezone.utc)
+    period = f"{year or now.year}年 {month or now.month}月"
+    return f"{period} {day}日" if day is not None else period
+
+async def vc_log(interaction: discord.Interaction, channel: discord.VoiceChannel, year: app_commands.Range[int, 2025, 2099] = None, month: app_commands.Range[int, 1, 12] = None, day: app_commands.Range[int, 1, 31] = None, all_time: bool = False, ephemeral: bool = True):
+    period = format_period(year, month, day, all_time)
     try:
-        with get_session() as session:
-            vc_rank = crud.readVcRankEntries(session, interaction.guild.id, channel_id, year, month)
-            user_rank = crud.readUserVcRankEntry(session, interaction.guild.id, interaction.user.id, channel_id, year, month)
+        connection_time, mic_on_time  = await db.readVcSummary(interaction.guild.id, interaction.user.id, channel.id, year, month, day, all_time)
     except crud.FutureDateError:
         await interaction.response.send_message(f"ごめんね～\n私、未来のことはわかんないんだよね......\nその時まで一緒にいれると嬉しいな！", ephemeral=True)
         return
     except crud.NoDataError:
-        user_nodata = True
-    logger.debug(f"{interaction.user.id} queried vc-rank for {interaction.guild.id}/{channel_id}: {vc_rank}")
-    await interaction.response.defer(thinking=True)
+        await interaction.response.send_message(f"{period}のデータがなかったよ！", ephemeral = ephemeral)
+        return
+    logger.debug("%s queried vc-time for %s: Connection Time: %s, Mic Time: %s", interaction.user.id, channel.name, connection_time, mic_on_time)
+    await interaction.response.send_message(f"{period}に <#{channel.id}> に接続していた時間の発表です！\n接続時間: {connection_time}\nミュート: {mic_on_time}", ephemeral = ephemeral)
 
+@tree.command(name= 'vc-time', description= 'あなたのvc接続時間を表示します。')
+@app_commands.guild_only()
+@app_commands.describe(channel="閲覧するチャンネル", day="日 (UTC)", all_time="これまでの合計を表示するかどうかです。defaultでFalseです。", ephemeral="自分にしか表示しないかどうかです。defaultでTrueです。")
+async def vc_log_slash(interaction: discord.Interaction, channel: discord.VoiceChannel, year: app_commands.Range[int, 2025, 2099] = None, month: app_commands.Range[int, 1, 12] = None, day: app_commands.Range[int, 1, 31] = None, all_time: bool = False, ephemeral: bool = True):
+    await vc_log(interaction = interaction, channel = channel, year = year, month = month, day = day, all_time = all_time, ephemeral = ephemeral)
+
+
+async def build_vc_rank_message(guild: discord.Guild, user: discord.abc.User, channel_id: int, year: int, month: int, rank_page: crud.VCRankingPage, all_time: bool = False):
     lines = []
-    channel_display = f"<#{channel_id}>" if channel is not None else interaction.guild.name
-    lines.append(f"{year or datetime.now().year}年 {month or datetime.now().month}月に {channel_display} に接続していた人のランキングの発表です！")
-    if vc_rank.entries:
-        for entry in vc_rank.entries:
-            member = interaction.guild.get_member(entry.user_id)
-            if member is None:
-                member = await interaction.guild.fetch_member(entry.user_id)
-            name = member.display_name if member else "unknown"
-            lines.append(f"{entry.rank}位 {name} | 接続: {entry.total_connection_time} | マイク: {entry.total_mic_on_time}")
+    channel_display = f"<#{channel_id}>" if channel_id is not None else guild.name
+    lines.append(f"{format_period(year, month, all_time=all_time)}に {channel_display} に接続していた人のランキングの発表です！")
+    if rank_page.entries:
+        names = await display_names.resolve(guild, (entry.user_id for entry in rank_page.entries))
+        for entry in rank_page.entries:
+            lines.append(f"{entry.rank}位 {names[entry.user_id]} | 接続: {entry.total_connection_time} | マイク: {entry.total_mic_on_time}")
     else:
         lines.append(f"データなし")
-    if not user_nodata:
-        lines.append(f"{user_rank.rank}位 {interaction.user.display_name} | 接続: {user_rank.total_connection_time} | マイク: {user_rank.total_mic_on_time}")
+    if rank_page.user_entry is not None:
+        user_rank = rank_page.user_entry
+        lines.append(f"{user_rank.rank}位 {user.display_name} | 接続: {user_rank.total_connection_time} | マイク: {user_rank.total_mic_on_time}")
+    if rank_page.page_count > 1:
+        lines.append(f"({rank_page.page}/{rank_page.page_count}ページ)")
+    return "\n".join(lines)
+
+class vcRankView(discord.ui.View):
+    def __init__(self, owner_id: int, channel_id: int, year: int, month: int, all_time: bool = False):
+        super().__init__(timeout=300)
+        self.owner_id = owner_id
+        self.channel_id = channel_id
+        self.year = year
+        self.month = month
+        self.all_time = all_time
+        self.page = 1
+        self.message = None
+
+    def update_buttons(self, rank_page: crud.VCRankingPage):
+        self.page = rank_page.page
+        self.previous_button.disabled = not rank_page.has_previous
+        self.next_button.disabled = not rank_page.has_next
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        if interaction.user.id != self.owner_id:
+            await interaction.response.send_message("ページをめくれるのはコマンドを使った人だけだよ！", ephemeral=True)
+            return False
+        return True
+
+    async def show_page(self, interaction: discord.Interaction, page: int):
+        rank_page = await db.readVcRankPage(interaction.guild.id, self.owner_id, self.channel_id, self.year, self.month, page, VC_RANK_PAGE_SIZE, self.all_time)
+        self.update_buttons(rank_page)
+        content = await build_vc_rank_message(interaction.guild, interaction.user, self.channel_id, self.year, self.month, rank_page, self.all_time)
+        await interaction.response.edit_message(content=content, view=self)
+
+    @discord.ui.button(label="◀", style=discord.ButtonStyle.secondary)
+    async def previous_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show_page(interaction, self.page - 1)
+
+    @discord.ui.button(label="▶", style=discord.ButtonStyle.secondary)
+    async def next_button(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show_page(interaction, self.page + 1)
+
+    async def on_timeout(self):
+        if self.message is None:
+            return
+        try:
+            await self.message.edit(view=None)
+        except discord.HTTPException:
+            logger.debug(f"Failed to remove vc-rank buttons from message (ID: {self.message.id})")
 
-    await interaction.followup.send("\n".join(lines))
+async def vc_rank(interaction: discord.Integration, channel: discord.VoiceChannel = None, year: app_commands.Range[int, 2025, 2099] = None, month: app_commands.Range[int, 1, 12] = None, all_time: bool = False, ephemeral: bool = False):
+    channel_id = channel.id if channel is not None else None
+    try:
+        rank_page = await db.readVcRankPage(interaction.guild.id, interaction.user.id, channel_id, year, month, 1, VC_RANK_PAGE_SIZE, all_time)
+    except crud.FutureDateError:
+        await interaction.response.send_message(f"ごめんね～\n私、未来のことはわかんないんだよね......\nその時まで一緒にいれると嬉しいな！", ephemeral=True)
+        return
+    logger.debug("%s queried vc-rank for %s/%s: %s", interaction.user.id, interaction.guild.id, channel_id, rank_page)
+    await interaction.response.defer(thinking=True, ephemeral=ephemeral)
+
+    content = await build_vc_rank_message(interaction.guild, interaction.user, channel_id, year, month, rank_page, all_time)
+    if rank_page.page_count > 1:
+        view = vcRankView(interaction.user.id, channel_id, year, month, all_time)
+        view.update_buttons(rank_page)
+        view.message = await interaction.followup.send(content, view=view, wait=True)
+    else:
+        await interaction.followup.send(content)
 
 @tree.command(name= 'vc-rank', description= 'あなたのvc接続時間を表示します。')
 @app_commands.guild_only()
-@app_commands.describe(channel="閲覧するチャンネル", ephemeral="自分にしか表示しないかどうかです。defaultでFalseです。")
-async def vc_rank_slash(interaction: discord.Integration, channel: discord.VoiceChannel = None, year: app_commands.Range[int, 2025, 2099] = None, month: app_commands.Range[int, 1, 12] = None, ephemeral: bool = False):
-        await vc_rank(interaction = interaction, channel = channel, year = year, month = month, ephemeral = ephemeral)
+@app_commands.describe(channel="閲覧するチャンネル", all_time="これまでの合計で順位を付けるかどうかです。defaultでFalseです。", ephemeral="自分にしか表示しないかどうかです。defaultでFalseです。")
+async def vc_rank_slash(interaction: discord.Integration, channel: discord.VoiceChannel = None, year: app_commands.Range[int, 2025, 2099] = None, month: app_commands.Range[int, 1, 12] = None, all_time: bool = False, ephemeral: bool = False):
+        await vc_rank(interaction = interaction, channel = channel, year = year, month = month, all_time = all_time, ephemeral = ephemeral)
 
 
 async def rps(interaction: discord.Interaction):
-    logger.debug(f"{interaction.user.id} executed /rps command in {f"guild id={interaction.guild.id}" if interaction.guild else f"{interaction.channel.type.name} id={interaction.channel.id}"}")
-    with get_session() as session:
-        crud.addUserCount(session, interaction.user.id)
+    logger.debug("%s executed /rps command in %s", interaction.user.id, LazyStr(interaction_place, interaction))
+    command_counter.increment(interaction.user.id)
     if random.randint(1, 100) == 1:
         await interaction.response.send_message(":hand_with_index_finger_and_thumb_crossed:")
     else:
@@ -339,9 +842,8 @@ class rpsMeView(discord.ui.View):
 
 
 async def rps_me(interaction: discord.Integration):
-    logger.debug(f"{interaction.user.id} executed /rps-me command in {f"guild id={interaction.guild.id}" if interaction.guild else f"{interaction.channel.type.name} id={interaction.channel.id}"}")
-    with get_session() as session:
-        crud.addUserCount(session, interaction.user.id)
+    logger.debug("%s executed /rps-me command in %s", interaction.user.id, LazyStr(interaction_place, interaction))
+    command_counter.increment(interaction.user.id)
     if random.randint(1, 250) == 1:
         await interaction.response.send_message("zzz...")
     else:
@@ -355,24 +857,16 @@ async def rps_me_slash(interaction: discord.Integration):
 
 
 async def dice(interaction: discord.Interaction, roll: int, side: int):
-    logger.debug(f"{interaction.user.id} executed /dice command in {f"guild id={interaction.guild.id}" if interaction.guild else f"{interaction.channel.type.name} id={interaction.channel.id}"}")
-    with get_session() as session:
-        crud.addUserCount(session, interaction.user.id)
+    logger.debug("%s executed /dice command in %s", interaction.user.id, LazyStr(interaction_place, interaction))
+    command_counter.increment(interaction.user.id)
     if side is None or roll is None:
-        logger.error(f'Not a valid parameter: roll: {roll} side: {side}')
-        await interaction.response.send_message("必要なオプションがが指定されていません。",ephemeral=True)
+        await interaction.response.send_message(f"オプションは{MAX_DIGITS}桁までの整数で指定してね!",ephemeral=True)
     elif roll <= 0 or side <= 0:
         await interaction.response.send_message("オプションは0以上の整数だよ!",ephemeral=True)
-    elif roll >= 16777216 or side >= 16777216:
-        await interaction.response.send_message("オプションは16777216以下の整数だよ!大きい数字は無理なんだ......ごめんね？\n後で大きい数字対応のコマンドも作るよ!がんばるね!",ephemeral=True)
     else:
         await interaction.response.defer(thinking=True)
-
-        def calculate_roll():
-            return sum(random.randint(1, side) for _ in range(roll))
-        
         try:
-            msg = await asyncio.to_thread(calculate_roll)
+            msg = await dice_engine.roll(roll, side)
             await interaction.followup.send(f"{msg}")
         except Exception as e:
             logger.exception(f'Error in random calculation: roll: {roll} side: {side}')
@@ -381,14 +875,13 @@ async def dice(interaction: discord.Interaction, roll: int, side: int):
 @tree.command(name = 'dice', description = 'サイコロを振ります')
 @app_commands.allowed_contexts(guilds=True, dms=True, private_channels=True)
 @app_commands.describe(roll="サイコロを振る回数です", side="サイコロの面の数です")
-async def dice_slash(interaction: discord.Interaction, roll: int, side: int):
+async def dice_slash(interaction: discord.Interaction, roll: app_commands.Transform[int, BigIntTransformer], side: app_commands.Transform[int, BigIntTransformer]):
     await dice(interaction = interaction, roll = roll, side = side)
 
 
 async def chinchiro(interaction: discord.Interaction):
-    logger.debug(f"{interaction.user.id} executed /chinchiro command in {f"guild id={interaction.guild.id}" if interaction.guild else f"{interaction.channel.type.name} id={interaction.channel.id}"}")
-    with get_session() as session:
-        crud.addUserCount(session, interaction.user.id)
+    logger.debug("%s executed /chinchiro command in %s", interaction.user.id, LazyStr(interaction_place, interaction))
+    command_counter.increment(interaction.user.id)
     if random.randint(1, 50) == 1:
         await interaction.response.send_message("台からサイコロが落ちた！")
     else:
@@ -401,9 +894,8 @@ async def chinchiro_slash(interaction: discord.Interaction):
 
 
 async def dice_poker(interaction: discord.Interaction):
-    logger.debug(f"{interaction.user.id} executed /dice-poker command in {f"guild id={interaction.guild.id}" if interaction.guild else f"{interaction.channel.type.name} id={interaction.channel.id}"}")
-    with get_session() as session:
-        crud.addUserCount(session, interaction.user.id)
+    logger.debug("%s executed /dice-poker command in %s", interaction.user.id, LazyStr(interaction_place, interaction))
+    command_counter.increment(interaction.user.id)
     faces = ["9", "10", "J", "Q", "K", "A"]
     await interaction.response.send_message(f'{random.choice(faces)}  {random.choice(faces)}  {random.choice(faces)}  {random.choice(faces)}  {random.choice(faces)}')
 
@@ -415,9 +907,8 @@ async def dice_poker_slash(interaction: discord.Interaction):
 
 
 async def dice_poker_stgr(interaction: discord.Integration):
-    logger.debug(f"{interaction.user.id} executed /dice-poker-stgr command in {f"guild id={interaction.guild.id}" if interaction.guild else f"{interaction.channel.type.name} id={interaction.channel.id}"}")
-    with get_session() as session:
-        crud.addUserCount(session, interaction.user.id)
+    logger.debug("%s executed /dice-poker-stgr command in %s", interaction.user.id, LazyStr(interaction_place, interaction))
+    command_counter.increment(interaction.user.id)
     await interaction.response.send_message(f'{random.randint(1, 6)}  {random.randint(1, 6)}  {random.randint(1, 6)}  {random.randint(1, 6)}  {random.randint(1, 6)}')
 
 @tree.command(name = 'dice-poker-stgr', description = 'ストグラのカジノで行われているダイスポーカーを振ります')
@@ -428,57 +919,76 @@ async def dice_poker_stgr_slash(interaction: discord.Integration):
 
 @client.event
 async def on_voice_state_update(member, before, after):
-    msg = None
+    notice = None
     
-    logger.debug(f"Event triggered: {member.display_name}, Before: {before.channel}, After: {after.channel}")
-    with get_session() as session:
-        alert_channel_id = crud.readServerSetting(session, member.guild.id).notification_channel
+    voice_logger.debug("Event triggered: %s, Before: %s, After: %s", member.display_name, before.channel, after.channel)
+    display_names.remember(member)
+    alert_channel_id = (await db.readServerSetting(member.guild.id)).notification_channel
     alert_channel = client.get_channel(alert_channel_id) or member.guild.system_channel
     if alert_channel is None:
-        logger.error(f"Alert channel with ID {alert_channel_id} not found or no access.")
+        logger.error("Alert channel with ID %s not found or no access.", alert_channel_id)
         return
     
     if not alert_channel.permissions_for(member.guild.me).send_messages:
         return
 
     if before.channel is None and after.channel is not None:
-        msg = f'{member.display_name} が {after.channel.name} に参加しました。'
-        with get_session() as session:
-            crud.addVcSessions(session, member.guild.id, member.id, after.channel.id, after.self_mute)
+        notice = ("join", (after.channel.name,))
+        voice_events.inc("join")
+        voice_sessions.add(member.guild.id, member.id, after.channel.id, after.self_mute)
     elif after.channel is None and before.channel is not None:
-        msg = f'{member.display_name} が {before.channel.name} から退出しました。'
-        with get_session() as session:
-            crud.endVcSessions(session, member.guild.id, member.id, before.channel.id, before.self_mute, startup_time)
+        notice = ("leave", (before.channel.name,))
+        voice_events.inc("leave")
+        voice_sessions.end(member.guild.id, member.id, before.channel.id, before.self_mute)
     elif before.channel is not None and after.channel is not None:
         if before.channel.id != after.channel.id:
-            msg = f'{member.display_name} が {before.channel.name} から {after.channel.name} に移動しました。'
-            with get_session() as session:
-                crud.endVcSessions(session, member.guild.id, member.id, before.channel.id, before.self_mute, startup_time)
-                crud.addVcSessions(session, member.guild.id, member.id, after.channel.id, after.self_mute)
+            notice = ("move", (before.channel.name, after.channel.name))
+            voice_events.inc("move")
+            voice_sessions.end(member.guild.id, member.id, before.channel.id, before.self_mute)
+            voice_sessions.add(member.guild.id, member.id, after.channel.id, after.self_mute)
         elif before.self_mute != after.self_mute:
+            voice_events.inc("mute")
             if before.self_mute:
-                with get_session() as session:
-                    crud.endVcSessions(session, member.guild.id, member.id, before.channel.id, before.self_mute, startup_time)
-                    crud.addVcSessions(session, member.guild.id, member.id, after.channel.id, after.self_mute)
+                voice_sessions.end(member.guild.id, member.id, before.channel.id, before.self_mute)
+                voice_sessions.add(member.guild.id, member.id, after.channel.id, after.self_mute)
             elif after.self_mute:
-                with get_session() as session:
-                    crud.endVcSessions(session, member.guild.id, member.id, before.channel.id, before.self_mute, startup_time)
-                    crud.addVcSessions(session, member.guild.id, member.id, after.channel.id, after.self_mute)
+                voice_sessions.end(member.guild.id, member.id, before.channel.id, before.self_mute)
+                voice_sessions.add(member.guild.id, member.id, after.channel.id, after.self_mute)
 
-    if msg is not None:
-        logger.debug(f'Send message: {msg}')
-        await alert_channel.send(msg)
+    if notice is not None:
+        # 送信は通知用のキューに任せる。文面にするのは送るときで、短い間に続いた通知は1通にまとめて送られる
+        voice_logger.debug("Queue notification: %s %s (%s)", *notice, member.display_name)
+        notifier.notify(alert_channel, *notice, member.display_name)
     else:
-        logger.debug("No relevant voice state changes detected.")
+        voice_logger.debug("No relevant voice state changes detected.")
 
 tree.add_command(serverSettings)
 
 async def shutdown():
     logger.info("Start Shutdown")
-    with get_session() as session:
-        crud.endAllVcSessions(session, startup_time)
-    await client.close()
+    logger.info(f"Guild settings cache: {crud.guild_settings_cache.stats()}")
+    # どれかが失敗しても残りの後片付けは続ける (DB スレッドやログを止め損ねないように)
+    steps = [
+        ("meme watcher", meme_watcher.close),
+        ("maintenance", maintenance.close),
+        ("voice sessions", voice_sessions.close),
+        ("notifier", notifier.close),
+        ("command counter", command_counter.close),
+        ("open VC sessions", functools.partial(db.endAllVcSessions, **shard_scope)),
+        ("metrics exporter", metrics_exporter.close),
+        ("discord client", client.close),
+        ("dice engine", dice_engine.shutdown),
+        ("database", db.shutdown),
+    ]
+    for name, step in steps:
+        try:
+            result = step()
+            if inspect.isawaitable(result):
+                await result
+        except Exception:
+            logger.exception(f"Failed to shut down {name}")
     logger.info("Finish Shutdown! good by!")
+    log_pipeline.stop()
 
 async def runner(token):
 
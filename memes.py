@@ -0,0 +1,262 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+from collections import deque
+from typing import Awaitable, Callable, Iterable, Sequence
+from database.cache import LRUCache
+
+logger = logging.getLogger('vampire.memes')
+
+# exact: メッセージ全体が一致 / prefix: メッセージの先頭が一致 / substring: メッセージのどこかに含まれる / regex: 正規表現
+MODES = ("exact", "prefix", "substring", "regex")
+# サーバーごとのルールで使えるモード。正規表現は書き方次第でいくらでも遅くなるので memes.json だけで使える
+GUILD_MODES = ("exact", "prefix", "substring")
+
+
+class MemeRule:
+    def __init__(self, trigger: str, responses: Sequence[str], mode: str = "exact"):
+        if mode not in MODES:
+            raise ValueError(f"Unknown meme mode: {mode}")
+        if not trigger:
+            raise ValueError("Meme trigger must not be empty")
+        if not responses:
+            raise ValueError(f"Meme trigger '{trigger}' has no responses")
+        self.trigger = trigger
+        self.responses = list(responses)
+        self.mode = mode
+        # 正規表現は1つずつコンパイルする。まとめて1つのパターンにすると (?i) のようなフラグや \1 のような後方参照が壊れる
+        self.pattern = re.compile(trigger) if mode == "regex" else None
+
+    def choose(self):
+        return random.choice(self.responses)
+
+    def to_dict(self):
+        return {
+            "trigger": self.trigger,
+            "responses": self.responses,
+            "mode": self.mode
+        }
+
+    def __repr__(self):
+        return f"<MemeRule(trigger='{self.trigger}', mode={self.mode}, responses={len(self.responses)})>"
+
+
+def parseMemeRules(data: dict) -> list[MemeRule]:
+    # {"trigger": ["response", ...]} の従来の形式と、
+    # {"trigger": {"responses": [...], "mode": "substring"}} の形式のどちらも受け付ける
+    if not isinstance(data, dict):
+        raise ValueError("memes.json must be a JSON object")
+    rules = []
+    for trigger, value in data.items():
+        if isinstance(value, list):
+            rule = MemeRule(trigger, value)
+        elif isinstance(value, dict):
+            rule = MemeRule(trigger, value.get("responses", []), value.get("mode", "exact"))
+        else:
+            raise ValueError(f"Invalid entry for meme trigger '{trigger}'")
+        if not all(isinstance(response, str) for response in rule.responses):
+            raise ValueError(f"Responses for meme trigger '{trigger}' must be strings")
+        rules.append(rule)
+    return rules
+
+
+def loadMemeFile(path: str) -> list[MemeRule]:
+    with open(path, "r", encoding="utf-8") as f:
+        return parseMemeRules(json.load(f))
+
+
+class AhoCorasick:
+    def __init__(self, patterns: Iterable[str]):
+        self.patterns = list(patterns)
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail = [0]
+        self._output: list[tuple[int, ...]] = [()]
+        for index, pattern in enumerate(self.patterns):
+            state = 0
+            for char in pattern:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][char] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append(())
+                state = next_state
+            self._output[state] += (index,)
+
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._output[next_state] += self._output[self._fail[next_state]]
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def iter(self, text: str):
+        # (終了位置, パターン番号) を終了位置の順に返す
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for index in output[state]:
+                yield position, index
+
+
+class MemeMatcher:
+    def __init__(self, rules: Iterable[MemeRule]):
+        self.rules: list[MemeRule] = []
+        self._exact: dict[str, MemeRule] = {}
+        scanned: list[MemeRule] = []
+        regex_rules: list[MemeRule] = []
+        for rule in rules:
+            self.rules.append(rule)
+            if rule.mode == "exact":
+                self._exact.setdefault(rule.trigger, rule)
+            elif rule.mode == "regex":
+                regex_rules.append(rule)
+            else:
+                scanned.append(rule)
+        self._scanned = scanned
+        self._automaton = AhoCorasick(rule.trigger for rule in scanned) if scanned else None
+        self._regex_rules = regex_rules
+
+    def __len__(self):
+        return len(self.rules)
+
+    def match(self, content: str) -> MemeRule | None:
+        rule = self._exact.get(content)
+        if rule is not None:
+            return rule
+        if self._automaton is not None:
+            # 最初に見つかったものを返すので、トリガーの数によらずメッセージの長さに比例した時間で終わる
+            for position, index in self._automaton.iter(content):
+                rule = self._scanned[index]
+                if rule.mode == "substring" or position + 1 == len(rule.trigger):
+                    return rule
+        for rule in self._regex_rules:
+            if rule.pattern.search(content) is not None:
+                return rule
+        return None
+
+
+class MemeEngine:
+    def __init__(self, rules: Iterable[MemeRule] = (), load_guild_rules: Callable[[int], Awaitable[list[MemeRule]]] = None, maxsize: int = 1024):
+        self.global_matcher = MemeMatcher(rules)
+        self._load_guild_rules = load_guild_rules
+        self._guild_rules = LRUCache(maxsize=maxsize)
+        self._guild_matchers = LRUCache(maxsize=maxsize)
+        self._loading: dict[int, asyncio.Task] = {}
+        self._generations: dict[int, int] = {}
+
+    def swap_global(self, matcher: MemeMatcher):
+        # 参照の差し替えだけなので、処理中の on_message は古い照合器をそのまま使い切る
+        self.global_matcher = matcher
+        self._guild_matchers.clear()
+        logger.info(f"Swapped global meme rules ({len(matcher)} rules)")
+
+    def _compile(self, guild_id: int, guild_rules: list[MemeRule]):
+        if guild_rules:
+            # サーバー独自のルールを優先する
+            matcher = MemeMatcher([*guild_rules, *self.global_matcher.rules])
+            logger.debug("Compiled %d meme rules for guild_id=%s", len(guild_rules), guild_id)
+        else:
+            matcher = self.global_matcher
+        self._guild_matchers.put(guild_id, matcher)
+        return matcher
+
+    async def matcher(self, guild_id: int | None) -> MemeMatcher:
+        if guild_id is None or self._load_guild_rules is None:
+            return self.global_matcher
+        matcher = self._guild_matchers.get(guild_id)
+        if matcher is not None:
+            return matcher
+        guild_rules = self._guild_rules.get(guild_id)
+        if guild_rules is None:
+            generation = self._generations.get(guild_id, 0)
+            task = self._loading.get(guild_id)
+            if task is None:
+                task = asyncio.create_task(self._load_guild_rules(guild_id))
+                self._loading[guild_id] = task
+                task.add_done_callback(lambda done: self._loading.pop(guild_id) if self._loading.get(guild_id) is done else None)
+            guild_rules = await task
+            if generation != self._generations.get(guild_id, 0):
+                # 読み込み中にルールが変更された。古いルールをキャッシュしないようにこの場限りで使う
+                return MemeMatcher([*guild_rules, *self.global_matcher.rules])
+            self._guild_rules.put(guild_id, guild_rules)
+        return self._compile(guild_id, guild_rules)
+
+    def invalidate(self, guild_id: int):
+        self._generations[guild_id] = self._generations.get(guild_id, 0) + 1
+        self._loading.pop(guild_id, None)
+        self._guild_rules.invalidate(guild_id)
+        self._guild_matchers.invalidate(guild_id)
+
+
+class MemeFileWatcher:
+    def __init__(self, path: str, engine: MemeEngine, interval: float = 5.0):
+        self.path = path
+        self.engine = engine
+        self.interval = interval
+        self._signature = self._stat()
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _build(self):
+        # 読み込み・検証・コンパイルまで全部ループの外でやる
+        signature = self._stat()
+        return signature, MemeMatcher(loadMemeFile(self.path))
+
+    async def reload(self, force: bool = False) -> bool:
+        async with self._lock:
+            if not force and self._stat() == self._signature:
+                return False
+            try:
+                signature, matcher = await asyncio.to_thread(self._build)
+            except Exception:
+                # 壊れたファイルを読んだときは今のルールのまま動かし続ける
+                self._signature = self._stat()
+                raise
+            self._signature = signature
+            self.engine.swap_global(matcher)
+            return True
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run(), name="meme-file-watcher")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.reload()
+            except Exception as e:
+                logger.warning(f"Failed to reload {self.path}: {e}. Keeping the current meme rules.")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
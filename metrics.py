@@ -0,0 +1,302 @@
+import asyncio
+import bisect
+import functools
+import logging
+import math
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable
+from sqlalchemy import event
+
+logger = logging.getLogger('vampire.metrics')
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _formatValue(value: float) -> str:
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _formatLabels(pairs) -> str:
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (), func: Callable[[], float | dict] = None):
+        # func を渡すと出力のたびに呼んで値を取る。ラベルがあるときは {ラベルのタプル: 値} を返す
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.func = func
+        self._lock = threading.Lock()
+        self._values: dict[tuple[str, ...], object] = {}
+
+    def _key(self, labels) -> tuple[str, ...]:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {labels}")
+        return tuple(str(label) for label in labels)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _collect(self) -> dict:
+        if self.func is None:
+            with self._lock:
+                return dict(self._values)
+        value = self.func()
+        return value if isinstance(value, dict) else {(): value}
+
+    def _samples(self):
+        try:
+            items = self._collect()
+        except Exception:
+            logger.exception(f"Failed to collect metric {self.name}")
+            return
+        for key, value in items.items():
+            yield f"{self.name}{_formatLabels(list(zip(self.labelnames, key)))} {_formatValue(value)}"
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1.0):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, *labels) -> float:
+        return self._collect().get(self._key(labels), 0.0)
+
+    def items(self) -> dict[tuple[str, ...], float]:
+        return self._collect()
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, *labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, *labels) -> float:
+        return self._collect().get(self._key(labels), math.nan)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [バケットごとの件数 (最後は +Inf), 合計, 件数]
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def snapshot(self) -> dict[tuple[str, ...], tuple[list[int], float, int]]:
+        with self._lock:
+            return {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+
+    def quantile(self, q: float, counts: list[int]) -> float:
+        # Prometheus の histogram_quantile と同じく、バケットの中は線形に補間する
+        count = sum(counts)
+        if count == 0:
+            return math.nan
+        rank = q * count
+        cumulative = 0
+        for index, bucket_count in enumerate(counts):
+            if cumulative + bucket_count >= rank and bucket_count:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.buckets[-1]
+
+    def _samples(self):
+        for key, (counts, total, count) in self.snapshot().items():
+            pairs = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, math.inf), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket{_formatLabels([*pairs, ("le", _formatValue(bound))])} {cumulative}"
+            yield f"{self.name}_sum{_formatLabels(pairs)} {_formatValue(total)}"
+            yield f"{self.name}_count{_formatLabels(pairs)} {count}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: Metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric):
+                    raise ValueError(f"Metric {metric.name} is already registered as {existing.kind}")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, help: str, labelnames: tuple[str, ...] = (), func: Callable[[], float | dict] = None) -> Counter:
+        return self._register(Counter(name, help, labelnames, func))
+
+    def gauge(self, name: str, help: str, labelnames: tuple[str, ...] = (), func: Callable[[], float | dict] = None) -> Gauge:
+        return self._register(Gauge(name, help, labelnames, func))
+
+    def histogram(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+_STATEMENT_OPERATION = re.compile(r"^\s*(\w+)")
+_STATEMENT_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE)\s+\"?(\w+)", re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=1024)
+def statementLabels(statement: str) -> tuple[str, str]:
+    # SQL文そのものをラベルにすると種類が増えすぎるので、操作とテーブル名にまとめる
+    operation = _STATEMENT_OPERATION.match(statement)
+    table = _STATEMENT_TABLE.search(statement)
+    return (operation.group(1).upper() if operation else "OTHER", table.group(1) if table else "")
+
+
+def instrumentEngine(engine, registry: Registry = registry):
+    duration = registry.histogram("vampire_sql_duration_seconds", "Time spent executing SQL statements", ("operation", "table"))
+    errors = registry.counter("vampire_sql_errors_total", "SQL statements that raised an error", ("operation", "table"))
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._vampire_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_vampire_started", None)
+        if started is not None:
+            duration.observe(time.perf_counter() - started, *statementLabels(statement))
+
+    @event.listens_for(engine, "handle_error")
+    def _error(exception_context):
+        errors.inc(*statementLabels(exception_context.statement or ""))
+
+    return duration
+
+
+class MetricsExporter:
+    def __init__(self, registry: Registry = registry, path: str = None, port: int = 0, host: str = "127.0.0.1", interval: float = 15.0):
+        self.registry = registry
+        self.path = path
+        self.port = port
+        self.host = host
+        self.interval = interval
+        self._task = None
+        self._server = None
+
+    async def start(self):
+        if self.path and self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run(), name="metrics-file-writer")
+        if self.port and self._server is None:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+            logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    def _write(self, text: str):
+        # 書きかけのファイルを読まれないように、別名で書いてから置き換える
+        temporary = f"{self.path}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(temporary, self.path)
+
+    async def write(self):
+        await asyncio.to_thread(self._write, self.registry.render())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.write()
+            except Exception as e:
+                logger.warning(f"Failed to write metrics to {self.path}: {e}")
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] in (b"/", b"/metrics"):
+                status, body = "200 OK", self.registry.render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self.path:
+            try:
+                await self.write()
+            except Exception as e:
+                logger.warning(f"Failed to write metrics to {self.path}: {e}")
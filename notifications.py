@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import time
+from typing import Callable, Sequence
+import discord
+
+logger = logging.getLogger('vampire.notifications')
+
+# Discord のメッセージの最大文字数
+MESSAGE_LIMIT = 2000
+# 通知の種類ごとの文面。{names} にはまとめた名前、{0} {1} にはチャンネル名が入る
+# 名前やチャンネル名は format の引数として渡すので、中に "{names}" などが含まれていても置き換わらない
+TEMPLATES = {
+    "join": "{names} が {0} に参加しました。",
+    "leave": "{names} が {0} から退出しました。",
+    "move": "{names} が {0} から {1} に移動しました。",
+}
+NAME_SEPARATOR = "、"
+
+
+def _truncate(text: str, limit: int) -> str:
+    return text if len(text) <= limit else text[:max(0, limit - 1)] + "…"
+
+
+def formatDigest(events: Sequence[tuple[str, tuple[str, ...], str]], limit: int = MESSAGE_LIMIT) -> list[str]:
+    # (種類, チャンネル名, 名前) の並びを、同じ通知ごとに名前をまとめた行にして、limit 文字以内のメッセージに詰める
+    # 例: [("join", ("General",), "A"), ("join", ("General",), "B")] -> ["A、B が General に参加しました。"]
+    # 1人の通知の順番は変えない。すでに後の行に出ている人は前の行にはまとめず、新しい行にする
+    groups: list[tuple[tuple[str, tuple[str, ...]], dict[str, None]]] = []
+    last_group: dict[tuple[str, tuple[str, ...]], int] = {}
+    last_line: dict[str, int] = {}
+    for kind, channel_names, name in events:
+        key = (kind, tuple(channel_names))
+        index = last_group.get(key)
+        if index is None or last_line.get(name, -1) > index:
+            index = last_group[key] = len(groups)
+            groups.append((key, {}))
+        groups[index][1][name] = None
+        last_line[name] = index
+
+    lines = []
+    for (kind, channel_names), names in groups:
+        template = TEMPLATES[kind]
+        budget = limit - len(template.format(*channel_names, names=""))
+        if budget <= 0:
+            lines.append(_truncate(template.format(*channel_names, names=""), limit))
+            continue
+        current = []
+        length = 0
+        for name in names:
+            name = _truncate(name, budget)
+            added = len(name) + (len(NAME_SEPARATOR) if current else 0)
+            if current and length + added > budget:
+                lines.append(template.format(*channel_names, names=NAME_SEPARATOR.join(current)))
+                current, length, added = [], 0, len(name)
+            current.append(name)
+            length += added
+        if current:
+            lines.append(template.format(*channel_names, names=NAME_SEPARATOR.join(current)))
+
+    messages = []
+    current = ""
+    for line in lines:
+        if current and len(current) + 1 + len(line) > limit:
+            messages.append(current)
+            current = ""
+        current = f"{current}\n{line}" if current else line
+    if current:
+        messages.append(current)
+    return messages
+
+
+class _ChannelQueue:
+    def __init__(self, channel):
+        self.channel = channel
+        # (種類, チャンネル名, 名前, 積んだ時刻)。文面にするのは送るとき
+        self.events: list[tuple[str, tuple[str, ...], str, float]] = []
+        self.task = None
+
+
+class NotificationDispatcher:
+    def __init__(self, window: float = 1.5, max_pending: int = 200, limit: int = MESSAGE_LIMIT, close_timeout: float = 5.0,
+                 observe_delay: Callable[[float], None] = None):
+        # window 秒の間に届いた通知を1通にまとめる。送信は1チャンネルにつき window 秒に1回まで
+        self.window = window
+        self.max_pending = max_pending
+        self.limit = limit
+        self.close_timeout = close_timeout
+        self.observe_delay = observe_delay
+        self._queues: dict[int, _ChannelQueue] = {}
+        self._closing = asyncio.Event()
+        self.queued = 0
+        self.dropped = 0
+        self.sent_messages = 0
+        self.sent_events = 0
+        self.failed = 0
+
+    def __len__(self):
+        return sum(len(queue.events) for queue in self._queues.values())
+
+    @property
+    def busy_channels(self):
+        return len(self._queues)
+
+    def notify(self, channel, kind: str, channel_names: Sequence[str], name: str) -> bool:
+        # ハンドラから呼ぶ。ここでは積むだけで、DiscordへのHTTPは待たない
+        # kind は TEMPLATES のキー、channel_names はその文面に入るチャンネル名
+        if kind not in TEMPLATES:
+            raise ValueError(f"kind must be one of {', '.join(TEMPLATES)}, got {kind!r}")
+        if self._closing.is_set():
+            return False
+        queue = self._queues.get(channel.id)
+        if queue is None:
+            queue = self._queues[channel.id] = _ChannelQueue(channel)
+        queue.channel = channel
+        queue.events.append((kind, tuple(channel_names), name, time.monotonic()))
+        self.queued += 1
+        accepted = True
+        if len(queue.events) > self.max_pending:
+            # 送信が追いつかないときは古いものから捨てる
+            del queue.events[0]
+            self.dropped += 1
+            accepted = False
+        if queue.task is None:
+            queue.task = asyncio.create_task(self._run(channel.id), name=f"notify-{channel.id}")
+        return accepted
+
+    async def _wait(self, timeout: float):
+        try:
+            await asyncio.wait_for(self._closing.wait(), timeout=timeout)
+        except TimeoutError:
+            pass
+
+    async def _run(self, channel_id: int):
+        queue = self._queues[channel_id]
+        try:
+            while queue.events:
+                await self._wait(self.window)
+                events, queue.events = queue.events, []
+                await self._send(queue.channel, events)
+                if not self._closing.is_set():
+                    # 送った直後の通知も、次の window までまとめてから送る
+                    await self._wait(self.window)
+        finally:
+            self._queues.pop(channel_id, None)
+
+    async def _send(self, channel, events: list[tuple[str, tuple[str, ...], str, float]]):
+        if self.observe_delay is not None:
+            self.observe_delay(time.monotonic() - events[0][3])
+        messages = formatDigest([event[:3] for event in events], self.limit)
+        for message in messages:
+            try:
+                await channel.send(message)
+                self.sent_messages += 1
+            except discord.HTTPException as e:
+                self.failed += 1
+                logger.warning(f"Failed to send notification to channel id={channel.id}: {e}")
+        self.sent_events += len(events)
+        if len(events) > 1:
+            logger.debug("Sent %d notifications as %d message(s) to channel id=%s", len(events), len(messages), channel.id)
+
+    async def close(self):
+        # 残っている通知はすぐに送る。レート制限で待たされても close_timeout 秒で諦める
+        self._closing.set()
+        tasks = [queue.task for queue in self._queues.values() if queue.task is not None]
+        if not tasks:
+            return
+        done, pending = await asyncio.wait(tasks, timeout=self.close_timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+            logger.warning(f"Gave up sending notifications to {len(pending)} channel(s) on shutdown")
+        logger.info(f"Notification dispatcher closed (sent {self.sent_messages} messages for {self.sent_events} events, dropped {self.dropped})")
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# database パッケージは import したときに DATABASE_URL のDBに接続するので、先に使い捨てのファイルを指しておく
+_tmpdir = tempfile.TemporaryDirectory()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_tmpdir.name, 'test.db')}"
+os.environ.setdefault("LEADERBOARD_CACHE_SIZE", "1024")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,35 @@
+import re
+import pytest
+from memes import MemeMatcher, MemeRule, parseMemeRules
+
+
+def test_regex_trigger_with_inline_flag():
+    rules = parseMemeRules({
+        "(?i)hello": {"responses": ["hi"], "mode": "regex"},
+        "^bye$": {"responses": ["see you"], "mode": "regex"},
+    })
+    matcher = MemeMatcher(rules)
+    assert matcher.match("HeLLo there").trigger == "(?i)hello"
+    assert matcher.match("bye").trigger == "^bye$"
+    assert matcher.match("BYE") is None
+
+
+def test_regex_trigger_with_backreference():
+    matcher = MemeMatcher(parseMemeRules({
+        "(x)y": {"responses": ["first"], "mode": "regex"},
+        r"(a)\1": {"responses": ["double"], "mode": "regex"},
+    }))
+    assert matcher.match("baab").trigger == r"(a)\1"
+    assert matcher.match("ab") is None
+
+
+def test_regex_rules_combined_with_guild_rules():
+    global_rules = parseMemeRules({"(?i)hello": {"responses": ["hi"], "mode": "regex"}})
+    matcher = MemeMatcher([MemeRule("hello", ["guild"], "substring"), *global_rules])
+    assert matcher.match("say hello").responses == ["guild"]
+    assert matcher.match("HELLO").responses == ["hi"]
+
+
+def test_invalid_regex_is_rejected():
+    with pytest.raises(re.error):
+        parseMemeRules({"(unclosed": {"responses": ["x"], "mode": "regex"}})
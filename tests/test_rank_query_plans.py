@@ -0,0 +1,130 @@
+import os
+import random
+import pytest
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from database.config import createEngine, loadStorageConfig
+from database.migrations import migrate
+from database.models import Base
+import database.crud as crud
+
+# マイグレーション前のスキーマ (ランキング用のインデックスも schema_version もない) のDBにマイグレーションを適用し、
+# ランキングと集計を読むときに発行されるすべての SELECT が EXPLAIN QUERY PLAN でインデックスを使っているか確かめる
+GUILDS = 50
+USERS = 5000
+ROWS = 50000
+GUILD_ID = 1
+USER_ID = GUILDS + 1
+
+PRIMARY_KEY_LOOKUPS = {
+    "vc_summary": "(id=? AND channel_id=? AND year=? AND month=?)",
+    "vc_daily_summary": "(id=? AND channel_id=? AND year=? AND month=? AND day=?)",
+    "vc_yearly_summary": "(id=? AND channel_id=? AND year=?)",
+    "vc_total_summary": "(id=? AND channel_id=?)",
+}
+# (channel_id, year, month, all_time)
+PERIODS = [(channel_id, 2025, month, all_time) for channel_id in (None, 3) for month, all_time in ((None, False), (5, False), (None, True))]
+
+
+@pytest.fixture(scope="module")
+def legacy_engine(tmp_path_factory):
+    url = f"sqlite:///{os.path.join(tmp_path_factory.mktemp('explain'), 'legacy.db')}"
+    engine = createEngine(loadStorageConfig({"DATABASE_URL": url}))
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        conn.exec_driver_sql("DROP INDEX ix_vc_summary_rank")
+        conn.exec_driver_sql("DROP TABLE schema_version")
+        conn.exec_driver_sql("ALTER TABLE guilds DROP COLUMN retention_months")
+        for table in ("vc_daily_summary", "vc_yearly_summary", "vc_total_summary", "vc_intervals"):
+            conn.exec_driver_sql(f"DROP TABLE {table}")
+        conn.exec_driver_sql("INSERT INTO guilds (guild_id) VALUES " + ",".join(f"({g})" for g in range(GUILDS)))
+        conn.exec_driver_sql("INSERT INTO users (user_id) VALUES " + ",".join(f"({i})" for i in range(1, USERS + 1)))
+        conn.exec_driver_sql("INSERT INTO guild_users (id, guild_id, user_id) VALUES " + ",".join(f"({i}, {i % GUILDS}, {i})" for i in range(1, USERS + 1)))
+        rng = random.Random(0)
+        rows = {(rng.randint(1, USERS), rng.randint(1, 20), rng.choice((2025, 2026)), rng.randint(1, 12)) for _ in range(ROWS)}
+        conn.exec_driver_sql("INSERT INTO vc_summary VALUES " + ",".join(f"({i}, {c}, {y}, {m}, 3600, 600)" for i, c, y, m in rows))
+    migrate(engine)
+    yield engine
+    engine.dispose()
+
+
+def bad_steps(plan: list[str]) -> list[str]:
+    # 集計表や guild_users の全件走査と、カバリングインデックスでも主キーの完全一致でもない集計表の検索を不可とする
+    bad = []
+    for step in plan:
+        if step.startswith("SCAN guild_users") or any(step.startswith(f"SCAN {table}") for table in PRIMARY_KEY_LOOKUPS):
+            bad.append(step)
+        for table, lookup in PRIMARY_KEY_LOOKUPS.items():
+            if step.startswith(f"SEARCH {table} ") and "COVERING INDEX" not in step and not step.endswith(lookup):
+                bad.append(step)
+    return bad
+
+
+def capture(engine, read) -> list[tuple[str, tuple]]:
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(("SELECT", "WITH")):
+            statements.append((statement, parameters))
+
+    # ランキングはメモリ上にあると DB を読まないので、毎回読み込ませる
+    crud.leaderboards.clear()
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        with Session(engine) as session:
+            read(session)
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+        crud.leaderboards.clear()
+    assert statements, "no SELECT was issued"
+    return statements
+
+
+def assert_uses_indexes(engine, statements):
+    raw = engine.raw_connection()
+    try:
+        for statement, parameters in statements:
+            plan = [row[3] for row in raw.cursor().execute("EXPLAIN QUERY PLAN " + statement, parameters)]
+            assert not bad_steps(plan), f"{' '.join(statement.split())}\n" + "\n".join(plan)
+    finally:
+        raw.close()
+
+
+def ignore_no_data(read):
+    def wrapper(session):
+        try:
+            read(session)
+        except crud.NoDataError:
+            pass
+    return wrapper
+
+
+@pytest.mark.parametrize("channel_id, year, month, all_time", PERIODS)
+def test_rank_entries_use_indexes(legacy_engine, channel_id, year, month, all_time):
+    statements = capture(legacy_engine, lambda session: crud.readVcRankEntries(session, GUILD_ID, channel_id, year, month, all_time=all_time))
+    assert_uses_indexes(legacy_engine, statements)
+
+
+@pytest.mark.parametrize("channel_id, year, month, all_time", PERIODS)
+@pytest.mark.parametrize("window_query", [False, True], ids=["leaderboard", "window"])
+def test_rank_page_uses_indexes(legacy_engine, monkeypatch, window_query, channel_id, year, month, all_time):
+    if window_query:
+        # ランキングをメモリに持たない設定では RANK / row_number / count() over の窓関数のクエリになる
+        monkeypatch.setattr(crud.leaderboards, "maxsize", 0)
+    for page in (1, 1000):
+        statements = capture(legacy_engine, lambda session: crud.readVcRankPage(session, GUILD_ID, USER_ID, channel_id, year, month, page=page, all_time=all_time))
+        if window_query:
+            assert any("over" in statement.lower() for statement, _ in statements)
+        assert_uses_indexes(legacy_engine, statements)
+
+
+@pytest.mark.parametrize("channel_id, year, month, all_time", PERIODS)
+def test_user_rank_entry_uses_indexes(legacy_engine, channel_id, year, month, all_time):
+    statements = capture(legacy_engine, ignore_no_data(lambda session: crud.readUserVcRankEntry(session, GUILD_ID, USER_ID, channel_id, year, month, all_time=all_time)))
+    assert_uses_indexes(legacy_engine, statements)
+
+
+@pytest.mark.parametrize("month, day, all_time", [(None, None, False), (5, None, False), (5, 12, False), (None, None, True)])
+def test_summary_uses_indexes(legacy_engine, month, day, all_time):
+    statements = capture(legacy_engine, ignore_no_data(lambda session: crud.readVcSummary(session, GUILD_ID, USER_ID, 3, 2025, month, day, all_time)))
+    assert_uses_indexes(legacy_engine, statements)
@@ -0,0 +1,38 @@
+import time
+import pytest
+from database import init_db
+import database.crud as crud
+
+GUILD_ID = 8001
+CHANNEL_ID = 800100
+MEMBERS = 29
+
+
+@pytest.fixture(scope="module", autouse=True)
+def seeded():
+    init_db()
+    now = int(time.time())
+    # 全員の順位が分かれるように、接続時間を1人ずつずらす
+    intervals = [(GUILD_ID, user_id, CHANNEL_ID, now - 60 - user_id * 10, now - 30, False) for user_id in range(1, MEMBERS + 1)]
+    with crud.get_session() as session:
+        crud.checkpointVcSessions(session, intervals, [], [])
+
+
+def read_page(user_id: int, page: int, channel_id=CHANNEL_ID):
+    with crud.get_session() as session:
+        result = crud.readVcRankPage(session, GUILD_ID, user_id, channel_id=channel_id, page=page, per_page=10)
+    return result.total, result.page_count, [(entry.rank, entry.user_id) for entry in result.entries], \
+        result.user_entry and (result.user_entry.rank, result.user_entry.user_id)
+
+
+@pytest.mark.parametrize("user_id", [1, 999])
+@pytest.mark.parametrize("channel_id", [CHANNEL_ID, None])
+def test_window_query_matches_leaderboard(monkeypatch, user_id, channel_id):
+    pages = range(1, 7)
+    crud.leaderboards.clear()
+    from_leaderboard = [read_page(user_id, page, channel_id) for page in pages]
+    monkeypatch.setattr(crud.leaderboards, "maxsize", 0)
+    from_window_query = [read_page(user_id, page, channel_id) for page in pages]
+    assert from_window_query == from_leaderboard
+    for total, page_count, _, _ in from_window_query:
+        assert (total, page_count) == (MEMBERS, 3)